@@ -0,0 +1,220 @@
+"""Benchmarks of the utils operators and the contour engine.
+
+Run from the repository root:
+
+    python -m benchmarks.run_benchmarks            # compare with baseline.json
+    python -m benchmarks.run_benchmarks --quick    # 256 and 512 pixel images only
+    python -m benchmarks.run_benchmarks --save     # record the baseline
+
+Each case runs on synthetic images from 256x256 to 4096x4096, synthetic 3D
+stacks and the files in `examples/`. Its time is the best of a few runs and
+its peak memory is measured in a separate run with tracemalloc, which sees
+numpy's allocations. A case more than `--tolerance` slower or bigger than in
+the baseline is a regression, and the exit status is then 1.
+
+Timings only compare on the machine that recorded the baseline; its
+description is stored with it and a mismatch is reported.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from medicalcontour import engine, utils, volume_io
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(HERE, "baseline.json")
+EXAMPLES = os.path.join(os.path.dirname(HERE), "examples")
+
+SIZES = (256, 512, 1024, 2048, 4096)
+QUICK_SIZES = (256, 512)
+STACKS = ((128, 128, 64), (256, 256, 64))  # [y, x, z]
+# Fixed amount of work per MGAC case: no early stopping.
+MGAC_PARAMS = dict(iterations=20, patience=0, balloon=-1, smoothing=2)
+
+
+def machine():
+    """What the timings depend on."""
+    return {"platform": platform.platform(), "processor": platform.processor(),
+            "cpus": os.cpu_count(), "python": platform.python_version(),
+            "numpy": np.__version__, "opencv": cv2.__version__}
+
+
+def synthetic_image(shape, seed=0):
+    """uint8 image (2D or 3D) of bright blobs on a darker noisy background."""
+    rng = np.random.default_rng(seed)
+    grids = np.ogrid[tuple(slice(0, n) for n in shape)]
+    image = np.full(shape, 60.0, dtype=np.float32)
+    for _ in range(6):
+        center = [rng.uniform(0.2, 0.8) * n for n in shape]
+        radii = [rng.uniform(0.05, 0.2) * n for n in shape]
+        inside = sum(((g - c) / r) ** 2 for g, c, r in zip(grids, center, radii)) < 1
+        image[inside] += rng.uniform(60, 150)
+    image += rng.normal(0, 8, shape).astype(np.float32)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def _is_lfs_pointer(path):
+    with open(path, "rb") as f:
+        return f.read(40).startswith(b"version https://git-lfs")
+
+
+def inputs(sizes=SIZES, stacks=STACKS, examples=True):
+    """(name, uint8 image) pairs; unusable example files are reported and skipped."""
+    for n in sizes:
+        yield f"synthetic {n}x{n}", synthetic_image((n, n))
+    for shape in stacks:
+        yield "stack {}x{}x{}".format(*shape), synthetic_image(shape)
+    if not examples:
+        return
+    for name in ("slice.png", "mama07ORI.bmp"):
+        image = cv2.imread(os.path.join(EXAMPLES, name), cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            print(f"skipped {name}: cannot be read", file=sys.stderr)
+            continue
+        yield name, image
+    path = os.path.join(EXAMPLES, "volume-2.nii.gz")
+    if _is_lfs_pointer(path):
+        print("skipped volume-2.nii.gz: Git LFS pointer (run `git lfs pull`)", file=sys.stderr)
+        return
+    dataobj = volume_io.load(path).dataobj
+    volume = volume_io.normalize_volume(dataobj, *volume_io.intensity_range(dataobj))
+    middle = volume.shape[2] // 2
+    yield "volume-2 slice", np.ascontiguousarray(volume[:, :, middle])
+    yield "volume-2 slab", np.ascontiguousarray(volume[:, :, max(middle - 16, 0):middle + 16])
+
+
+def _seed(image):
+    """Key points of a centered box seed covering half of each axis."""
+    lows = [n // 4 for n in image.shape]
+    highs = [3 * n // 4 for n in image.shape]
+    # Key points are (x, y[, z]) while the image is indexed [y, x(, z)].
+    order = [1, 0] + list(range(2, image.ndim))
+    return [tuple(lows[i] for i in order), tuple(highs[i] for i in order)]
+
+
+def cases(image):
+    """(stage, callable) pairs for one input; set-up is done here, untimed."""
+    raw = image.astype(np.float64) * 8 - 1000  # CT-like intensities
+    unit = engine.to_unit(image)
+    key_points = _seed(image)
+    init_ls, mean_roi = engine.generate_Initial_mask(unit, "rectangle", key_points)
+    gimage = engine.inverse_gaussian_gradient(unit, alpha=1000, sigma=5.48, dtype=np.float32)
+    gradient = np.gradient(gimage)
+    work = utils.MorphWorkspace()
+    out = np.empty(init_ls.shape, dtype=np.int8)
+    curvop = utils.CurvatureOperator()
+    u = init_ls.copy()
+
+    yield "normalize", lambda: utils.normalize(raw)
+    if image.ndim == 3:
+        yield "normalize_volume", lambda: volume_io.normalize_volume(raw, -1000, 1040)
+    for method in utils.GRADIENT_METHODS:
+        yield f"igg {method}", lambda method=method: engine.inverse_gaussian_gradient(
+            unit, alpha=1000, sigma=5.48, method=method, dtype=np.float32)
+    yield "sup_inf", lambda: utils.sup_inf(init_ls, out=out, work=work)
+    yield "inf_sup", lambda: utils.inf_sup(init_ls, out=out, work=work)
+    yield "_curvop", lambda: utils._curvop(init_ls)
+    yield "CurvatureOperator", lambda: curvop(u)
+    yield "mask rectangle", lambda: engine.generate_Initial_mask(unit, "rectangle", key_points)
+    if image.ndim == 2:
+        yield "mask ellipse", lambda: engine.generate_Initial_mask(unit, "ellipse", key_points)
+    threshold = 0.8 * mean_roi
+    for narrow_band in (False, True):
+        params = engine.ContourParams(narrow_band=narrow_band, **MGAC_PARAMS)
+        name = "mgac narrow band" if narrow_band else "mgac"
+        yield name, lambda params=params: engine.evolve(gimage, init_ls, threshold, params,
+                                                        gradient=gradient)
+
+
+def measure(fn, repeat=3, budget=2.0):
+    """Best time of up to `repeat` runs (fewer once `budget` seconds are
+    spent) and the peak traced memory of one more run, in bytes."""
+    times = []
+    while len(times) < repeat and sum(times) < budget:
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"seconds": min(times), "peak_bytes": peak}
+
+
+def compare(results, baseline, tolerance=0.25, slack_bytes=2 ** 20):
+    """Keys of `results` slower or bigger than `baseline` by more than
+    `tolerance`, with their ratios."""
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        time_ratio = result["seconds"] / max(base["seconds"], 1e-9)
+        memory_limit = base["peak_bytes"] * (1 + tolerance) + slack_bytes
+        if time_ratio > 1 + tolerance or result["peak_bytes"] > memory_limit:
+            regressions.append((key, time_ratio,
+                                result["peak_bytes"] / max(base["peak_bytes"], 1)))
+    return regressions
+
+
+def load_baseline(path=BASELINE):
+    if not os.path.exists(path):
+        return {"machine": {}, "results": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="only the small synthetic images")
+    parser.add_argument("--sizes", type=int, nargs="+", help="synthetic image sizes")
+    parser.add_argument("--filter", default="", help="only cases whose key contains this")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    args = parser.parse_args(argv)
+
+    sizes = args.sizes or (QUICK_SIZES if args.quick else SIZES)
+    stacks = STACKS[:1] if args.quick else STACKS
+    baseline = load_baseline(args.baseline)
+    if baseline["machine"] and baseline["machine"] != machine():
+        print("note: the baseline was recorded on another machine", file=sys.stderr)
+
+    results = {}
+    print(f"{'case':48} {'time ms':>10} {'peak MB':>9} {'vs base':>8}")
+    for input_name, image in inputs(sizes, stacks, examples=not args.quick):
+        for stage, fn in cases(image):
+            key = f"{stage} / {input_name}"
+            if args.filter not in key:
+                continue
+            result = results[key] = measure(fn, args.repeat)
+            base = baseline["results"].get(key)
+            ratio = f"{result['seconds'] / base['seconds']:.2f}x" if base else "-"
+            print(f"{key:48} {result['seconds'] * 1e3:10.2f} "
+                  f"{result['peak_bytes'] / 2 ** 20:9.1f} {ratio:>8}", flush=True)
+
+    if args.save:
+        baseline["machine"] = machine()
+        baseline["results"].update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+        print(f"baseline saved to {args.baseline}")
+        return 0
+    regressions = compare(results, baseline["results"], args.tolerance)
+    for key, time_ratio, memory_ratio in regressions:
+        print(f"REGRESSION {key}: time {time_ratio:.2f}x, peak memory {memory_ratio:.2f}x")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,12 +4,42 @@ from PyQt5.QtWidgets import QApplication, QMainWindow, QPushButton, QVBoxLayout,
 from PyQt5.QtCore import Qt, QPoint
 from PyQt5.QtGui import QImage, QPixmap,QMouseEvent
 from PyQt5.QtWidgets import QLabel
+import io
+import os
 import sys
+import json
+import tempfile
+import time
+import tracemalloc
 import cv2
 import numpy as np
+from scipy import ndimage as ndi
 from medicalcontour.main import ImageSegmentationApp
 # import utils
 import medicalcontour.utils as utils 
+from medicalcontour import engine
+from medicalcontour import contours
+from medicalcontour import display
+from medicalcontour import profiling
+from medicalcontour import propagation
+from medicalcontour import volume_io
+from medicalcontour.labels import LabelStore
+import nibabel as nib
+from benchmarks import run_benchmarks
+from medicalcontour.worker import LabelSaver, RefineJob, SaveJob, SegmentationJob, SegmentationQueue
+
+
+def wait_for_queue(queue, timeout=30.0):
+    """Process Qt events until the background segmentation queue is idle."""
+    deadline = time.monotonic() + timeout
+    while queue.busy or queue.pending:
+        if time.monotonic() > deadline:
+            raise TimeoutError("segmentation queue did not finish")
+        QApplication.processEvents()
+        time.sleep(0.005)
+    QApplication.processEvents()
+
+
 class TestImageSegmentationApp(unittest.TestCase):
 
     def setUp(self):
@@ -76,6 +106,16 @@ class TestImageSegmentationApp(unittest.TestCase):
         self.assertIn("rectangle", [self.window.mode_selector.itemText(i) for i in range(self.window.mode_selector.count())])
         self.assertIn("ellipse", [self.window.mode_selector.itemText(i) for i in range(self.window.mode_selector.count())])
 
+    def test_pyramid_controls_disabled_while_regions_queued(self):
+        """Regions are segmented at full size, so the pyramid options are greyed out."""
+        self.window.key_points = [(10, 10), (40, 40)]
+        self.window.add_region()
+        self.assertFalse(self.window.pyramid_input.isEnabled())
+        self.assertFalse(self.window.pyramid_iterations_input.isEnabled())
+        self.window.regions = []
+        self.window.update_pyramid_controls()
+        self.assertTrue(self.window.pyramid_input.isEnabled())
+
     @patch('cv2.imread')
     def test_load_2d_image(self, mock_imread):
         """Test the load_2d_image function and mock cv2.imread."""
@@ -97,7 +137,7 @@ class TestImageSegmentationApp(unittest.TestCase):
         # Prepare mock NIfTI data
         mock_img_data = np.random.rand(432, 104, 432)  # A 3D image with random data (e.g., 432x104x432)
         mock_nii_img = MagicMock()
-        mock_nii_img.get_fdata.return_value = mock_img_data  # Mocking get_fdata to return the random data
+        mock_nii_img.dataobj = mock_img_data  # Volumes are read chunk by chunk from dataobj
         
         # Mock nib.load to return our mocked NIfTI image
         mock_nib_load.return_value = mock_nii_img
@@ -110,12 +150,13 @@ class TestImageSegmentationApp(unittest.TestCase):
         self.window.load_3d_image(file_path)
 
         # Verify nib.load was called with the correct path
-        mock_nib_load.assert_called_once_with(file_path)
+        mock_nib_load.assert_called_once_with(file_path, keep_file_open=True)
 
         # Verify that the image was processed correctly
         self.assertIsNotNone(self.window.image)  # Ensure image is loaded
         self.assertEqual(self.window.image.shape, (104, 432, 432))  # Verify the shape after transposition and flipping
-        self.assertEqual(self.window.result.shape, (104, 432, 3,432))  # Check the result shape after stacking
+        self.assertEqual(self.window.labels.shape, (104, 432))  # One label map per slice
+        self.assertEqual(self.window.labels.depth, 432)
         
         # Verify slider values
         self.assertTrue(self.window.image_slider.isEnabled())  # Ensure the image slider is enabled
@@ -292,11 +333,16 @@ class TestImageSegmentationApp(unittest.TestCase):
     def test_visual_result(self):
          # Setting mock values for required attributes
         self.window.selected_color = [255, 0, 0]  # Red color for highlighting edges
-        self.window.result = np.zeros((100, 100, 3, 100), dtype=np.uint8)  # Mock 3D RGB image (100x100x100x3)
+        self.window.dim = 3
+        self.window.image = np.zeros((100, 100, 100), dtype=np.uint8)  # Mock 3D image (100x100x100)
+        self.window.labels = LabelStore((100, 100), 100)
         self.window.current_slice = 50  # Choose a slice (e.g., 50)
         
         # Mocking QLabel to simulate display updates
         self.window.result_label = MagicMock()
+        # Overlays are drawn at the size of the view.
+        self.window.result_label.width.return_value = 100
+        self.window.result_label.height.return_value = 100
         self.window.display_image = MagicMock()
         # Simulate a levelset array (e.g., edges in the image)
         levelset = np.zeros((100, 100), dtype=np.float32)
@@ -342,7 +388,9 @@ class TestImageSegmentationApp(unittest.TestCase):
     def test_save_result_save_current_slice(self,mock_info, mock_get_item, mock_get_save_file_name, mock_nib_save, mock_cv2_imwrite):
 
         # Mock required attributes
-        self.window.result = np.zeros((100, 100, 3, 10), dtype=np.uint8)  # Mock image data (100x100x3x10)
+        self.window.dim = 3
+        self.window.image = np.zeros((100, 100, 10), dtype=np.uint8)  # Mock image data (100x100x10)
+        self.window.labels = LabelStore((100, 100), 10)
         self.window.current_slice = 5  # Mock the current slice
         
         # Mock the necessary PyQt dialog methods
@@ -375,5 +423,1208 @@ class TestImageSegmentationApp(unittest.TestCase):
     
 
 
+class TestContourEngine(unittest.TestCase):
+    """The engine must run without a QApplication."""
+
+    def setUp(self):
+        self.image = cv2.imread("examples/mama07ORI.bmp", cv2.IMREAD_GRAYSCALE)
+        self.key_points = [(10, 10), (50, 50)]
+
+    def test_segment_calls_progress_callback(self):
+        levelsets = []
+        params = engine.ContourParams(iterations=5, patience=0)
+        result = engine.segment(self.image, "rectangle", self.key_points,
+                                params=params, iter_callback=levelsets.append)
+
+        self.assertEqual(result.mask.shape, self.image.shape)
+        self.assertEqual(result.iterations, 5)
+        self.assertEqual(len(levelsets), 6)  # initial level set + one per iteration
+
+    def test_segment_matches_manual_pipeline(self):
+        img = self.image / 255.0
+        gimg = engine.inverse_gaussian_gradient(img, alpha=1000, sigma=5.48)
+        init_ls, mean_roi = engine.generate_Initial_mask(img, "rectangle", self.key_points)
+        expected = engine.morphological_geodesic_active_contour(
+            gimg, iterations=10, init_level_set=init_ls, smoothing=2,
+            threshold=0.8 * mean_roi, balloon=-1)
+
+        result = engine.segment(self.image, "rectangle", self.key_points)
+        np.testing.assert_array_equal(result.mask, expected)
+
+    def test_integer_differences_match_np_gradient(self):
+        u = np.int8(np.random.default_rng(6).random((7, 9, 5)) > 0.5)
+        du = np.empty_like(u)
+        for axis, expected in enumerate(np.gradient(u)):
+            np.testing.assert_array_equal(engine._central_differences(u, axis, du), 2 * expected)
+
+    def test_step_reuses_workspace(self):
+        img = self.image / 255.0
+        dimage = np.gradient(engine.inverse_gaussian_gradient(img, alpha=1000, sigma=5.48))
+        u = np.int8(engine.generate_Initial_mask(img, "rectangle", self.key_points)[0])
+        curvop = utils.CurvatureOperator()
+        structure = np.ones((3, 3), dtype=np.int8)
+        engine._evolve_step(u, dimage, dimage[0] > 0, -1, 2, structure, curvop)
+        buffers = {name: buf.ctypes.data for name, buf in curvop.work._buffers.items()}
+        engine._evolve_step(u, dimage, dimage[0] > 0, -1, 2, structure, curvop)
+        self.assertEqual({name: buf.ctypes.data for name, buf in curvop.work._buffers.items()}, buffers)
+
+
+class TestRefine(unittest.TestCase):
+
+    def setUp(self):
+        self.image = cv2.imread("examples/mama07ORI.bmp", cv2.IMREAD_GRAYSCALE)
+        self.params = engine.ContourParams(iterations=300)
+        self.cache = engine.EdgeMapCache()
+        self.key_points = [(64, 64), (192, 192)]
+        self.previous = engine.segment(self.image, "rectangle", self.key_points, params=self.params,
+                                       edge_cache=self.cache, cache_key=0).mask
+
+    def test_edit_is_evolved_in_a_window_from_the_previous_mask(self):
+        moved = [(64, 64), (202, 192)]
+        levelsets = []
+        result = engine.refine(self.image, "rectangle", moved, self.previous, self.key_points,
+                               params=self.params, margin=16, edge_cache=self.cache, cache_key=0,
+                               iter_callback=lambda u: levelsets.append(u.shape))
+        self.assertEqual(self.cache.misses, 1)  # g(I) of the first run
+        self.assertEqual(result.stop_reason, "converged")
+        self.assertLess(result.iterations, 50)
+        self.assertEqual(set(levelsets), {self.image.shape})
+        window = np.zeros(self.image.shape, dtype=bool)
+        window[64 - 16:193 + 16, 193 - 16:203 + 16] = True
+        np.testing.assert_array_equal(result.mask[~window] > 0, self.previous[~window] > 0)
+        self.assertTrue((result.mask[window] != self.previous[window]).any())
+
+        fresh = engine.segment(self.image, "rectangle", moved, params=self.params).mask > 0
+        refined = result.mask > 0
+        self.assertGreater(2 * (fresh & refined).sum() / (fresh.sum() + refined.sum()), 0.95)
+
+    def test_window_edges_are_not_eaten(self):
+        previous = self.previous > 0
+        for moved in ([(70, 64), (192, 192)], [(64, 64), (202, 192)]):
+            result = engine.refine(self.image, "rectangle", moved, self.previous, self.key_points,
+                                   params=self.params, margin=16, edge_cache=self.cache,
+                                   cache_key=0)
+            fresh = engine.segment(self.image, "rectangle", moved, params=self.params,
+                                   edge_cache=self.cache, cache_key=0).mask > 0
+            changed = (engine.generate_Initial_mask(self.image, "rectangle", moved)[0] > 0) ^ \
+                (engine.generate_Initial_mask(self.image, "rectangle", self.key_points)[0] > 0)
+            window = engine._edit_window(changed, 16)
+            edges = np.zeros(self.image.shape, dtype=bool)
+            edges[window] = True
+            edges[tuple(slice(w.start + 1, w.stop - 1) for w in window)] = False
+            kept = previous & fresh
+            self.assertTrue(kept[edges].any())
+            self.assertFalse((kept & ~(result.mask > 0))[edges].any())
+            self.assertFalse((kept & ~(result.mask > 0)).any())
+
+    def test_unmoved_seed_keeps_the_mask(self):
+        result = engine.refine(self.image, "rectangle", self.key_points, self.previous,
+                               self.key_points, params=self.params)
+        self.assertEqual(result.iterations, 0)
+        np.testing.assert_array_equal(result.mask > 0, self.previous > 0)
+
+    def test_dragging_a_key_point_refines_the_slice(self):
+        self.app = QApplication.instance() or QApplication(sys.argv)
+        window = ImageSegmentationApp()
+        window.load_2d_image("examples/mama07ORI.bmp")
+        window.selected_mode = "rectangle"
+        window.key_points = list(self.key_points)
+        window.contour_params = engine.ContourParams(iterations=300)
+        window.medcontour()
+        wait_for_queue(window.segmentation_queue)
+        before = window.labels.mask(0, window.selected_color)
+        jobs = []
+        window.segmentation_queue.finished.connect(lambda job, result: jobs.append(job))
+
+        def mouse(kind, x, y):
+            # Image pixel (x, y) on the view, which is scaled to fit and centered.
+            scale = min(window.original_label.width(), window.original_label.height()) / 256
+            offset = ((window.original_label.width() - 256 * scale) // 2,
+                      (window.original_label.height() - 256 * scale) // 2)
+            point = QPoint(int(offset[0] + (x + 0.5) * scale), int(offset[1] + (y + 0.5) * scale))
+            return QMouseEvent(kind, point, Qt.LeftButton, Qt.LeftButton, Qt.NoModifier)
+
+        window.press_on_image(mouse(QMouseEvent.MouseButtonPress, 192, 192))
+        window.drag_key_point(mouse(QMouseEvent.MouseMove, 197, 192))
+        window.release_key_point(mouse(QMouseEvent.MouseButtonRelease, 202, 192))
+        wait_for_queue(window.segmentation_queue)
+
+        self.assertIsInstance(jobs[0], RefineJob)
+        self.assertEqual(window.key_points, [(64, 64), (202, 192)])
+        self.assertEqual(window.editable_seed[2], [(64, 64), (202, 192)])
+        after = window.labels.mask(0, window.selected_color)
+        self.assertFalse((before & ~after)[:, :150].any())
+        self.assertTrue((after != before).any())
+        window.close()
+
+
+class TestCurvatureOperators(unittest.TestCase):
+    """The shift-based SI/IS operators must match the ndimage reference."""
+
+    @staticmethod
+    def reference_sup_inf(u):
+        return np.array([ndi.binary_erosion(u, P) for P in utils._P2], dtype=np.int8).max(0)
+
+    @staticmethod
+    def reference_inf_sup(u):
+        return np.array([ndi.binary_dilation(u, P) for P in utils._P2], dtype=np.int8).min(0)
+
+    def test_operators_match_reference(self):
+        rng = np.random.default_rng(0)
+        for shape in [(1, 1), (2, 5), (64, 48)]:
+            for density in [0.2, 0.5, 1.0]:
+                u = (rng.random(shape) < density).astype(np.int8)
+                np.testing.assert_array_equal(utils.sup_inf(u), self.reference_sup_inf(u))
+                np.testing.assert_array_equal(utils.inf_sup(u), self.reference_inf_sup(u))
+
+    def test_curvature_operator_alternates_in_place(self):
+        u = (np.random.default_rng(1).random((64, 64)) < 0.5).astype(np.int8)
+        si_is = self.reference_sup_inf(self.reference_inf_sup(u))
+        is_si = self.reference_inf_sup(self.reference_sup_inf(si_is))
+
+        op = utils.CurvatureOperator()
+        v = u.copy()
+        self.assertIs(op(v), v)
+        np.testing.assert_array_equal(v, si_is)
+        op(v)
+        np.testing.assert_array_equal(v, is_si)
+
+
+class TestVolumeSegmentation(unittest.TestCase):
+
+    def setUp(self):
+        grid = np.mgrid[:40, :40, :20]
+        ball = ((grid[0] - 20) ** 2 + (grid[1] - 20) ** 2 + (grid[2] - 10) ** 2) <= 8 ** 2
+        self.volume = np.where(ball, 200, 30).astype(np.uint8)
+
+    def test_3d_operators_match_reference(self):
+        u = (np.random.default_rng(2).random((12, 10, 8)) < 0.6).astype(np.int8)
+        expected_si = np.array([ndi.binary_erosion(u, P) for P in utils._P3], dtype=np.int8).max(0)
+        expected_is = np.array([ndi.binary_dilation(u, P) for P in utils._P3], dtype=np.int8).min(0)
+        np.testing.assert_array_equal(utils.sup_inf(u), expected_si)
+        np.testing.assert_array_equal(utils.inf_sup(u), expected_is)
+
+    def test_generate_3d_box_seed(self):
+        mask, mean_roi = utils.generate_Initial_mask(self.volume / 255.0, "rectangle",
+                                                     [(5, 6, 2), (30, 33, 18)])
+        self.assertEqual(mask.shape, self.volume.shape)
+        self.assertEqual(mask.sum(), 26 * 28 * 17)
+        self.assertGreater(mean_roi, 0)
+
+    def test_segment_volume_shrinks_onto_ball(self):
+        params = engine.ContourParams(sigma=1.0, iterations=30, smoothing=1)
+        result = engine.segment_volume(self.volume, "rectangle", [(4, 4, 0), (36, 36, 19)],
+                                       params=params)
+        self.assertEqual(result.mask.shape, self.volume.shape)
+        self.assertTrue(result.mask[20, 20, 10])
+        self.assertFalse(result.mask[5, 5, 1])
+
+
+class TestVolumeKeyPoints(unittest.TestCase):
+
+    def setUp(self):
+        self.app = QApplication.instance() or QApplication(sys.argv)
+        self.window = ImageSegmentationApp()
+
+    def test_rectangle_is_lifted_to_a_box(self):
+        self.window.current_slice = 10
+        self.window.selected_mode = "rectangle"
+        self.window.key_points = [(10, 20), (30, 60)]
+        self.assertEqual(self.window.volume_key_points(), [(10, 20, 0), (30, 60, 20)])
+
+    def test_points_stay_on_current_slice(self):
+        self.window.current_slice = 4
+        self.window.selected_mode = "point"
+        self.window.key_points = [(1, 2)]
+        self.assertEqual(self.window.volume_key_points(), [(1, 2, 4)])
+
+    def tearDown(self):
+        self.window.close()
+
+
+class TestInitialMask(unittest.TestCase):
+    """Seeds rasterized in their bounding box match a full-image evaluation."""
+
+    def setUp(self):
+        self.image = np.random.default_rng(7).random((60, 80))
+
+    def test_ellipse_and_circle_match_full_grid(self):
+        grid_y, grid_x = np.mgrid[:60, :80]
+        # Clipped by the image border on purpose.
+        (x1, y1), (x2, y2) = (50, 30), (90, 52)
+        cx, cy = (x1 + 80) // 2, (y1 + y2) // 2  # x2 is clipped to the width
+        ellipse = ((grid_x - cx) ** 2 / ((80 - x1) / 2) ** 2 +
+                   (grid_y - cy) ** 2 / ((y2 - y1) / 2) ** 2) <= 1
+        mask, mean_roi = utils.generate_Initial_mask(self.image, "ellipse", [(x1, y1), (x2, y2)])
+        np.testing.assert_array_equal(mask, ellipse)
+        self.assertEqual(mask.dtype, np.int8)
+        self.assertAlmostEqual(mean_roi, self.image[ellipse].mean())
+
+        radius = np.hypot(80 - x1, y2 - y1) / 2
+        circle = np.hypot(grid_y - cy, grid_x - cx) < radius
+        mask, mean_roi = utils.generate_Initial_mask(self.image, "point", [(x1, y1), (x2, y2)])
+        np.testing.assert_array_equal(mask, circle)
+        self.assertAlmostEqual(mean_roi, self.image[circle].mean())
+
+    def test_sphere_matches_full_grid(self):
+        volume = np.random.default_rng(8).random((20, 30, 16))
+        grid = np.mgrid[:20, :30, :16]
+        sphere = np.sqrt(sum((g - c) ** 2 for g, c in zip(grid, (4, 2, 10)))) < 6
+        mask, mean_roi = utils.generate_Initial_mask(volume, "point", [(2, 4, 10)])
+        np.testing.assert_array_equal(mask, sphere)
+        self.assertAlmostEqual(mean_roi, volume[sphere].mean())
+
+
+class TestNarrowBand(unittest.TestCase):
+
+    def test_narrow_band_matches_full_evolution(self):
+        img = cv2.imread("examples/mama07ORI.bmp", cv2.IMREAD_GRAYSCALE) / 255.0
+        gimg = engine.inverse_gaussian_gradient(img, alpha=1000, sigma=5.48)
+        for mode, key_points in [("rectangle", [(10, 10), (200, 200)]),
+                                 ("ellipse", [(30, 40), (220, 200)])]:
+            init_ls, mean_roi = engine.generate_Initial_mask(img, mode, key_points)
+            full = engine.morphological_geodesic_active_contour(
+                gimg, 30, init_ls, smoothing=2, threshold=0.8 * mean_roi, balloon=-1)
+            band = engine.morphological_geodesic_active_contour(
+                gimg, 30, init_ls, smoothing=2, threshold=0.8 * mean_roi, balloon=-1,
+                narrow_band=True, tile_size=16)
+            np.testing.assert_array_equal(band, full)
+
+    def test_narrow_band_in_3d(self):
+        volume = ndi.gaussian_filter(np.random.default_rng(0).random((30, 24, 20)), 2)
+        gimg = engine.inverse_gaussian_gradient(volume, alpha=1000, sigma=1.0)
+        init_ls, _ = engine.generate_Initial_mask(volume, "rectangle", [(3, 3, 3), (20, 25, 16)])
+        full = engine.morphological_geodesic_active_contour(gimg, 10, init_ls, smoothing=1,
+                                                            threshold=0.5, balloon=-1)
+        band = engine.morphological_geodesic_active_contour(gimg, 10, init_ls, smoothing=1,
+                                                            threshold=0.5, balloon=-1,
+                                                            narrow_band=True, tile_size=8)
+        np.testing.assert_array_equal(band, full)
+
+
+class TestConvergence(unittest.TestCase):
+
+    def setUp(self):
+        self.image = cv2.imread("examples/mama07ORI.bmp", cv2.IMREAD_GRAYSCALE)
+        self.key_points = [(10, 10), (50, 50)]
+
+    def test_stops_at_fixed_point_with_same_result(self):
+        params = engine.ContourParams(iterations=400)
+        result = engine.segment(self.image, "rectangle", self.key_points, params=params)
+        full = engine.segment(self.image, "rectangle", self.key_points,
+                              params=engine.ContourParams(iterations=400, patience=0))
+
+        self.assertEqual(result.stop_reason, "converged")
+        self.assertLess(result.iterations, 400)
+        self.assertEqual(full.stop_reason, "max_iterations")
+        np.testing.assert_array_equal(result.mask, full.mask)
+
+    def test_narrow_band_reports_convergence(self):
+        params = engine.ContourParams(iterations=400, narrow_band=True)
+        result = engine.segment(self.image, "rectangle", self.key_points, params=params)
+        reference = engine.segment(self.image, "rectangle", self.key_points,
+                                   params=engine.ContourParams(iterations=400))
+        self.assertEqual(result.stop_reason, "converged")
+        self.assertEqual(result.iterations, reference.iterations)
+
+    def test_tolerance_stops_oscillating_contour(self):
+        params = engine.ContourParams(iterations=400, tolerance=0.001)
+        result = engine.segment(self.image, "rectangle", [(10, 10), (200, 200)], params=params)
+        self.assertEqual(result.stop_reason, "tolerance")
+
+    def test_time_budget(self):
+        params = engine.ContourParams(iterations=400, max_time=0.0)
+        result = engine.segment(self.image, "rectangle", self.key_points, params=params)
+        self.assertEqual(result.stop_reason, "time_budget")
+        self.assertEqual(result.iterations, 1)
+
+
+class TestPyramid(unittest.TestCase):
+
+    def setUp(self):
+        yy, xx = np.mgrid[:301, :257]
+        img = 0.2 + 0.6 * ((yy - 150) ** 2 + (xx - 120) ** 2 < 60 ** 2)
+        self.img = ndi.gaussian_filter(img, 2)
+        self.gimg = engine.inverse_gaussian_gradient(self.img, alpha=1000, sigma=2.0)
+
+    def test_halve_and_double_odd_shapes(self):
+        u = np.zeros((7, 5, 3), dtype=np.int8)
+        u[2:5, 1:4, :] = 1
+        half = engine._halve(u)
+        self.assertEqual(half.shape, (4, 3, 2))
+        self.assertEqual(engine._double(half > 0, u.shape).shape, u.shape)
+        np.testing.assert_allclose(engine._halve(np.ones((5, 5)))[-1], 1.0)
+
+    def test_coarse_to_fine_matches_full_resolution(self):
+        for balloon, key_points, ratio in [(-1, [(10, 10), (245, 290)], 0.8),
+                                           (1, [(115, 145), (125, 155)], 0.5)]:
+            init_ls, mean_roi = engine.generate_Initial_mask(self.img, "rectangle", key_points)
+            full = engine.evolve(self.gimg, init_ls, ratio * mean_roi,
+                                 engine.ContourParams(iterations=1000, balloon=balloon))
+            coarse = engine.evolve(self.gimg, init_ls, ratio * mean_roi,
+                                   engine.ContourParams(iterations=50, balloon=balloon,
+                                                        pyramid_levels=2))
+            self.assertEqual(coarse.stop_reason, "converged")
+            overlap = np.count_nonzero((coarse.mask > 0) & (full.mask > 0))
+            dice = 2 * overlap / (np.count_nonzero(coarse.mask) + np.count_nonzero(full.mask))
+            self.assertGreater(dice, 0.99)
+
+    def test_preview_and_cancel(self):
+        init_ls, mean_roi = engine.generate_Initial_mask(self.img, "rectangle", [(10, 10), (245, 290)])
+        params = engine.ContourParams(iterations=5, pyramid_levels=1, pyramid_iterations=(20,),
+                                      patience=0)
+        shapes = []
+        result = engine.evolve(self.gimg, init_ls, 0.8 * mean_roi, params,
+                               iter_callback=lambda u: shapes.append(u.shape))
+        self.assertEqual(set(shapes), {self.gimg.shape})
+        self.assertEqual(result.iterations, 20 + 5)
+        cancelled = engine.evolve(self.gimg, init_ls, 0.8 * mean_roi, params,
+                                  should_stop=lambda: True)
+        self.assertEqual(cancelled.stop_reason, "cancelled")
+        self.assertEqual(cancelled.mask.shape, self.gimg.shape)
+
+
+class TestDtypePolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.image = cv2.imread("examples/mama07ORI.bmp", cv2.IMREAD_GRAYSCALE)
+
+    def test_unknown_dtype_is_rejected(self):
+        for dtype in ("float23", "float16", np.int32):
+            with self.assertRaisesRegex(ValueError, "float32, float64"):
+                engine.segment(self.image, "rectangle", [(20, 20), (230, 230)],
+                               params=engine.ContourParams(dtype=dtype))
+        self.assertEqual(utils.compute_dtype("float32"), np.float32)
+
+    def test_float32_masks_match_float64(self):
+        for mode, key_points, balloon in [("rectangle", [(20, 20), (230, 230)], -1),
+                                          ("ellipse", [(60, 60), (190, 190)], -1),
+                                          ("point", [(128, 128)], 1)]:
+            masks = [engine.segment(self.image, mode, key_points,
+                                    params=engine.ContourParams(iterations=100, balloon=balloon,
+                                                                dtype=dtype)).mask
+                     for dtype in utils.COMPUTE_DTYPES]
+            np.testing.assert_array_equal(masks[0], masks[1])
+
+    def test_edge_maps_follow_policy(self):
+        cache = engine.EdgeMapCache()
+        for dtype in utils.COMPUTE_DTYPES:
+            engine.segment(self.image, "point", [(128, 128)], edge_cache=cache, cache_key=0,
+                           params=engine.ContourParams(iterations=2, dtype=dtype))
+            gimage, gradient = cache.edge_map(0, None, 1000.0, 5.48, "exact", dtype)
+            self.assertEqual(gimage.dtype, np.dtype(dtype))
+            self.assertEqual(gradient[0].dtype, np.dtype(dtype))
+        self.assertEqual(len(cache), 2)
+
+    def test_normalize_in_float32(self):
+        data = np.random.default_rng(0).normal(300, 200, (256, 256))
+        single = utils.normalize(data)
+        double = utils.normalize(data, dtype=np.float64)
+        self.assertLessEqual(np.abs(single.astype(int) - double).max(), 1)
+        self.assertEqual((single.min(), single.max()), (0, 255))
+        np.testing.assert_array_equal(double, (255 * (data - data.min()) /
+                                               (data.max() - data.min())).astype(np.uint8))
+
+
+class TestRenderThrottle(unittest.TestCase):
+
+    def test_every_n_iterations(self):
+        throttle = display.RenderThrottle("iterations", every_n=3)
+        self.assertEqual([throttle.should_render() for _ in range(7)],
+                         [True, False, False, True, False, False, True])
+
+    def test_interval(self):
+        now = [0.0]
+        throttle = display.RenderThrottle("interval", interval_ms=100, clock=lambda: now[0])
+        rendered = []
+        for t in [0.0, 0.05, 0.1, 0.15, 0.25]:
+            now[0] = t
+            rendered.append(throttle.should_render())
+        self.assertEqual(rendered, [True, False, True, False, True])
+
+    def test_window_preview_n_is_configurable(self):
+        self.app = QApplication.instance() or QApplication(sys.argv)
+        window = ImageSegmentationApp()
+        self.assertFalse(window.preview_n_input.isEnabled())
+        window.preview_selector.setCurrentText("Every N iterations")
+        self.assertTrue(window.preview_n_input.isEnabled())
+        self.assertEqual(window.render_throttle.every_n, 5)
+        window.preview_n_input.setValue(12)
+        self.assertEqual(window.render_throttle.policy, "iterations")
+        self.assertEqual(window.render_throttle.every_n, 12)
+        window.preview_selector.setCurrentText("Every N ms")
+        window.preview_n_input.setValue(250)
+        self.assertEqual(window.render_throttle.interval, 0.25)
+        window.preview_selector.setCurrentText("Final result only")
+        self.assertFalse(window.preview_n_input.isEnabled())
+        self.assertEqual(window.render_throttle.policy, "final")
+        window.close()
+
+    def test_previews_do_not_reenter_the_event_loop(self):
+        self.app = QApplication.instance() or QApplication(sys.argv)
+        window = ImageSegmentationApp()
+        window.load_2d_image("examples/mama07ORI.bmp")
+        job = SegmentationJob(window.image, "rectangle", [(10, 10), (50, 50)],
+                              engine.ContourParams(), image_serial=window.image_serial)
+        levelset = np.zeros((256, 256), dtype=np.int8)
+        levelset[20:60, 20:60] = 1
+        with patch("medicalcontour.main.QApplication") as qt_app:
+            window.on_segmentation_progress(job, levelset)
+        qt_app.processEvents.assert_not_called()
+        window.close()
+
+    def test_final_only_skips_previews_in_the_window(self):
+        self.app = QApplication.instance() or QApplication(sys.argv)
+        window = ImageSegmentationApp()
+        window.load_2d_image("examples/mama07ORI.bmp")
+        window.selected_mode = "rectangle"
+        window.key_points = [(10, 10), (50, 50)]
+        window.preview_selector.setCurrentText("Final result only")
+        window.visual_result = MagicMock(return_value=window.display_data.copy())
+
+        window.medcontour()
+        wait_for_queue(window.segmentation_queue)
+
+        window.visual_result.assert_not_called()  # no intermediate contours
+        self.assertTrue(window.statusBar().currentMessage().startswith("Stopped after"))
+        window.close()
+
+
+class TestSegmentationQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.app = QApplication.instance() or QApplication(sys.argv)
+        self.image = cv2.imread("examples/mama07ORI.bmp", cv2.IMREAD_GRAYSCALE)
+        self.queue = SegmentationQueue()
+        self.finished = []
+        self.queue.finished.connect(lambda job, result: self.finished.append((job, result)))
+
+    def make_job(self, slice_index, **params):
+        return SegmentationJob(self.image, "rectangle", [(10, 10), (50, 50)],
+                               engine.ContourParams(**params), slice_index=slice_index)
+
+    def test_jobs_run_in_background_in_order(self):
+        progress = []
+        self.queue.progress.connect(lambda job, levelset: progress.append(levelset))
+        self.queue.submit(self.make_job(0, iterations=5))
+        self.queue.submit(self.make_job(1, iterations=5))
+        self.assertTrue(self.queue.busy)
+        wait_for_queue(self.queue)
+
+        self.assertEqual([job.slice_index for job, _ in self.finished], [0, 1])
+        expected = engine.segment(self.image, "rectangle", [(10, 10), (50, 50)],
+                                  params=engine.ContourParams(iterations=5))
+        np.testing.assert_array_equal(self.finished[0][1].mask, expected.mask)
+        self.assertEqual(len(progress), 2 * 6)
+
+    def test_volume_progress_sends_only_the_job_slice(self):
+        volume = np.repeat(self.image[:64, :64, None], 8, axis=2)
+        progress = []
+        self.queue.progress.connect(lambda job, levelset: progress.append(levelset))
+        self.queue.submit(SegmentationJob(volume, "rectangle", [(10, 10, 2), (50, 50, 6)],
+                                          engine.ContourParams(iterations=3),
+                                          slice_index=4, volume=True))
+        wait_for_queue(self.queue)
+
+        self.assertEqual(len(progress), 4)
+        self.assertEqual({levelset.shape for levelset in progress}, {(64, 64)})
+        np.testing.assert_array_equal(progress[-1], self.finished[0][1].mask[..., 4])
+
+    def test_cancel_stops_running_and_queued_jobs(self):
+        self.queue.submit(self.make_job(0, iterations=100000, patience=0))
+        self.queue.submit(self.make_job(1))
+        self.queue.cancel()
+        wait_for_queue(self.queue)
+
+        self.assertEqual(len(self.finished), 1)
+        self.assertEqual(self.finished[0][1].stop_reason, "cancelled")
+
+    def test_jobs_of_a_replaced_image_are_dropped(self):
+        window = ImageSegmentationApp()
+        window.load_2d_image("examples/slice.png")
+        window.selected_mode = "rectangle"
+        window.key_points = [(100, 100), (400, 400)]
+        window.contour_params = engine.ContourParams(iterations=100000, patience=0)
+        window.medcontour()
+        window.visual_result = MagicMock()
+        window.load_2d_image("examples/mama07ORI.bmp")  # cancels the running job
+        wait_for_queue(window.segmentation_queue)
+
+        window.visual_result.assert_not_called()
+        self.assertEqual(window.labels.shape[:2], (256, 256))
+        self.assertFalse(window.labels.mask(0, window.selected_color).any())
+
+        # A result of the same shape that was already on its way is dropped as well.
+        stale = SegmentationJob(window.image, "rectangle", [(10, 10), (200, 200)],
+                                engine.ContourParams(iterations=5),
+                                image_serial=window.image_serial - 1)
+        window.on_segmentation_finished(stale, stale.run())
+        self.assertFalse(window.labels.mask(0, window.selected_color).any())
+        window.close()
+
+    def tearDown(self):
+        self.queue.cancel()
+        self.queue.wait()
+
+
+class TestPropagation(unittest.TestCase):
+
+    def setUp(self):
+        grid = np.mgrid[:64, :64, :16]
+        self.organ = (((grid[0] - 32) / 20.0) ** 2 + ((grid[1] - 30) / 16.0) ** 2 +
+                      ((grid[2] - 8) / 7.0) ** 2) <= 1
+        self.volume = np.where(self.organ, 180, 40).astype(np.uint8)
+        self.params = engine.ContourParams(sigma=1.0, iterations=60)
+        self.seed = self.organ[..., 8]
+
+    def test_propagates_until_structure_ends(self):
+        result = propagation.propagate_volume(self.volume, 8, self.seed, self.params, workers=1)
+
+        self.assertEqual(result.stop_reason, "completed")
+        self.assertIn(8, result.slices)
+        self.assertLess(min(result.slices), 5)
+        self.assertGreater(max(result.slices), 11)
+        self.assertFalse(result.mask[..., 0].any())
+        self.assertGreater((result.mask & self.organ).sum(), 0.8 * self.organ.sum())
+
+    def test_process_pool_matches_serial_run(self):
+        serial = propagation.propagate_volume(self.volume, 8, self.seed, self.params, workers=1)
+        pooled = propagation.propagate_volume(self.volume, 8, self.seed, self.params, workers=2)
+        self.assertEqual(pooled.slices, serial.slices)
+        np.testing.assert_array_equal(pooled.mask, serial.mask)
+
+    def deep_volume(self, margin=40):
+        background = np.full((64, 64, margin), 40, dtype=np.uint8)
+        return np.concatenate([background, self.volume, background], axis=2)
+
+    def test_edge_maps_follow_the_walk(self):
+        volume = self.deep_volume()
+        with patch.object(engine, "inverse_gaussian_gradient",
+                          wraps=utils.inverse_gaussian_gradient) as edge_maps:
+            result = propagation.propagate_volume(volume, 48, self.seed, self.params, workers=1)
+        # The slices segmented and the one past each end of the structure.
+        self.assertEqual(edge_maps.call_count, len(result.slices) + 1)
+
+        cache = engine.EdgeMapCache()
+        pooled = propagation.propagate_volume(volume, 48, self.seed, self.params, workers=3,
+                                              edge_cache=cache, cache_key="deep")
+        np.testing.assert_array_equal(pooled.mask, result.mask)
+        self.assertLess(len(cache), len(result.slices) + 4)
+
+    def test_warm_edge_maps_are_reused(self):
+        cache = engine.EdgeMapCache()
+        first = propagation.propagate_volume(self.volume, 8, self.seed, self.params, workers=1,
+                                             edge_cache=cache, cache_key=1)
+        with patch.object(engine, "inverse_gaussian_gradient") as edge_maps:
+            again = propagation.propagate_volume(self.volume, 8, self.seed, self.params,
+                                                 workers=1, edge_cache=cache, cache_key=1)
+        edge_maps.assert_not_called()
+        np.testing.assert_array_equal(again.mask, first.mask)
+
+    def test_cancel(self):
+        result = propagation.propagate_volume(self.volume, 8, self.seed, self.params,
+                                              workers=1, should_stop=lambda: True)
+        self.assertEqual(result.stop_reason, "cancelled")
+        self.assertEqual(result.slices, [8])
+
+
+class TestLazyVolume(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(3)
+        self.data = rng.integers(-1000, 2000, size=(30, 20, 12)).astype(np.int16)
+        self.path = os.path.join(self.tmpdir.name, "volume.nii")
+        nib.save(nib.Nifti1Image(self.data, affine=np.eye(4)), self.path)
+        eager = utils.normalize(self.data.astype(np.float64))
+        self.expected = np.flip(np.transpose(eager, (1, 0, 2)), axis=0)
+
+    def test_slices_match_eager_loading(self):
+        volume = volume_io.LazyVolume(nib.load(self.path).dataobj, chunk_slices=5)
+        self.assertEqual(volume.shape, self.expected.shape)
+        self.assertEqual((volume.min_val, volume.max_val), (self.data.min(), self.data.max()))
+        for z in [0, 7, 11]:
+            np.testing.assert_array_equal(volume[:, :, z], self.expected[:, :, z])
+        np.testing.assert_array_equal(np.asarray(volume), self.expected)
+
+    def test_slice_cache_is_bounded(self):
+        volume = volume_io.LazyVolume(nib.load(self.path).dataobj, cache_slices=2)
+        for z in range(5):
+            volume[:, :, z]
+        self.assertEqual(list(volume._cache), [3, 4])
+
+    def test_gzip_volume_is_decompressed_once(self):
+        path = os.path.join(self.tmpdir.name, "deep.nii.gz")
+        data = np.random.default_rng(5).integers(-1000, 2000, size=(128, 128, 256)).astype(np.int16)
+        nib.save(nib.Nifti1Image(data, affine=np.eye(4)), path)
+
+        start = time.perf_counter()
+        np.asarray(nib.load(path).dataobj)
+        one_pass = time.perf_counter() - start
+        start = time.perf_counter()
+        dataobj = volume_io.load(path).dataobj
+        chunked = volume_io.normalize_volume(dataobj, -1000, 2000, chunk_slices=4)
+        seconds = time.perf_counter() - start
+        # Reopening the file for each of the 64 chunks took about 30 passes.
+        self.assertLess(seconds, 5 * one_pass + 0.5)
+        np.testing.assert_array_equal(chunked, utils.normalize(data, -1000, 2000))
+
+        image = volume_io.load(path, random_access=True)
+        temporary = image.get_filename()
+        self.assertTrue(temporary.endswith(".nii"))
+        volume = volume_io.LazyVolume(image.dataobj)
+        np.testing.assert_array_equal(volume[:, :, 200], utils.normalize(
+            np.flip(data[:, :, 200].T, axis=0), volume.min_val, volume.max_val))
+        del image, volume
+        self.assertFalse(os.path.exists(temporary))
+
+    def test_window_lazy_loading(self):
+        self.app = QApplication.instance() or QApplication(sys.argv)
+        window = ImageSegmentationApp()
+        window.lazy_checkbox.setChecked(True)
+        window.load_3d_image(self.path)
+        self.assertIsInstance(window.image, volume_io.LazyVolume)
+        window.image_slider.setValue(4)
+        np.testing.assert_array_equal(window.image_data[..., 0], self.expected[:, :, 4])
+        window.close()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+class TestNormalization(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(4)
+        self.data = rng.normal(0, 300, size=(64, 48, 40))
+        self.data[0, 0, 0] = 5000  # an outlier
+
+    def test_constant_and_clipped_images(self):
+        np.testing.assert_array_equal(utils.normalize(np.full((4, 4), 7.0)), 0)
+        clipped = utils.normalize(np.array([-10.0, 0.0, 5.0, 10.0, 20.0]), 0, 10)
+        np.testing.assert_array_equal(clipped, [0, 0, 127, 255, 255])
+
+    def test_chunks_match_whole_volume(self):
+        out = np.empty(self.data.shape, dtype=np.uint8)
+        result = volume_io.normalize_volume(self.data, -500, 500, out=out, chunk_slices=7)
+        self.assertIs(result, out)
+        np.testing.assert_array_equal(out, utils.normalize(self.data, -500, 500))
+
+    def test_peak_memory_is_about_one_chunk(self):
+        out = np.empty(self.data.shape, dtype=np.uint8)
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        volume_io.normalize_volume(self.data, -500, 500, out=out, chunk_slices=4)
+        peak = tracemalloc.get_traced_memory()[1] - start
+        if started:
+            tracemalloc.stop()
+        self.assertLess(peak, self.data.nbytes // 4)
+
+    def test_percentiles_and_windows(self):
+        low, high = volume_io.intensity_range(self.data, percentiles=(1, 99), chunk_slices=8)
+        bin_width = (self.data.max() - self.data.min()) / 4096
+        np.testing.assert_allclose([low, high], np.percentile(self.data, [1, 99]),
+                                   atol=2 * bin_width)
+        self.assertEqual(volume_io.intensity_range(self.data, window=utils.WINDOW_PRESETS["Lung"]),
+                         (-1350.0, 150.0))
+
+    def test_window_preset_in_window(self):
+        self.app = QApplication.instance() or QApplication(sys.argv)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "volume.nii")
+            nib.save(nib.Nifti1Image(self.data.astype(np.int16), affine=np.eye(4)), path)
+            window = ImageSegmentationApp()
+            window.load_3d_image(path)
+            window.labels.add_mask(0, np.ones(window.labels.shape, dtype=bool), (255, 0, 0))
+            serial = window.image_serial
+            window.intensity_selector.setCurrentText("Soft tissue window")
+            expected = utils.normalize(self.data.astype(np.int16), -160, 240)
+            np.testing.assert_array_equal(window.image, np.flip(np.transpose(expected, (1, 0, 2)), axis=0))
+            self.assertGreater(window.image_serial, serial)
+            self.assertEqual(window.labels.labelled_slices(), [0])
+            window.close()
+
+
+class TestEdgeMapCache(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(4)
+        self.image = ndi.gaussian_filter(rng.integers(0, 255, (80, 90)).astype(float), 3).astype(np.uint8)
+        self.key_points = [(20, 20), (60, 60)]
+
+    def test_cached_run_matches_uncached(self):
+        cache = engine.EdgeMapCache()
+        expected = engine.segment(self.image, "rectangle", self.key_points)
+        for _ in range(2):
+            result = engine.segment(self.image, "rectangle", self.key_points,
+                                    edge_cache=cache, cache_key=("image", 0))
+            np.testing.assert_array_equal(result.mask, expected.mask)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        engine.segment(self.image, "rectangle", self.key_points,
+                       params=engine.ContourParams(sigma=2.0), edge_cache=cache, cache_key=("image", 0))
+        self.assertEqual(cache.misses, 2)  # other parameters, other edge map
+
+    def test_eviction_keeps_budget(self):
+        entry = self.image.size * 8 * 3  # g(I) and its two gradients in float64
+        cache = engine.EdgeMapCache(budget=2 * entry)
+        for z in range(3):
+            cache.edge_map(z, self.image / 255.0, 1000.0, 5.48)
+        self.assertEqual(len(cache), 2)
+        self.assertLessEqual(cache.nbytes, cache.budget)
+        self.assertNotIn((0, 1000.0, 5.48, "exact"), cache)
+
+    def test_warm_up_fills_cache(self):
+        cache = engine.EdgeMapCache()
+        items = [((0, z), lambda: self.image / 255.0) for z in range(4)]
+        cache.warm(items, 1000.0, 5.48).join(timeout=30)
+        self.assertEqual(len(cache), 4)
+        cache.edge_map((0, 2), self.image / 255.0, 1000.0, 5.48)
+        self.assertEqual(cache.hits, 1)
+
+
+class TestGradientMethods(unittest.TestCase):
+    """The fast g(I) filters stay within their documented error bounds."""
+
+    def gradient_magnitude(self, image, method, sigma=5.48):
+        # Invert g = 1 / sqrt(1 + alpha * |grad|) with alpha = 1.
+        g = utils.inverse_gaussian_gradient(image, alpha=1.0, sigma=sigma, method=method)
+        return 1.0 / np.asarray(g, dtype=np.float64) ** 2 - 1.0
+
+    def relative_errors(self, image, method, border=10, sigma=5.48):
+        exact = ndi.gaussian_gradient_magnitude(image, sigma, mode='nearest')
+        error = np.abs(self.gradient_magnitude(image, method, sigma) - exact) / exact.max()
+        inner = (slice(border, -border),) * image.ndim
+        return error.max(), error[inner].max()
+
+    def test_error_bounds_on_examples(self):
+        for path in ["examples/mama07ORI.bmp", "examples/slice.png"]:
+            image = cv2.imread(path, cv2.IMREAD_GRAYSCALE) / 255.0
+            self.assertLess(self.relative_errors(image, "float32")[0], 1e-4)
+            self.assertLess(self.relative_errors(image, "recursive")[0], 0.015)
+            self.assertLess(self.relative_errors(image, "pyramid")[0], 0.01)
+
+    def test_error_bounds_across_sigma(self):
+        # White noise has the most detail near the border and at small scales.
+        images = [np.random.default_rng(6).random((128, 151)),
+                  cv2.imread("examples/slice.png", cv2.IMREAD_GRAYSCALE) / 255.0]
+        for sigma in [0.5, 1.0, 2.0, 3.0, 3.5, 5.0, 5.48, 8.0, 16.0, 24.0]:
+            for image in images:
+                with self.subTest(sigma=sigma, shape=image.shape):
+                    recursive = self.relative_errors(image, "recursive", sigma=sigma)[0]
+                    pyramid = self.relative_errors(image, "pyramid", sigma=sigma)[0]
+                    self.assertLess(recursive, 0.015 if sigma >= 5 else 1e-4)
+                    self.assertLess(pyramid, 0.01 if sigma >= 3.5 else 1e-4)
+
+    def test_recursive_volume(self):
+        volume = ndi.gaussian_filter(np.random.default_rng(5).random((30, 40, 20)), 2)
+        self.assertLess(self.relative_errors(volume, "recursive", border=2)[0], 0.015)
+
+    def test_float32_segmentation_matches_exact(self):
+        image = cv2.imread("examples/mama07ORI.bmp")
+        exact = engine.segment(image, "rectangle", [(60, 60), (160, 160)])
+        fast = engine.segment(image, "rectangle", [(60, 60), (160, 160)],
+                              params=engine.ContourParams(gradient_method="float32"))
+        np.testing.assert_array_equal(fast.mask, exact.mask)
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            utils.inverse_gaussian_gradient(np.zeros((10, 10)), method="fft")
+
+
+class TestDisplayScaling(unittest.TestCase):
+
+    def setUp(self):
+        self.app = QApplication.instance() or QApplication(sys.argv)
+
+    def test_fit_size_matches_qt(self):
+        from PyQt5.QtCore import QSize
+        for w, h in [(1000, 700), (104, 432), (432, 104), (30, 20)]:
+            expected = QSize(w, h).scaled(450, 400, Qt.KeepAspectRatio)
+            self.assertEqual(display.fit_size(w, h, 450, 400), (expected.width(), expected.height()))
+
+    def test_wrap_shares_buffer(self):
+        img = np.zeros((20, 30, 3), dtype=np.uint8)
+        q_image = display.wrap_qimage(img)
+        img[5, 7] = (10, 20, 30)
+        self.assertEqual(q_image.pixelColor(7, 5).getRgb()[:3], (10, 20, 30))
+
+    def test_downscale_before_convert(self):
+        img = np.random.default_rng(1).integers(0, 255, (2048, 1536, 3), dtype=np.uint8)
+        pyramid = display.MipPyramid(img)
+        self.assertEqual([level.shape[:2] for level in pyramid.levels],
+                         [(2048, 1536), (1024, 768)])
+        for source in (img, pyramid):
+            q_image = display.scaled_qimage(source, 450, 400)
+            self.assertEqual((q_image.width(), q_image.height()), (300, 400))
+        gray = np.full((1000, 1000), 77, dtype=np.uint8)
+        self.assertEqual(display.scaled_qimage(gray, 100, 100).pixelColor(50, 50).red(), 77)
+
+
+class TestSliceCache(unittest.TestCase):
+
+    def test_lru_eviction_within_budget(self):
+        cache = display.SliceCache(budget=300)
+        for key in "abc":
+            cache.put(key, key.upper(), 100)
+        self.assertEqual(cache.get("a"), "A")  # "a" is now the most recent
+        cache.put("d", "D", 100)
+        self.assertNotIn("b", cache)
+        self.assertIn("a", cache)
+        self.assertEqual(cache.nbytes, 300)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_prefetcher_fills_cache(self):
+        cache = display.SliceCache()
+        prefetcher = display.SlicePrefetcher(cache)
+        prefetcher.schedule([(z, lambda z=z: (z * 2, 10)) for z in range(5)])
+        self.assertTrue(prefetcher.join(timeout=10))
+        prefetcher.close()
+        self.assertEqual([cache.get(z) for z in range(5)], [0, 2, 4, 6, 8])
+
+    def test_window_prefetches_in_scroll_direction(self):
+        self.app = QApplication.instance() or QApplication(sys.argv)
+        window = ImageSegmentationApp()
+        window.image = np.random.default_rng(0).integers(0, 255, (40, 30, 20), dtype=np.uint8)
+        window.dim = 3
+        window.labels = LabelStore((40, 30), 20)
+        window.current_slice = 10
+        window.update_image_slice(9)
+        self.assertTrue(window.prefetcher.join(timeout=10))
+        window.update_image_slice(8)
+        self.assertEqual(window.slice_cache.hits, 1)
+        for z in (5, 6, 7):
+            self.assertIn(window.slice_view("image", z)[0], window.slice_cache)
+        window.close()
+
+    def test_slice_changes_build_rgb_only_when_used(self):
+        self.app = QApplication.instance() or QApplication(sys.argv)
+        window = ImageSegmentationApp()
+        window.image = np.random.default_rng(2).integers(0, 255, (40, 30, 20), dtype=np.uint8)
+        window.dim = 3
+        window.labels = LabelStore((40, 30), 20)
+        window.slice_rgb = MagicMock(wraps=window.slice_rgb)
+        for z in (1, 2, 3):
+            window.update_image_slice(z)
+        window.slice_rgb.assert_not_called()
+        np.testing.assert_array_equal(window.display_data[..., 1], window.image[:, :, 3])
+        window.slice_rgb.assert_called_once_with(3)
+        window.close()
+
+    def test_image_view_is_scaled_in_gray(self):
+        self.app = QApplication.instance() or QApplication(sys.argv)
+        window = ImageSegmentationApp()
+        window.image = np.random.default_rng(1).integers(0, 255, (1200, 900, 2), dtype=np.uint8)
+        window.dim = 3
+        window.labels = LabelStore((1200, 900), 2)
+        (q_image, shape), nbytes = window.slice_view("image", 1)[1]()
+        self.assertEqual(q_image.format(), QImage.Format_Grayscale8)
+        self.assertEqual(shape, (1200, 900))
+        self.assertEqual(nbytes, q_image.bytesPerLine() * q_image.height())
+        self.assertLess(nbytes, 1200 * 900)  # one byte per pixel of the view
+        window.close()
+
+
+class TestLabelStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = LabelStore((64, 48), depth=10)
+        self.mask = np.zeros((64, 48), dtype=bool)
+        self.mask[10:30, 5:25] = True
+
+    def test_roundtrip_and_compact_storage(self):
+        self.store.add_mask(3, self.mask, (255, 0, 0))
+        np.testing.assert_array_equal(self.store.mask(3, (255, 0, 0)), self.mask)
+        self.assertEqual(self.store.labelled_slices(), [3])
+        self.assertLess(self.store.nbytes, self.mask.size)  # run-length encoded
+        self.assertFalse(self.store.mask(4, (255, 0, 0)).any())
+
+    def test_labels_per_color(self):
+        other = np.zeros_like(self.mask)
+        other[40:50, 30:40] = True
+        red = self.store.add_mask(0, self.mask, (255, 0, 0))
+        green = self.store.add_mask(0, other, (0, 255, 0))
+        self.assertNotEqual(red, green)
+        np.testing.assert_array_equal(self.store.mask(0, (0, 255, 0)), other)
+        np.testing.assert_array_equal(self.store.mask(0, (255, 0, 0)), self.mask)
+
+    def test_version_changes_on_edit(self):
+        before = self.store.version(2)
+        self.store.add_mask(2, self.mask, (255, 0, 0))
+        self.assertNotEqual(self.store.version(2), before)
+        self.store.set(2, np.zeros((64, 48), dtype=np.uint8))
+        self.assertEqual(self.store.labelled_slices(), [])
+
+    def test_compose_draws_contour(self):
+        self.store.add_mask(1, self.mask, (0, 0, 255))
+        image = np.full((64, 48, 3), 50, dtype=np.uint8)
+        overlay = self.store.compose(1, image)
+        edges = self.mask ^ ndi.binary_erosion(self.mask)
+        self.assertTrue((overlay[edges] == (0, 0, 255)).all())
+        self.assertTrue((overlay[~edges] == 50).all())
+        np.testing.assert_array_equal(self.store.compose(0, image), image)
+
+
+class TestContours(unittest.TestCase):
+
+    def setUp(self):
+        self.label_map = np.zeros((64, 48), dtype=np.uint8)
+        self.label_map[10:30, 5:25] = 1
+        self.label_map[15:20, 10:15] = 0  # a hole
+        yy, xx = np.mgrid[:64, :48]
+        self.label_map[(yy - 45) ** 2 + (xx - 30) ** 2 < 12 ** 2] = 2
+
+    def test_extract_traces_regions_and_holes(self):
+        found = contours.extract(self.label_map)
+        self.assertEqual(sorted(found), [1, 2])
+        self.assertEqual(len(found[1]), 2)  # outer boundary and hole
+        self.assertIn([(5, 10), (5, 29), (24, 10), (24, 29)],
+                      [sorted(map(tuple, p.tolist())) for p in found[1]])
+        simplified = contours.extract(self.label_map, epsilon=1.0)
+        self.assertLess(len(simplified[2][0]), len(found[2][0]))
+
+    def test_polylines_follow_the_raster_edges(self):
+        mask = self.label_map == 2
+        edges = mask ^ ndi.binary_erosion(mask)
+        image = np.zeros((64, 48, 3), dtype=np.uint8)
+        contours.draw(image, [(contours.extract(mask)[1], (0, 255, 0))])
+        drawn = (image == (0, 255, 0)).all(axis=-1)
+        self.assertFalse((drawn & ~mask).any())  # through boundary pixels only
+        self.assertGreater((drawn & edges).sum(), 0.9 * edges.sum())
+
+        gray = np.full((64, 48), 50, dtype=np.uint8)
+        overlay = display.contour_overlay(gray, contours.colored(contours.extract(self.label_map),
+                                                                 {1: (255, 0, 0), 2: (0, 255, 0)}),
+                                          96, 128)
+        self.assertEqual(overlay.shape, (128, 96, 3))
+        self.assertTrue((overlay == (255, 0, 0)).all(axis=-1).any())
+        self.assertTrue((gray == 50).all())
+
+    def test_label_store_traces_each_version_once(self):
+        store = LabelStore((64, 48), depth=2)
+        store.set(1, self.label_map)
+        first = store.contours(1)
+        self.assertIs(store.contours(1), first)
+        store.set(1, (self.label_map == 2).astype(np.uint8))
+        self.assertEqual(sorted(store.contours(1)), [1])
+        self.assertEqual(store.contours(0), {})
+
+    def test_export_json_and_csv(self):
+        slices = {3: contours.extract(self.label_map)}
+        key_points = {3: [(5, 10), (24, 29)]}
+        with tempfile.TemporaryDirectory() as d:
+            contours.export_json(os.path.join(d, "c.json"), slices, {1: (255, 0, 0), 2: (0, 255, 0)},
+                                 key_points)
+            with open(os.path.join(d, "c.json")) as f:
+                data = json.load(f)
+            contours.export_csv(os.path.join(d, "c.csv"), slices, key_points)
+            with open(os.path.join(d, "c.csv")) as f:
+                rows = f.read().splitlines()
+        [entry] = data["slices"]
+        self.assertEqual(entry["key_points"], [[5, 10], [24, 29]])
+        self.assertEqual([c["label"] for c in entry["contours"]], [1, 1, 2])
+        self.assertEqual(data["labels"]["2"]["color"], [0, 255, 0])
+        self.assertEqual(rows[0], "kind,slice,label,contour,x,y")
+        self.assertEqual(rows[1], "key_point,3,0,-1,5,10")
+        vertices = sum(len(p) for polygons in slices[3].values() for p in polygons)
+        self.assertEqual(len(rows), 1 + 2 + vertices)
+
+
+class TestLabelVolumeSave(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        affine = np.diag([0.7, 0.8, 2.5, 1.0])
+        affine[:3, 3] = (10, 20, 30)
+        data = np.random.default_rng(0).random((48, 64, 6)).astype(np.float32)  # [x, y, z]
+        path = self.path("image.nii.gz")
+        nib.save(nib.Nifti1Image(data, affine), path)
+        self.reference = nib.load(path)
+        # Indexed [y, x, z] like the loaded volume.
+        self.image = np.flip(np.transpose(data, (1, 0, 2)), axis=0)
+        self.labels = LabelStore(self.image.shape[:2], 6)
+        self.labels.add_mask(2, self.image[..., 2] > 0.5, (255, 0, 0))
+        self.labels.add_mask(4, self.image[..., 4] > 0.8, (0, 255, 0))
+
+    def path(self, name):
+        return os.path.join(self.dir.name, name)
+
+    def loaded_labels(self, path):
+        data = np.asarray(nib.load(path).dataobj)
+        return np.flip(np.transpose(data, (1, 0, 2)), axis=0)
+
+    def test_labels_keep_reference_geometry(self):
+        progress = []
+        path = self.path("labels.nii.gz")
+        written = volume_io.save_label_volume(self.labels, path, self.reference, compresslevel=9,
+                                              progress=lambda done, total: progress.append(done))
+        saved = nib.load(path)
+        self.assertEqual(saved.get_data_dtype(), np.uint8)
+        np.testing.assert_allclose(saved.affine, self.reference.affine)
+        self.assertEqual(written, list(range(6)))
+        self.assertEqual(progress, list(range(1, 7)))
+        labels = self.loaded_labels(path)
+        np.testing.assert_array_equal(labels[..., 2] == 1, self.image[..., 2] > 0.5)
+        np.testing.assert_array_equal(labels[..., 4] == 2, self.image[..., 4] > 0.8)
+        self.assertFalse(labels[..., 0].any())
+        self.assertFalse(os.path.exists(path + ".part"))
+
+    def test_only_changed_slices_are_rewritten(self):
+        path = self.path("labels.nii")
+        volume_io.save_label_volume(self.labels, path, self.reference)
+        since = self.labels.counter
+        self.labels.set(4, np.zeros(self.labels.shape, dtype=np.uint8))
+        self.labels.add_mask(1, self.image[..., 1] > 0.5, (255, 0, 0))
+        written = volume_io.save_label_volume(self.labels, path, self.reference, since=since)
+        self.assertEqual(written, [1, 4])
+        labels = self.loaded_labels(path)
+        np.testing.assert_array_equal(labels[..., 1] == 1, self.image[..., 1] > 0.5)
+        np.testing.assert_array_equal(labels[..., 2] == 1, self.image[..., 2] > 0.5)
+        self.assertFalse(labels[..., 4].any())
+
+    def test_saver_writes_snapshot_in_background(self):
+        self.app = QApplication.instance() or QApplication(sys.argv)
+        saver = LabelSaver()
+        finished = []
+        saver.finished.connect(lambda job, slices: finished.append(slices))
+        job = SaveJob(self.labels, self.path("labels.nii.gz"), self.reference, compresslevel=1)
+        self.labels.add_mask(0, self.image[..., 0] > 0.5, (255, 0, 0))  # after the snapshot
+        saver.submit(job)
+        self.assertTrue(saver.wait(30))
+        self.app.processEvents()
+        self.assertEqual(finished, [list(range(6))])
+        self.assertFalse(self.loaded_labels(job.path)[..., 0].any())
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+
+class TestMultiRegion(unittest.TestCase):
+
+    def setUp(self):
+        # Two bright disks on a dark background.
+        yy, xx = np.mgrid[:120, :160]
+        self.img = 0.2 + 0.6 * (((yy - 40) ** 2 + (xx - 40) ** 2 < 400) |
+                                ((yy - 80) ** 2 + (xx - 115) ** 2 < 625))
+        self.img = ndi.gaussian_filter(self.img, 1.5)
+        self.gimg = engine.inverse_gaussian_gradient(self.img, alpha=1000, sigma=1.0)
+        self.seeds = [engine.generate_Initial_mask(self.img, "rectangle", points)
+                      for points in ([(35, 35), (45, 45)], [(110, 75), (120, 85)])]
+
+    def run_regions(self, **options):
+        params = engine.ContourParams(iterations=150, balloon=1, **options)
+        return engine.evolve_regions(self.gimg, [ls for ls, _ in self.seeds],
+                                     [0.5 * mean for _, mean in self.seeds], params)
+
+    def test_distant_regions_match_separate_runs(self):
+        params = engine.ContourParams(iterations=150, balloon=1, patience=0)
+        result = self.run_regions(patience=0)
+        for label, (init_ls, mean_roi) in enumerate(self.seeds, 1):
+            alone = engine.evolve(self.gimg, init_ls, 0.5 * mean_roi, params)
+            np.testing.assert_array_equal(result.mask == label, alone.mask > 0)
+
+    def test_touching_regions_do_not_merge(self):
+        flat = np.ones((60, 80))
+        first, _ = engine.generate_Initial_mask(flat, "rectangle", [(10, 10), (40, 40)])
+        second, _ = engine.generate_Initial_mask(flat, "rectangle", [(30, 20), (70, 50)])
+        params = engine.ContourParams(iterations=30, balloon=1)
+        result = engine.evolve_regions(np.ones((60, 80)), [first, second], [0.5, 0.5], params)
+        self.assertTrue((result.mask[first > 0] == 1).all())  # the overlap stays with the first
+        self.assertEqual(set(np.unique(result.mask)), {0, 1, 2})
+        for label in (1, 2):
+            self.assertEqual(ndi.label(result.mask == label)[1], 1)
+
+    def test_narrow_band_and_frozen_regions_give_same_result(self):
+        full = self.run_regions()
+        band = self.run_regions(narrow_band=True, tile_size=16)
+        np.testing.assert_array_equal(band.mask, full.mask)
+        self.assertEqual(band.iterations, full.iterations)
+        with patch.object(engine._Contour, "freeze", lambda contour, labels: None):
+            unfrozen = self.run_regions()
+        np.testing.assert_array_equal(unfrozen.mask, full.mask)
+        self.assertEqual(unfrozen.iterations, full.iterations)
+
+    def test_segment_regions_labels_each_seed(self):
+        image = (self.img * 255).astype(np.uint8)
+        result = engine.segment_regions(image, [("point", [(40, 40)]),
+                                                ("rectangle", [(110, 75), (120, 85)])],
+                                        params=engine.ContourParams(iterations=100, balloon=1))
+        self.assertEqual(result.mask.dtype, np.uint8)
+        self.assertTrue(result.mask[40, 40] == 1 and result.mask[80, 115] == 2)
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_disabled_by_default(self):
+        profiler = profiling.Profiler.from_env({})
+        with profiler.stage("load") as record:
+            record["shape"] = (1, 1)
+        self.assertFalse(profiler.enabled)
+        self.assertEqual(len(profiler.records), 0)
+        self.assertTrue(profiling.Profiler.from_env({profiling.ENV_VAR: "time"}).enabled)
+
+    def test_records_go_to_stderr_without_a_log_file(self):
+        profiler = profiling.Profiler.from_env({profiling.ENV_VAR: "1"})
+        try:
+            with patch.object(sys, "stderr", io.StringIO()) as stderr:
+                with profiler.stage("load", file="volume.nii"):
+                    pass
+        finally:
+            profiler.set_enabled(False)
+        [line] = stderr.getvalue().splitlines()
+        self.assertEqual(json.loads(line)["stage"], "load")
+        self.assertEqual(json.loads(line)["file"], "volume.nii")
+
+    def test_nested_stages_time_and_memory_to_json(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "profile.jsonl")
+            profiler = profiling.Profiler(enabled=True, log_path=path)
+            try:
+                with profiler.stage("segmentation", slice=3) as outer:
+                    with profiler.stage("edge_map"):
+                        np.ones(2 ** 20, dtype=np.uint8)
+                    outer["iterations"] = 5
+            finally:
+                profiler.set_enabled(False)
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+        self.assertEqual([line["stage"] for line in lines], ["edge_map", "segmentation"])
+        self.assertGreaterEqual(lines[0]["peak_bytes"], 2 ** 20)
+        self.assertGreaterEqual(lines[1]["peak_bytes"], 2 ** 20)
+        self.assertEqual(lines[1]["iterations"], 5)
+        self.assertIn("edge_map", lines[1]["stages"])
+        self.assertIn("edge_map", profiling.summary(outer))
+        self.assertFalse(profiler.memory)
+
+    def test_engine_stages(self):
+        profiler = profiling.Profiler(enabled=True, memory=False)
+        image = cv2.imread("examples/mama07ORI.bmp", cv2.IMREAD_GRAYSCALE)
+        with patch.object(profiling, "PROFILER", profiler):
+            engine.segment(image, "point", [(128, 128)],
+                           params=engine.ContourParams(iterations=7, patience=0))
+        self.assertEqual([r["stage"] for r in profiler.records],
+                         ["edge_map", "initial_mask", "evolve"])
+        self.assertEqual(profiler.last("evolve")["iterations"], 7)
+        self.assertIsNone(profiler.last("evolve")["peak_bytes"])
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_cases_run_and_regressions_are_caught(self):
+        image = run_benchmarks.synthetic_image((64, 64))
+        results = {stage: run_benchmarks.measure(fn, repeat=1)
+                   for stage, fn in run_benchmarks.cases(image)}
+        self.assertIn("mgac", results)
+        self.assertGreater(results["normalize"]["peak_bytes"], 0)
+        baseline = {key: dict(result) for key, result in results.items()}
+        baseline["mgac"]["seconds"] = results["mgac"]["seconds"] / 2
+        baseline["normalize"]["peak_bytes"] = 0
+        regressions = run_benchmarks.compare(results, baseline, slack_bytes=0)
+        self.assertEqual(sorted(key for key, _, _ in regressions), ["mgac", "normalize"])
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,92 @@
+"""Vector contours of label maps.
+
+Every label region of a slice is traced once with cv2.findContours, and can
+be simplified with the Douglas-Peucker algorithm. Overlays are drawn from
+the vertices as polylines at the size of the view, and contours export to
+JSON or CSV for analysis tools. Vertices are (x, y) pixel coordinates of the
+slice as shown, like the key points.
+"""
+import csv
+import json
+
+import cv2
+import numpy as np
+
+
+def extract(label_map, epsilon=0.0):
+    """{label: [(n, 2) int32 arrays of (x, y) vertices]} of the regions of a
+    label map (or boolean mask, whose label is 1), outer boundaries and holes.
+
+    With `epsilon` > 0 the contours are simplified, no vertex moving more
+    than `epsilon` pixels.
+    """
+    label_map = np.asarray(label_map).astype(np.uint8, copy=False)
+    found = {}
+    for label in np.flatnonzero(np.bincount(label_map.ravel(), minlength=2)[1:]) + 1:
+        mask = (label_map == label).astype(np.uint8)
+        polygons, _ = cv2.findContours(mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+        if epsilon > 0:
+            polygons = [cv2.approxPolyDP(p, epsilon, True) for p in polygons]
+        found[int(label)] = [p.reshape(-1, 2) for p in polygons]
+    return found
+
+
+def colored(contours, colors):
+    """(polygons, color) pairs of `contours` ({label: polygons}) for `draw`."""
+    return [(polygons, colors[label]) for label, polygons in contours.items()]
+
+
+def draw(image_rgb, items, scale=1.0, thickness=1):
+    """Draw (polygons, color) `items` on `image_rgb` in place, as closed
+    polylines through the pixel centers, with vertices scaled by `scale`
+    (view size / slice size)."""
+    shift = 4  # sub-pixel vertices, in 1/16 pixel
+    for polygons, color in items:
+        points = [np.round(((p + 0.5) * scale - 0.5) * (1 << shift)).astype(np.int32)
+                  for p in polygons]
+        cv2.polylines(image_rgb, points, True, tuple(int(c) for c in color), thickness,
+                      cv2.LINE_8, shift)
+    return image_rgb
+
+
+def to_dict(slices, colors, key_points=None):
+    """JSON-ready description of the contours of several slices.
+
+    `slices` maps slice index -> {label: polygons}, `colors` label -> color
+    and `key_points` slice index -> [(x, y), ...], the seeds of each slice.
+    """
+    key_points = key_points or {}
+    return {
+        "labels": {str(label): {"color": [int(c) for c in color]}
+                   for label, color in colors.items()},
+        "slices": [{"slice": int(z),
+                    "key_points": [[int(v) for v in point] for point in key_points.get(z, [])],
+                    "contours": [{"label": label, "points": p.tolist()}
+                                 for label, polygons in slices.get(z, {}).items()
+                                 for p in polygons]}
+                   for z in sorted(set(slices) | set(key_points))],
+    }
+
+
+def export_json(path, slices, colors, key_points=None):
+    """Write `to_dict` to `path`, compactly."""
+    with open(path, "w") as f:
+        json.dump(to_dict(slices, colors, key_points), f, separators=(",", ":"))
+
+
+def export_csv(path, slices, key_points=None):
+    """Write one row per vertex: kind ("contour" or "key_point"), slice,
+    label, contour number within the slice, x, y. Key points have label 0
+    and contour -1."""
+    key_points = key_points or {}
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["kind", "slice", "label", "contour", "x", "y"])
+        for z in sorted(set(slices) | set(key_points)):
+            for x, y in key_points.get(z, []):
+                writer.writerow(["key_point", z, 0, -1, x, y])
+            number = 0
+            for label, polygons in slices.get(z, {}).items():
+                for p in polygons:
+                    writer.writerows(["contour", z, label, number, x, y] for x, y in p.tolist())
+                    number += 1
@@ -0,0 +1,272 @@
+"""Helpers deciding what gets drawn in the views, and when."""
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from PyQt5.QtGui import QImage
+
+from medicalcontour import contours
+
+# Preview choices offered in the window: label -> RenderThrottle arguments.
+# N of the "Every N" choices is set next to them, starting from these values.
+PREVIEW_POLICIES = {
+    "Every iteration": dict(policy="every"),
+    "Every N ms": dict(policy="interval", interval_ms=100),
+    "Every N iterations": dict(policy="iterations", every_n=5),
+    "Final result only": dict(policy="final"),
+}
+
+# The RenderThrottle argument that N sets, by policy.
+PREVIEW_N = {"interval": "interval_ms", "iterations": "every_n"}
+
+
+class RenderThrottle(object):
+    """Rate-limit intermediate level set rendering during a run.
+
+    policy:
+        "every"      render every iteration
+        "interval"   render at most once every `interval_ms` milliseconds
+        "iterations" render every `every_n` iterations
+        "final"      render nothing until the run is over
+    """
+
+    def __init__(self, policy="every", interval_ms=100, every_n=5, clock=time.perf_counter):
+        if policy not in ("every", "interval", "iterations", "final"):
+            raise ValueError(f"Unknown render policy: {policy}")
+        self.policy = policy
+        self.interval = interval_ms / 1000.0
+        self.every_n = max(1, int(every_n))
+        self.clock = clock
+        self.reset()
+
+    def reset(self):
+        """Start a new run."""
+        self.calls = 0
+        self.rendered = 0
+        self._last = None
+
+    def should_render(self):
+        """Count one update and tell whether to draw it."""
+        self.calls += 1
+        if self.policy == "every":
+            render = True
+        elif self.policy == "final":
+            render = False
+        elif self.policy == "iterations":
+            render = (self.calls - 1) % self.every_n == 0
+        else:
+            now = self.clock()
+            render = self._last is None or now - self._last >= self.interval
+            if render:
+                self._last = now
+        if render:
+            self.rendered += 1
+        return render
+
+    def wrap(self, render):
+        """Return a progress callback that forwards to `render` when allowed."""
+        self.reset()
+
+        def callback(levelset):
+            if self.should_render():
+                render(levelset)
+        return callback
+
+
+def fit_size(width, height, max_width, max_height):
+    """Size of a `width` x `height` image scaled to fit, like Qt.KeepAspectRatio."""
+    fit_width = max_height * width // height
+    if fit_width <= max_width:
+        return max(fit_width, 1), max_height
+    return max_width, max(max_width * height // width, 1)
+
+
+class MipPyramid(object):
+    """An image and its successive halvings, down to about `min_size` pixels.
+
+    Big images are shown from the smallest level that is still larger than
+    the target, so repeated redraws cost the screen size, not the image size.
+    """
+
+    def __init__(self, img, min_size=512):
+        self.levels = [np.ascontiguousarray(img)]
+        while min(self.levels[-1].shape[:2]) >= 2 * min_size:
+            top = self.levels[-1]
+            half = (top.shape[1] // 2, top.shape[0] // 2)
+            self.levels.append(cv2.resize(top, half, interpolation=cv2.INTER_AREA))
+
+    @property
+    def shape(self):
+        return self.levels[0].shape
+
+    def level_for(self, width, height):
+        """The smallest level at least `width` x `height`."""
+        for level in reversed(self.levels):
+            if level.shape[1] >= width and level.shape[0] >= height:
+                return level
+        return self.levels[0]
+
+
+def wrap_qimage(img):
+    """QImage sharing the buffer of a uint8 gray or RGB array.
+
+    The array is kept alive on the QImage; copies must not outlive it.
+    """
+    img = np.ascontiguousarray(img)
+    h, w = img.shape[:2]
+    fmt = QImage.Format_Grayscale8 if img.ndim == 2 else QImage.Format_RGB888
+    q_image = QImage(img.data, w, h, img.strides[0], fmt)
+    q_image.ndarray = img
+    return q_image
+
+
+def scaled_array(img, width, height):
+    """A uint8 gray or RGB array (or MipPyramid) scaled to fit `width` x
+    `height`; `img` itself if it already fits exactly.
+
+    Shrinking is done with area interpolation, so the cost follows the
+    target size.
+    """
+    h, w = img.shape[:2]
+    target = fit_size(w, h, width, height)
+    if isinstance(img, MipPyramid):
+        img = img.level_for(*target)
+    if (img.shape[1], img.shape[0]) != target:
+        shrink = img.shape[1] > target[0]
+        img = cv2.resize(img, target,
+                         interpolation=cv2.INTER_AREA if shrink else cv2.INTER_NEAREST)
+    return img
+
+
+def scaled_qimage(img, width, height):
+    """QImage of a uint8 gray or RGB array (or MipPyramid), scaled to fit
+    `width` x `height`."""
+    return wrap_qimage(scaled_array(img, width, height))
+
+
+def contour_overlay(img, items, width, height):
+    """RGB copy of `img` scaled to fit `width` x `height`, with the
+    (polygons, color) `items` drawn as polylines at that size.
+
+    Drawing after scaling keeps the lines one screen pixel wide, and costs
+    the number of vertices rather than of image pixels.
+    """
+    scaled = scaled_array(img, width, height)
+    if scaled.ndim == 2:
+        scaled = cv2.cvtColor(scaled, cv2.COLOR_GRAY2RGB)
+    elif any(scaled is level for level in getattr(img, "levels", [img])):
+        scaled = scaled.copy()  # never draw on the caller's image
+    return contours.draw(scaled, items, scale=scaled.shape[1] / img.shape[1])
+
+
+class SliceCache(object):
+    """LRU cache of display-ready slice images within `budget` bytes.
+
+    Entries are (QImage, original image shape) pairs. QPixmaps may only be
+    made on the GUI thread, so the cache holds the scaled QImages, which turn
+    into pixmaps for about the cost of a copy.
+    """
+
+    def __init__(self, budget=64 * 2 ** 20):
+        self.budget = budget
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()  # key -> (value, nbytes)
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """The entry for `key`, or None; counts a hit or a miss."""
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value, nbytes):
+        """Store `value`, evicting the least recently used entries to fit."""
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            if nbytes > self.budget:
+                return
+            self._items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.budget:
+                _, (_, n) = self._items.popitem(last=False)
+                self.nbytes -= n
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+
+class SlicePrefetcher(object):
+    """Fill a SliceCache ahead of the slider on a background thread.
+
+    `schedule` takes (key, build) pairs, where `build()` returns the value and
+    its size in bytes, and replaces the work not started yet. `build` runs on
+    the prefetch thread, so it must only touch thread-safe data (numpy
+    arrays, QImages).
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._tasks = []
+        self._busy = False
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def schedule(self, tasks):
+        with self._cond:
+            self._tasks = [(key, build) for key, build in tasks if key not in self.cache]
+            if self._tasks and self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def join(self, timeout=None):
+        """Wait until the scheduled work is done (for tests and shutdown)."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._tasks and not self._busy, timeout)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._tasks = []
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._tasks or self._closed)
+                if self._closed:
+                    return
+                key, build = self._tasks.pop(0)
+                self._busy = True
+            try:
+                if key not in self.cache:
+                    self.cache.put(key, *build())
+            except Exception:
+                pass  # the GUI builds the slice itself when it is shown
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
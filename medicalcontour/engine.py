@@ -0,0 +1,827 @@
+"""GUI-free contour engine.
+
+The morphological geodesic active contour (MGAC) and its helpers live here so
+that they can run on render-less batch nodes without a QApplication. The GUI in
+`main.py` is only a client of this module.
+"""
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Callable, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+from scipy import ndimage as ndi
+
+import medicalcontour.utils as utils
+from medicalcontour import profiling
+
+# Re-exported so that clients only need the engine.
+inverse_gaussian_gradient = utils.inverse_gaussian_gradient
+generate_Initial_mask = utils.generate_Initial_mask
+to_unit = utils.to_unit
+compute_dtype = utils.compute_dtype
+
+IterCallback = Callable[[np.ndarray], None]
+StopCheck = Callable[[], bool]
+
+
+@dataclass
+class ContourParams:
+    """Parameters of a single segmentation run."""
+    alpha: float = 1000.0
+    sigma: float = 5.48
+    # How g(I) is filtered, one of utils.GRADIENT_METHODS (see
+    # inverse_gaussian_gradient for their accuracy).
+    gradient_method: str = "exact"
+    iterations: int = 10
+    smoothing: int = 2
+    threshold_ratio: float = 0.8
+    balloon: int = -1
+    # Only evolve tiles of `tile_size` pixels around the contour.
+    narrow_band: bool = False
+    tile_size: int = 32
+    # Stop once `patience` consecutive iterations changed at most a
+    # `tolerance` fraction of the pixels (0 disables), or after `max_time`
+    # seconds. With tolerance 0 and patience >= 2 stopping early never changes
+    # the result: the level set has reached a fixed point.
+    patience: int = 2
+    tolerance: float = 0.0
+    max_time: Optional[float] = None
+    # Floating point type of the images, g(I) and its gradient, one of
+    # utils.COMPUTE_DTYPES; float32 halves their memory traffic.
+    dtype: str = "float32"
+    # Coarse-to-fine: first evolve on `pyramid_levels` successive halvings of
+    # g(I), coarsest first, for `pyramid_iterations[i]` iterations at level i
+    # (the last count repeats), then refine for `iterations` at full size.
+    # Single-region runs only.
+    pyramid_levels: int = 0
+    pyramid_iterations: Tuple[int, ...] = (100,)
+
+
+@dataclass
+class ContourResult:
+    """Final level set of a run, how many iterations ran and why it stopped.
+
+    `stop_reason` is one of "max_iterations", "converged" (no pixel changed
+    for `patience` iterations), "tolerance" (few pixels changed) or
+    "time_budget" or "cancelled" (`should_stop` returned True).
+    """
+    mask: np.ndarray
+    iterations: int
+    stop_reason: str = "max_iterations"
+
+
+class EdgeMapCache(object):
+    """LRU cache of edge maps g(I) and their gradients within `budget` bytes.
+
+    Keys are (image key, alpha, sigma, method, dtype), where the image key identifies the
+    image, e.g. (image id, slice index). Safe to share between threads.
+    """
+
+    def __init__(self, budget=256 * 2 ** 20):
+        self.budget = budget
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()  # key -> (gimage, gradient, nbytes)
+        self._lock = threading.Lock()
+        self._warm_stop = None
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def edge_map(self, image_key, img, alpha, sigma, method="exact", dtype=None):
+        """g(I) of the unit gray image `img` and its gradient, computed once
+        per (image_key, alpha, sigma, method, dtype). `img` may be a callable
+        returning it."""
+        item = self.get(image_key, alpha, sigma, method, dtype)
+        if item is not None:
+            return item
+        gimage, gradient = self._compute(img() if callable(img) else img, alpha, sigma, method,
+                                         dtype)
+        self._put((image_key, alpha, sigma, method, dtype), gimage, gradient)
+        return gimage, gradient
+
+    def get(self, image_key, alpha, sigma, method="exact", dtype=None):
+        """The cached g(I) and gradient of `image_key`, or None."""
+        key = (image_key, alpha, sigma, method, dtype)
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._items.move_to_end(key)
+            return item[0], item[1]
+
+    def put(self, image_key, gimage, alpha, sigma, method="exact", dtype=None):
+        """Cache a g(I) computed elsewhere, e.g. in another process; its
+        gradient is computed here. Returns both."""
+        gimage, gradient = self._frozen(gimage)
+        self._put((image_key, alpha, sigma, method, dtype), gimage, gradient)
+        return gimage, gradient
+
+    @classmethod
+    def _compute(cls, img, alpha, sigma, method, dtype):
+        return cls._frozen(inverse_gaussian_gradient(img, alpha=alpha, sigma=sigma,
+                                                     method=method, dtype=dtype))
+
+    @staticmethod
+    def _frozen(gimage):
+        gradient = np.gradient(gimage)
+        for array in [gimage] + list(gradient):
+            array.flags.writeable = False  # shared by every run on this image
+        return gimage, gradient
+
+    def _put(self, key, gimage, gradient, evict=True):
+        nbytes = gimage.nbytes + sum(g.nbytes for g in gradient)
+        with self._lock:
+            if key in self._items or nbytes > self.budget:
+                return False
+            if not evict and self.nbytes + nbytes > self.budget:
+                return False
+            self._items[key] = (gimage, gradient, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.budget:
+                _, (_, _, n) = self._items.popitem(last=False)
+                self.nbytes -= n
+            return True
+
+    def warm(self, items, alpha, sigma, method="exact", dtype=None):
+        """Fill the cache on a background thread from (image key, image
+        callable) pairs, stopping once the budget is full.
+
+        Replaces a warm-up still running. Returns the thread.
+        """
+        self.stop_warming()
+        stop = self._warm_stop = threading.Event()
+
+        def run():
+            for image_key, img in items:
+                if stop.is_set():
+                    return
+                key = (image_key, alpha, sigma, method, dtype)
+                if key in self:
+                    continue
+                gimage, gradient = self._compute(img(), alpha, sigma, method, dtype)
+                if not self._put(key, gimage, gradient, evict=False):
+                    return
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def stop_warming(self):
+        if self._warm_stop is not None:
+            self._warm_stop.set()
+
+    def clear(self):
+        self.stop_warming()
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+
+def _to_unit_gray(image: np.ndarray, dtype="float32") -> np.ndarray:
+    """Convert a gray or RGB uint8 slice to a `dtype` gray image in [0, 1]."""
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    return to_unit(image, dtype)
+
+
+def _central_differences(u, axis, out):
+    """Twice `np.gradient(u, axis=axis)` of an int8 level set, in int8."""
+    u, d = np.moveaxis(u, axis, 0), np.moveaxis(out, axis, 0)
+    np.subtract(u[2:], u[:-2], out=d[1:-1])
+    # np.gradient uses one-sided differences at the border.
+    np.subtract(u[1], u[0], out=d[0])
+    np.subtract(u[-1], u[-2], out=d[-1])
+    d[0] *= 2
+    d[-1] *= 2
+    return out
+
+
+def _evolve_step(u, dimage, threshold_mask_balloon, balloon, smoothing,
+                 structure, curvop):
+    """One MGAC iteration (balloon, image attachment, smoothing) on `u`.
+
+    Scratch arrays come from the curvature operator's workspace, so
+    repeated steps on arrays of the same size allocate nothing.
+    """
+    work = curvop.work
+    # Balloon
+    if balloon != 0:
+        aux = work.get("balloon", u.shape)
+        if balloon > 0:
+            ndi.binary_dilation(u, structure, output=aux)
+        else:
+            ndi.binary_erosion(u, structure, output=aux)
+        np.copyto(u, aux, where=threshold_mask_balloon)
+
+    # Image attachment: the sign of grad(g) . grad(u), with grad(u) doubled
+    # so that it stays integer.
+    dtype = np.result_type(*dimage)
+    aux = work.get("attachment", u.shape, dtype)
+    term = work.get("term", u.shape, dtype)
+    du = work.get("du", u.shape, np.int8)
+    for axis, el1 in enumerate(dimage):
+        _central_differences(u, axis, du)
+        if axis == 0:
+            np.multiply(el1, du, out=aux)
+        else:
+            np.multiply(el1, du, out=term)
+            aux += term
+    sign = work.get("sign", u.shape)
+    np.copyto(u, 1, where=np.greater(aux, 0, out=sign))
+    np.copyto(u, 0, where=np.less(aux, 0, out=sign))
+
+    # Smoothing
+    for _ in range(smoothing):
+        curvop(u)
+    return u
+
+
+class _NarrowBand(object):
+    """Tiles of a level set that contain part of its boundary.
+
+    A pixel can only change within `reach` pixels of the boundary in one
+    iteration, so evolving the tiles next to boundary tiles, each padded with
+    a `reach` halo, gives exactly the full-image result. The tiles must be at
+    least `reach` wide.
+    """
+
+    def __init__(self, u, tile_size, reach):
+        self.shape = u.shape
+        self.tile = max(int(tile_size), reach)
+        self.reach = reach
+        self.structure = np.ones((3,) * u.ndim, dtype=bool)
+        grid_shape = tuple(-(-n // self.tile) for n in self.shape)
+        self.has_boundary = np.zeros(grid_shape, dtype=bool)
+        self.update(u, np.ones(grid_shape, dtype=bool))
+
+    def active(self):
+        """Tiles that may change in the next iteration."""
+        return ndi.binary_dilation(self.has_boundary, self.structure)
+
+    def runs(self, tiles):
+        """Merge selected tiles into runs along the last axis.
+
+        Yields the tile indices of each run and its pixel slices.
+        """
+        t = self.tile
+        for lead in np.argwhere(tiles.any(axis=-1)):
+            row = tiles[tuple(lead)]
+            edges = np.flatnonzero(np.diff(np.concatenate(([0], row.view(np.int8), [0]))))
+            for start, stop in zip(edges[::2], edges[1::2]):
+                index = [(int(i), int(i) + 1) for i in lead] + [(int(start), int(stop))]
+                region = tuple(slice(a * t, min(b * t, n)) for (a, b), n in zip(index, self.shape))
+                yield index, region
+
+    def padded(self, region, halo):
+        """`region` grown by `halo` pixels, and `region` relative to it."""
+        outer = tuple(slice(max(r.start - halo, 0), min(r.stop + halo, n))
+                      for r, n in zip(region, self.shape))
+        local = tuple(slice(r.start - o.start, r.stop - o.start) for r, o in zip(region, outer))
+        return outer, local
+
+    def update(self, u, tiles):
+        """Recompute which of `tiles` contain boundary pixels of `u`."""
+        t = self.tile
+        for index, region in self.runs(tiles):
+            outer, local = self.padded(region, 1)
+            crop = u[outer]
+            boundary = (ndi.binary_dilation(crop, self.structure) &
+                        ~ndi.binary_erosion(crop, self.structure))[local]
+            lead = tuple(a for a, _ in index[:-1])
+            start, stop = index[-1]
+            for j in range(start, stop):
+                self.has_boundary[lead + (j,)] = boundary[..., (j - start) * t:(j - start + 1) * t].any()
+
+    def step(self, u, dimage, threshold_mask_balloon, balloon, smoothing,
+             structure, curvop):
+        """Evolve only the active tiles of `u`, in place.
+
+        Returns the number of pixels that changed.
+        """
+        active = self.active()
+        phase = curvop.phase
+        pending = []
+        for index, region in self.runs(active):
+            outer, local = self.padded(region, self.reach)
+            curvop.phase = phase
+            crop = _evolve_step(u[outer].copy(), [d[outer] for d in dimage],
+                                threshold_mask_balloon[outer] if balloon != 0 else None,
+                                balloon, smoothing, structure, curvop)
+            pending.append((index, region, crop[local]))
+
+        changed = np.zeros_like(active)
+        n_changed = 0
+        for index, region, values in pending:
+            n = np.count_nonzero(u[region] != values)
+            if n:
+                u[region] = values
+                changed[tuple(slice(a, b) for a, b in index)] = True
+                n_changed += n
+        if n_changed:
+            self.update(u, ndi.binary_dilation(changed, self.structure))
+        self.changed = changed
+        return n_changed
+
+
+class _Contour(object):
+    """The level set of one region and the state needed to evolve it."""
+
+    def __init__(self, gimage, dimage, init_level_set, threshold, params):
+        self.params = params
+        self.dimage = dimage
+        self.structure = np.ones((3,) * gimage.ndim, dtype=np.int8)
+        self.threshold_mask_balloon = None
+        if params.balloon != 0:
+            self.threshold_mask_balloon = gimage > threshold / np.abs(params.balloon)
+        self.u = np.int8(init_level_set > 0)
+        self.curvop = utils.CurvatureOperator()
+        self.band = None
+        if params.narrow_band:
+            self.band = _NarrowBand(self.u, params.tile_size, reach=2 + 2 * params.smoothing)
+        self.previous = None
+        if params.patience > 0 and self.band is None:
+            self.previous = np.empty_like(self.u)
+            self.diff = np.empty(self.u.shape, dtype=bool)
+        self.max_changed = params.tolerance * self.u.size
+        self.quiet = 0  # consecutive iterations with at most max_changed changes
+        self.quiet_changes = 0
+        self.still = 0  # consecutive iterations without any change
+        self.zone = None  # see freeze()
+        self.pinned = None  # see pin()
+
+    def pin(self, mask):
+        """Keep the pixels of `mask` at their current values (full-image
+        evolution only)."""
+        self.pinned = np.flatnonzero(mask)
+        self.pinned_values = self.u.ravel()[self.pinned]
+
+    def step(self):
+        """One iteration; returns the number of changed pixels if tracked."""
+        u, params = self.u, self.params
+        if self.band is not None:
+            return self.band.step(u, self.dimage, self.threshold_mask_balloon, params.balloon,
+                                  params.smoothing, self.structure, self.curvop)
+        if self.previous is not None:
+            np.copyto(self.previous, u)
+        _evolve_step(u, self.dimage, self.threshold_mask_balloon, params.balloon,
+                     params.smoothing, self.structure, self.curvop)
+        if self.pinned is not None:
+            np.put(u, self.pinned, self.pinned_values)
+        if self.previous is not None:
+            return np.count_nonzero(np.not_equal(u, self.previous, out=self.diff))
+        return None
+
+    def changed_regions(self):
+        """Slices covering every pixel the last step may have changed."""
+        if self.band is None:
+            return [(slice(None),) * self.u.ndim]
+        return [region for _, region in self.band.runs(self.band.changed)]
+
+    def claim(self, labels, label):
+        """Update `labels` with the last step, giving back the pixels that
+        other regions own. Returns how many pixels were given back."""
+        n_removed = 0
+        for region in self.changed_regions():
+            owners, u = labels[region], self.u[region]
+            taken = (owners != label) & (owners != 0) & (u > 0)
+            n = np.count_nonzero(taken)
+            if n:
+                u[taken] = 0
+                n_removed += n
+            owners[owners == label] = 0
+            owners[u > 0] = label
+        if n_removed and self.band is not None:
+            self.band.update(self.u, ndi.binary_dilation(self.band.changed, self.band.structure))
+        return n_removed
+
+    def freeze(self, labels):
+        """Remember the labels around a contour that stopped changing.
+
+        A pixel can only change within `reach` of the boundary, so while
+        the labels there stay the same the contour stays where it is and its
+        iterations can be skipped.
+        """
+        u = self.u.astype(bool)
+        boundary = ndi.binary_dilation(u, self.structure) & ~ndi.binary_erosion(u, self.structure)
+        zone = ndi.binary_dilation(boundary, self.structure, iterations=2 + 2 * self.params.smoothing)
+        self.zone = np.flatnonzero(zone)
+        self.zone_labels = labels.ravel()[self.zone]
+
+    def frozen(self, labels):
+        """Whether the next iteration would leave the contour unchanged."""
+        if self.zone is not None and np.array_equal(labels.ravel()[self.zone], self.zone_labels):
+            return True
+        self.zone = None
+        return False
+
+    def settle(self, n_changed):
+        """Count an iteration that changed `n_changed` pixels; True once the
+        contour has been quiet for `patience` iterations."""
+        if self.params.patience <= 0:
+            return False
+        if n_changed <= self.max_changed:
+            self.quiet += 1
+            self.quiet_changes += n_changed
+        else:
+            self.quiet = self.quiet_changes = 0
+        return self.quiet >= self.params.patience
+
+    @property
+    def quiet_reason(self):
+        return "converged" if self.quiet_changes == 0 else "tolerance"
+
+
+# Coarse levels are not made smaller than this many pixels a side.
+_PYRAMID_MIN_SIZE = 64
+
+
+def _halve(a):
+    """Means of 2x2 (2x2x2) blocks; odd sizes are padded with edge values."""
+    pad = [(0, n % 2) for n in a.shape]
+    if any(after for _, after in pad):
+        a = np.pad(a, pad, mode="edge")
+    blocks = a.reshape([k for n in a.shape for k in (n // 2, 2)])
+    dtype = a.dtype if a.dtype.kind == "f" else np.float32
+    return blocks.mean(axis=tuple(range(1, 2 * a.ndim, 2)), dtype=dtype)
+
+
+def _double(u, shape):
+    """Nearest-neighbour upsampling of `u` by 2, cropped to `shape`."""
+    for axis, n in enumerate(shape):
+        u = np.repeat(u, 2, axis=axis)[(slice(None),) * axis + (slice(0, n),)]
+    return u
+
+
+def _evolve_pyramid(gimage, init_level_set, threshold, params, iter_callback,
+                    should_stop, gradient):
+    """`evolve` run coarse to fine; see `ContourParams.pyramid_levels`."""
+    start = time.perf_counter()
+    gimages = [gimage]
+    while (len(gimages) <= params.pyramid_levels and
+           min(gimages[-1].shape) >= 2 * _PYRAMID_MIN_SIZE):
+        gimages.append(_halve(gimages[-1]))
+    u = init_level_set > 0
+    for _ in gimages[1:]:
+        # Any seed pixel keeps its block, so thin seeds survive.
+        u = _halve(u) > 0
+    counts = list(params.pyramid_iterations) or [params.iterations]
+
+    def remaining():
+        if params.max_time is None:
+            return None
+        return max(params.max_time - (time.perf_counter() - start), 0.0)
+
+    iterations = 0
+    for i, level in enumerate(range(len(gimages) - 1, 0, -1)):
+        level_params = replace(params, pyramid_levels=0, max_time=remaining(),
+                               iterations=counts[min(i, len(counts) - 1)])
+        result = evolve(gimages[level], u, threshold, level_params, should_stop=should_stop)
+        iterations += result.iterations
+        if result.mask.any():
+            u = result.mask
+        # else the structure is too small for this level; go on from its seed.
+        if result.stop_reason in ("cancelled", "time_budget"):
+            for finer in gimages[level - 1::-1]:
+                u = _double(u, finer.shape)
+            return ContourResult(mask=u, iterations=iterations, stop_reason=result.stop_reason)
+        u = _double(u, gimages[level - 1].shape)
+    result = evolve(gimage, u, threshold, replace(params, pyramid_levels=0, max_time=remaining()),
+                    iter_callback, should_stop, gradient)
+    result.iterations += iterations
+    return result
+
+
+def evolve(gimage: np.ndarray, init_level_set: np.ndarray, threshold: float,
+           params: ContourParams,
+           iter_callback: Optional[IterCallback] = None,
+           should_stop: Optional[StopCheck] = None,
+           gradient: Optional[Sequence[np.ndarray]] = None) -> ContourResult:
+    """Morphological Geodesic Active Contours (MorphGAC).
+
+    `gimage` is the edge-stopping map g(I), usually computed with
+    `inverse_gaussian_gradient`; `gradient` is `np.gradient(gimage)` if it
+    is already known. `iter_callback` is called with the level set
+    once before the first iteration and after every iteration; the array is
+    updated in place by the next iteration, so copy it to keep it.
+    `should_stop` is polled before every iteration to cancel the run.
+
+    With `params.narrow_band`, each iteration only touches the tiles around
+    the contour, so its cost follows the contour length instead of the image
+    area. The result is the same as the full-image evolution.
+
+    With `params.pyramid_levels`, most of the travel is done on downsampled
+    copies of g(I) and only the last `params.iterations` run at full size;
+    `iter_callback` then only sees the full-size iterations, and the
+    iteration count includes the coarse ones.
+    """
+    utils._check_input(gimage, init_level_set)
+    if params.pyramid_levels > 0:
+        return _evolve_pyramid(gimage, init_level_set, threshold, params, iter_callback,
+                               should_stop, gradient)
+    start = time.perf_counter()
+    dimage = np.gradient(gimage) if gradient is None else gradient
+    contour = _Contour(gimage, dimage, init_level_set, threshold, params)
+    return _run(contour, params, iter_callback, should_stop, start)
+
+
+def _run(contour, params, iter_callback, should_stop, start):
+    """Iterate `contour` until it stops; see `evolve`."""
+    u = contour.u
+    stop_reason = "max_iterations"
+    if iter_callback is not None:
+        iter_callback(u)
+    iteration = 0
+    while iteration < params.iterations:
+        if should_stop is not None and should_stop():
+            stop_reason = "cancelled"
+            break
+        n_changed = contour.step()
+        iteration += 1
+
+        if iter_callback is not None:
+            iter_callback(u)
+
+        if contour.settle(n_changed):
+            stop_reason = contour.quiet_reason
+            break
+        if params.max_time is not None and time.perf_counter() - start >= params.max_time:
+            if iteration < params.iterations:
+                stop_reason = "time_budget"
+            break
+    return ContourResult(mask=u, iterations=iteration, stop_reason=stop_reason)
+
+
+def evolve_regions(gimage: np.ndarray, init_level_sets: Sequence[np.ndarray],
+                   thresholds: Sequence[float], params: ContourParams,
+                   iter_callback: Optional[IterCallback] = None,
+                   should_stop: Optional[StopCheck] = None,
+                   gradient: Optional[Sequence[np.ndarray]] = None) -> ContourResult:
+    """Evolve several regions together on one g(I).
+
+    Each region evolves as in `evolve` with its own threshold, but may not
+    take pixels that belong to another region, so neighbouring structures
+    never merge (where seeds overlap, the earlier one keeps the pixels).
+    Regions that stopped changing are skipped until a neighbour moves next
+    to them, so settled structures cost almost nothing.
+    The result mask is a uint8 label map: 0 is background and region k of
+    the inputs is k + 1. `iter_callback` receives that label map. The run
+    stops once every region has been quiet for `params.patience` iterations.
+    """
+    if not 0 < len(init_level_sets) < 256:
+        raise ValueError("Between 1 and 255 regions are supported.")
+    for init_level_set in init_level_sets:
+        utils._check_input(gimage, init_level_set)
+    start = time.perf_counter()
+    dimage = np.gradient(gimage) if gradient is None else gradient
+    labels = np.zeros(gimage.shape, dtype=np.uint8)
+    contours = []
+    for label, (init_level_set, threshold) in enumerate(zip(init_level_sets, thresholds), 1):
+        contour = _Contour(gimage, dimage, (init_level_set > 0) & (labels == 0), threshold, params)
+        labels[contour.u > 0] = label
+        contours.append(contour)
+    stop_reason = "max_iterations"
+    if iter_callback is not None:
+        iter_callback(labels)
+    iteration = 0
+    while iteration < params.iterations:
+        if should_stop is not None and should_stop():
+            stop_reason = "cancelled"
+            break
+        settled = []
+        for label, contour in enumerate(contours, 1):
+            if contour.frozen(labels):
+                # Keep the smoothing phase where the skipped iteration leaves it.
+                contour.curvop.phase ^= params.smoothing % 2
+                settled.append(contour.settle(0))
+                continue
+            n_changed = contour.step()
+            if n_changed != 0:
+                n_removed = contour.claim(labels, label)
+                if n_changed is not None:
+                    n_changed += n_removed
+            settled.append(contour.settle(n_changed))
+            # Two still iterations cover both smoothing phases.
+            contour.still = contour.still + 1 if n_changed == 0 else 0
+            if contour.still >= 2:
+                contour.freeze(labels)
+        iteration += 1
+
+        if iter_callback is not None:
+            iter_callback(labels)
+
+        if all(settled):
+            reasons = {contour.quiet_reason for contour in contours}
+            stop_reason = "converged" if reasons == {"converged"} else "tolerance"
+            break
+        if params.max_time is not None and time.perf_counter() - start >= params.max_time:
+            if iteration < params.iterations:
+                stop_reason = "time_budget"
+            break
+    return ContourResult(mask=labels, iterations=iteration, stop_reason=stop_reason)
+
+
+def morphological_geodesic_active_contour(gimage: np.ndarray, iterations: int,
+                                          init_level_set: np.ndarray,
+                                          smoothing: int = 1,
+                                          threshold: float = 0.5,
+                                          balloon: float = 0,
+                                          iter_callback: Optional[IterCallback] = None,
+                                          **options) -> np.ndarray:
+    """MorphGAC returning only the final level set.
+
+    `options` are the other `ContourParams` fields (`narrow_band`,
+    `patience`, `max_time`, ...). See `evolve`.
+    """
+    params = ContourParams(iterations=iterations, smoothing=smoothing,
+                           balloon=balloon, **options)
+    return evolve(gimage, init_level_set, threshold, params, iter_callback).mask
+
+
+def _edge_map(img, params, edge_cache, cache_key):
+    """g(I) of `img`, and its gradient when it comes from `edge_cache`."""
+    with profiling.stage("edge_map", shape=img.shape, method=params.gradient_method):
+        if edge_cache is not None and cache_key is not None:
+            return edge_cache.edge_map(cache_key, img, params.alpha, params.sigma,
+                                       params.gradient_method, params.dtype)
+        gimg = inverse_gaussian_gradient(img, alpha=params.alpha, sigma=params.sigma,
+                                         method=params.gradient_method, dtype=params.dtype)
+        return gimg, None
+
+
+def _evolve_profiled(evolve_fn, *args, **fields):
+    """Call `evolve_fn(*args)` as the "evolve" stage, recording how it ended."""
+    with profiling.stage("evolve", **fields) as record:
+        result = evolve_fn(*args)
+        record["iterations"] = result.iterations
+        record["stop_reason"] = result.stop_reason
+    return result
+
+
+def _segment_unit_gray(img: np.ndarray, mode: str, key_points: Sequence[tuple],
+                       params: ContourParams,
+                       iter_callback: Optional[IterCallback],
+                       should_stop: Optional[StopCheck],
+                       edge_cache: Optional[EdgeMapCache] = None,
+                       cache_key=None) -> ContourResult:
+    # g(I)
+    gimg, gradient = _edge_map(img, params, edge_cache, cache_key)
+    # Initialization of the level-set and threshold.
+    with profiling.stage("initial_mask", mode=mode):
+        init_ls, mean_roi = generate_Initial_mask(img, mode, key_points)
+    return _evolve_profiled(evolve, gimg, init_ls, params.threshold_ratio * mean_roi, params,
+                            iter_callback, should_stop, gradient)
+
+
+def segment(image: np.ndarray, mode: str, key_points: Sequence[Tuple[int, int]],
+            params: Optional[ContourParams] = None,
+            iter_callback: Optional[IterCallback] = None,
+            should_stop: Optional[StopCheck] = None,
+            edge_cache: Optional[EdgeMapCache] = None,
+            cache_key=None) -> ContourResult:
+    """Segment a uint8 gray (or RGB) image from a seed region.
+
+    `mode` and `key_points` describe the seed as in `generate_Initial_mask`.
+    With an `edge_cache`, g(I) is reused between runs on the image that
+    `cache_key` identifies, e.g. (image id, slice index).
+    """
+    if params is None:
+        params = ContourParams()
+    return _segment_unit_gray(_to_unit_gray(image, params.dtype), mode, key_points, params,
+                              iter_callback, should_stop, edge_cache, cache_key)
+
+
+def _edit_window(changed, margin):
+    """Slices of the bounding box of `changed` grown by `margin`, or None."""
+    if not changed.any():
+        return None
+    window = []
+    for axis, n in enumerate(changed.shape):
+        hits = np.flatnonzero(changed.any(axis=tuple(a for a in range(changed.ndim) if a != axis)))
+        window.append(slice(max(int(hits[0]) - margin, 0), min(int(hits[-1]) + 1 + margin, n)))
+    return tuple(window)
+
+
+def _window_callback(iter_callback, u, window, local):
+    """`iter_callback` fed the full level set `u`, with the evolving window
+    (`local` in the evolved array) written into it; None without a callback."""
+    if iter_callback is None:
+        return None
+
+    def callback(level_set):
+        u[window] = level_set[local]
+        iter_callback(u)
+    return callback
+
+
+def refine(image: np.ndarray, mode: str, key_points: Sequence[Tuple[int, int]],
+           previous: np.ndarray, old_key_points: Sequence[Tuple[int, int]],
+           params: Optional[ContourParams] = None, margin: int = 16,
+           iter_callback: Optional[IterCallback] = None,
+           should_stop: Optional[StopCheck] = None,
+           edge_cache: Optional[EdgeMapCache] = None,
+           cache_key=None) -> ContourResult:
+    """Update the mask `previous` that `segment` returned for the seed
+    `old_key_points` after the seed was moved to `key_points`.
+
+    The level set starts from `previous` where both seeds agree, gains the
+    pixels only the new seed covers and loses those only the old one
+    covered. Only the bounding box of those pixels, grown by `margin`, is
+    evolved, against the unchanged pixels of `previous` around it; the rest
+    of `previous` is kept, so a small edit converges in a few iterations on
+    a small window. g(I) comes from `edge_cache` as in
+    `segment`. `iter_callback` receives the full-size level set.
+    """
+    if params is None:
+        params = ContourParams()
+    img = _to_unit_gray(image, params.dtype)
+    gimg, gradient = _edge_map(img, params, edge_cache, cache_key)
+    with profiling.stage("initial_mask", mode=mode, refine=True):
+        new_seed, mean_roi = generate_Initial_mask(img, mode, key_points)
+        old_seed = generate_Initial_mask(img, mode, old_key_points)[0] > 0
+        new_seed = new_seed > 0
+        u = np.int8(((np.asarray(previous) > 0) & ~(old_seed & ~new_seed)) | (new_seed & ~old_seed))
+    window = _edit_window(new_seed ^ old_seed, margin)
+    if window is None:
+        return ContourResult(mask=u, iterations=0, stop_reason="converged")
+    # Evolve the window with a halo as wide as a step's reach, held at the
+    # values of `previous`: the window then evolves as it would in the full
+    # image, instead of treating its edges as background.
+    reach = 2 + 2 * params.smoothing
+    outer = tuple(slice(max(w.start - reach, 0), min(w.stop + reach, n))
+                  for w, n in zip(window, u.shape))
+    local = tuple(slice(w.start - o.start, w.stop - o.start) for w, o in zip(window, outer))
+    halo = np.ones(u[outer].shape, dtype=bool)
+    halo[local] = False
+    with profiling.stage("evolve", window=tuple((w.start, w.stop) for w in window)) as record:
+        start = time.perf_counter()
+        dimage = np.gradient(gimg[outer]) if gradient is None else [g[outer] for g in gradient]
+        # The warm start is already close: no coarse levels; the window is small.
+        window_params = replace(params, pyramid_levels=0, narrow_band=False)
+        contour = _Contour(gimg[outer], dimage, u[outer], params.threshold_ratio * mean_roi,
+                           window_params)
+        contour.pin(halo)
+        result = _run(contour, window_params, _window_callback(iter_callback, u, window, local),
+                      should_stop, start)
+        record["iterations"] = result.iterations
+        record["stop_reason"] = result.stop_reason
+    u[window] = result.mask[local]
+    result.mask = u
+    return result
+
+
+def segment_regions(image: np.ndarray, seeds: Sequence[Tuple[str, Sequence[Tuple[int, int]]]],
+                    params: Optional[ContourParams] = None,
+                    iter_callback: Optional[IterCallback] = None,
+                    should_stop: Optional[StopCheck] = None,
+                    edge_cache: Optional[EdgeMapCache] = None,
+                    cache_key=None) -> ContourResult:
+    """Segment several structures of a uint8 gray (or RGB) image in one run.
+
+    `seeds` is a list of (mode, key_points) pairs as in `segment`. g(I) is
+    computed once for all of them; see `evolve_regions` for the label map
+    returned. The regions always evolve at full size: `params.pyramid_levels`
+    is not used.
+    """
+    if params is None:
+        params = ContourParams()
+    img = _to_unit_gray(image, params.dtype)
+    gimg, gradient = _edge_map(img, params, edge_cache, cache_key)
+    init_level_sets, thresholds = [], []
+    with profiling.stage("initial_mask", regions=len(seeds)):
+        for mode, key_points in seeds:
+            init_ls, mean_roi = generate_Initial_mask(img, mode, key_points)
+            init_level_sets.append(init_ls)
+            thresholds.append(params.threshold_ratio * mean_roi)
+    return _evolve_profiled(evolve_regions, gimg, init_level_sets, thresholds, params,
+                            iter_callback, should_stop, gradient, regions=len(seeds))
+
+
+def segment_volume(volume: np.ndarray, mode: str,
+                   key_points: Sequence[Tuple[int, int, int]],
+                   params: Optional[ContourParams] = None,
+                   iter_callback: Optional[IterCallback] = None,
+                   should_stop: Optional[StopCheck] = None,
+                   edge_cache: Optional[EdgeMapCache] = None,
+                   cache_key=None) -> ContourResult:
+    """Segment a whole uint8 volume, indexed [y, x, z], in a single 3D run.
+
+    The seed is a box, ellipsoid or sphere given by (x, y, z) key points.
+    `edge_cache` and `cache_key` are as in `segment`.
+    """
+    if params is None:
+        params = ContourParams()
+    volume = np.asarray(volume)
+    if volume.ndim != 3:
+        raise ValueError("`volume` must be a 3-dimensional array.")
+    return _segment_unit_gray(to_unit(volume, params.dtype), mode, key_points, params,
+                              iter_callback, should_stop, edge_cache, cache_key)
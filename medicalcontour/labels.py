@@ -0,0 +1,161 @@
+"""Segmentation results stored as per-slice label maps.
+
+Instead of keeping an RGB copy of the whole volume with overlays baked in,
+each slice keeps a uint8 label map (0 is background) and every label has a
+color. Slices without labels take no memory, sparse ones are run-length
+encoded, and overlays are composed only for the slice being shown. The
+vector contours of a slice are traced from its label map when first asked
+for and kept until it changes.
+"""
+import numpy as np
+from scipy import ndimage as ndi
+
+from medicalcontour import contours as contour_tools
+
+
+def draw_label_edges(image_rgb, label_map, colors):
+    """Draw the contour of every label of `label_map` in `colors[label]`, in place."""
+    for label in np.flatnonzero(np.bincount(label_map.ravel(), minlength=2)[1:]) + 1:
+        region = label_map == label
+        edges = region ^ ndi.binary_erosion(region)
+        image_rgb[edges] = colors[label]
+    return image_rgb
+
+
+class _RunLength(object):
+    """Run-length encoded flat label map: run starts and their labels."""
+
+    def __init__(self, flat):
+        self.size = flat.size
+        starts = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        self.starts = np.concatenate(([0], starts)).astype(np.int32)
+        self.values = flat[self.starts]
+
+    @property
+    def nbytes(self):
+        return self.starts.nbytes + self.values.nbytes
+
+    def decode(self):
+        lengths = np.diff(np.append(self.starts, self.size))
+        return np.repeat(self.values, lengths)
+
+
+class LabelStore(object):
+    """Label maps of `depth` slices of `shape` (rows, columns)."""
+
+    def __init__(self, shape, depth=1):
+        self.shape = tuple(shape)
+        self.depth = depth
+        self.colors = {}     # label -> (r, g, b)
+        self._slices = {}    # z -> dense uint8 map or _RunLength
+        self._versions = {}  # z -> change counter, for display caches
+        self._contours = {}  # z -> (version, epsilon, contours)
+        self._counter = 0
+
+    def label_for_color(self, color):
+        """The label drawn in `color`, allocating a new one if needed."""
+        color = tuple(int(c) for c in color)
+        for label, c in self.colors.items():
+            if c == color:
+                return label
+        if len(self.colors) >= 255:
+            raise ValueError("A label map holds at most 255 labels.")
+        label = len(self.colors) + 1
+        self.colors[label] = color
+        return label
+
+    def get(self, z):
+        """The uint8 label map of slice `z` (a new array)."""
+        stored = self._slices.get(z)
+        if stored is None:
+            return np.zeros(self.shape, dtype=np.uint8)
+        if isinstance(stored, _RunLength):
+            return stored.decode().reshape(self.shape)
+        return stored.copy()
+
+    def set(self, z, label_map):
+        """Replace the label map of slice `z`, storing it compactly."""
+        flat = np.ascontiguousarray(label_map, dtype=np.uint8).ravel()
+        if not flat.any():
+            self._slices.pop(z, None)
+        else:
+            encoded = _RunLength(flat)
+            if encoded.nbytes < flat.nbytes:
+                self._slices[z] = encoded
+            else:
+                self._slices[z] = flat.reshape(self.shape).copy()
+        self._counter += 1
+        self._versions[z] = self._counter
+
+    def add_mask(self, z, mask, color):
+        """Paint `mask` into slice `z` with the label of `color`."""
+        label = self.label_for_color(color)
+        label_map = self.get(z)
+        label_map[np.asarray(mask) > 0] = label
+        self.set(z, label_map)
+        return label
+
+    def set_mask(self, z, mask, color):
+        """Make `mask` exactly the pixels of slice `z` drawn in `color`."""
+        label = self.label_for_color(color)
+        label_map = self.get(z)
+        label_map[label_map == label] = 0
+        label_map[np.asarray(mask) > 0] = label
+        self.set(z, label_map)
+        return label
+
+    def mask(self, z, color):
+        """Boolean mask of the pixels of slice `z` drawn in `color`."""
+        color = tuple(int(c) for c in color)
+        labels = [label for label, c in self.colors.items() if c == color]
+        if not labels or z not in self._slices:
+            return np.zeros(self.shape, dtype=bool)
+        return self.get(z) == labels[0]
+
+    def version(self, z):
+        """Changes whenever slice `z` changes."""
+        return self._versions.get(z, 0)
+
+    @property
+    def counter(self):
+        """Changes made so far; pass it to `changed_since` later."""
+        return self._counter
+
+    def changed_since(self, counter):
+        """Slices set (or cleared) after the store's `counter` was `counter`."""
+        return sorted(z for z, version in self._versions.items() if version > counter)
+
+    def snapshot(self):
+        """A copy that later edits do not change (the stored slices are shared:
+        `set` replaces them rather than editing them)."""
+        copy = LabelStore(self.shape, self.depth)
+        copy.colors = dict(self.colors)
+        copy._slices = dict(self._slices)
+        copy._versions = dict(self._versions)
+        copy._contours = dict(self._contours)
+        copy._counter = self._counter
+        return copy
+
+    def contours(self, z, epsilon=0.0):
+        """Vector contours of slice `z`, {label: polygons}; see
+        `contours.extract`. Traced once per version of the slice."""
+        cached = self._contours.get(z)
+        if cached is not None and cached[:2] == (self.version(z), epsilon):
+            return cached[2]
+        found = contour_tools.extract(self.get(z), epsilon) if z in self._slices else {}
+        self._contours[z] = (self.version(z), epsilon, found)
+        return found
+
+    def labelled_slices(self):
+        return sorted(self._slices)
+
+    @property
+    def nbytes(self):
+        return sum(s.nbytes for s in self._slices.values())
+
+    def compose(self, z, image_rgb):
+        """Draw the contour of every label of slice `z` on a copy of `image_rgb`."""
+        overlay = image_rgb.copy()
+        if z not in self._slices:
+            return overlay
+        return draw_label_edges(overlay, self.get(z), self.colors)
@@ -3,15 +3,28 @@ import numpy as np
 import nibabel as nib
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QLabel, QPushButton, QFileDialog,
-    QVBoxLayout, QHBoxLayout, QSlider, QLineEdit, QMessageBox, QWidget,QInputDialog,QComboBox
+    QVBoxLayout, QHBoxLayout, QSlider, QLineEdit, QMessageBox, QWidget,QInputDialog,QComboBox,
+    QCheckBox, QSpinBox
 )
 from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QImage, QPixmap, QMouseEvent
+from PyQt5.QtGui import QPixmap, QMouseEvent
 
 import os
+import time
 
 import utils
 import medicalcontour.utils as utils
+from medicalcontour import contours
+from medicalcontour import engine
+from medicalcontour import display
+from medicalcontour import profiling
+from medicalcontour.labels import LabelStore
+from medicalcontour import volume_io
+from medicalcontour.propagation import PropagationResult
+from medicalcontour.worker import (
+    LabelSaver, PropagationJob, RefineJob, RegionsJob, SaveJob, SegmentationJob,
+    SegmentationQueue
+)
 from matplotlib import pyplot as plt
 from scipy import ndimage as ndi
 
@@ -29,7 +42,34 @@ SIZES = {
 class ImageSegmentationApp(QMainWindow):
     def __init__(self):
         super().__init__()
+        # Segmentation parameters outlive a loaded image, like the widgets that edit them.
+        self.contour_params = engine.ContourParams()
+        self.render_throttle = display.RenderThrottle()
+        # Display-ready slices for slider scrubbing, prepared ahead of the slider.
+        self.slice_cache = display.SliceCache()
+        self.prefetcher = display.SlicePrefetcher(self.slice_cache)
+        self.prefetch_slices = 4
+        self.image_serial = 0  # identifies the loaded image in cache keys and jobs
+        # g(I) of the slices segmented so far, reused when they are re-seeded.
+        self.edge_maps = engine.EdgeMapCache()
+        # Preview rendering time of the running job, logged when it ends.
+        self.render_seconds = 0.0
+        self.render_count = 0
+        self.segmentation_queue = SegmentationQueue(self)
+        self.segmentation_queue.progress.connect(self.on_segmentation_progress)
+        self.segmentation_queue.finished.connect(self.on_segmentation_finished)
+        self.segmentation_queue.failed.connect(self.on_segmentation_failed)
+        # Label volumes are written in the background; the last save is
+        # (path, LabelStore, counter), to rewrite only what changed since.
+        self.label_saver = LabelSaver(self)
+        self.label_saver.progress.connect(self.on_save_progress)
+        self.label_saver.finished.connect(self.on_save_finished)
+        self.label_saver.failed.connect(self.on_save_failed)
+        self.last_label_save = None
+        self.image = None
+        self._image_data = self._display_data = None
         self.init_ui()
+        self.segmentation_queue.busy_changed.connect(self.cancel_button.setEnabled)
         self.init_para()
         # self.image_data = None
         # self.result_data = None
@@ -42,6 +82,10 @@ class ImageSegmentationApp(QMainWindow):
         self.current_slice = 0
         self.current_result_slice = 0
         self.key_points = []
+        self.regions = []  # (mode, key points, color) of seeds segmented together
+        self.slice_key_points = {}  # slice -> key points of its last segmentation, for export
+        self.editable_seed = None  # (slice, mode, key points, color) of the last slice run
+        self.drag_index = None  # key point being dragged
         self.dim = 2
         self.gray = 1
         self.height = 450
@@ -53,6 +97,7 @@ class ImageSegmentationApp(QMainWindow):
         self.selected_mode = "point"  # Default to point mode for keypoints/area
         self.centerpoint = []
         self.selected_color = (255, 0, 0) 
+        self.nii_image = None  # the open NIfTI file, to re-normalize it
 
     def init_ui(self):
         """initial window"""
@@ -92,10 +137,20 @@ class ImageSegmentationApp(QMainWindow):
         self.color_selector.currentTextChanged.connect(self.select_color)
   
 
+        self.region_button = QPushButton("Add Region")
+        self.region_button.setToolTip("Keep the selected seed; all added seeds are segmented together without merging")
+        self.region_button.clicked.connect(self.add_region)
+        self.region_button.setFixedSize(*SIZES["button_size"])
+
         self.edge_button = QPushButton("Centerline Detection")
         self.edge_button.clicked.connect(self.medcontour)
         self.edge_button.setFixedSize(*SIZES["button_size"])
 
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.cancel_segmentation)
+        self.cancel_button.setFixedSize(*SIZES["button_size"])
+        self.cancel_button.setEnabled(False)
+
         self.save_button = QPushButton("Save Result")
         self.save_button.clicked.connect(self.save_result)
         self.save_button.setFixedSize(*SIZES["button_size"])
@@ -105,17 +160,92 @@ class ImageSegmentationApp(QMainWindow):
         control_layout.addWidget(self.keypoint_input)
         control_layout.addWidget(self.keypoint_button)
         control_layout.addWidget(self.color_selector)
+        control_layout.addWidget(self.region_button)
         control_layout.addWidget(self.edge_button)
+        control_layout.addWidget(self.cancel_button)
         control_layout.addWidget(self.save_button)
         main_layout.addLayout(control_layout)
 
+        # segmentation options
+        options_layout = QHBoxLayout()
+        self.volume_checkbox = QCheckBox("Segment whole volume (3D)")
+        self.volume_checkbox.setEnabled(False)
+        options_layout.addWidget(self.volume_checkbox)
+        self.lazy_checkbox = QCheckBox("Lazy loading")
+        self.lazy_checkbox.setToolTip("Read NIfTI slices from disk on demand instead of loading the whole volume")
+        options_layout.addWidget(self.lazy_checkbox)
+        options_layout.addWidget(QLabel("Intensity"))
+        self.intensity_selector = QComboBox()
+        self.intensity_selector.addItems(list(volume_io.INTENSITY_WINDOWS))
+        self.intensity_selector.setToolTip("How volume intensities map to gray levels")
+        self.intensity_selector.currentTextChanged.connect(self.set_intensity_window)
+        options_layout.addWidget(self.intensity_selector)
+        self.warm_checkbox = QCheckBox("Precompute edge maps")
+        self.warm_checkbox.setToolTip("Compute g(I) of every slice in the background after loading a volume")
+        self.warm_checkbox.toggled.connect(self.set_warm_edge_maps)
+        options_layout.addWidget(self.warm_checkbox)
+        self.propagate_button = QPushButton("Propagate through volume")
+        self.propagate_button.clicked.connect(self.propagate_volume)
+        self.propagate_button.setEnabled(False)
+        options_layout.addWidget(self.propagate_button)
+        self.narrow_band_checkbox = QCheckBox("Narrow band")
+        self.narrow_band_checkbox.setChecked(self.contour_params.narrow_band)
+        self.narrow_band_checkbox.toggled.connect(self.set_narrow_band)
+        options_layout.addWidget(self.narrow_band_checkbox)
+        options_layout.addWidget(QLabel("Max iterations"))
+        self.iterations_input = QSpinBox()
+        self.iterations_input.setRange(1, 10000)
+        self.iterations_input.setValue(self.contour_params.iterations)
+        self.iterations_input.valueChanged.connect(self.set_max_iterations)
+        options_layout.addWidget(self.iterations_input)
+        options_layout.addWidget(QLabel("Pyramid levels"))
+        self.pyramid_input = QSpinBox()
+        self.pyramid_input.setRange(0, 4)
+        self.pyramid_input.setValue(self.contour_params.pyramid_levels)
+        self.pyramid_input.setToolTip("Evolve on downsampled images first; max iterations then refine at full size")
+        self.pyramid_input.valueChanged.connect(self.set_pyramid_levels)
+        options_layout.addWidget(self.pyramid_input)
+        self.pyramid_iterations_input = QLineEdit(
+            ",".join(str(n) for n in self.contour_params.pyramid_iterations))
+        self.pyramid_iterations_input.setToolTip("Iterations per coarse level, coarsest first, e.g. 100,50")
+        self.pyramid_iterations_input.setFixedWidth(80)
+        self.pyramid_iterations_input.editingFinished.connect(self.set_pyramid_iterations)
+        options_layout.addWidget(self.pyramid_iterations_input)
+        options_layout.addWidget(QLabel("Preview"))
+        self.preview_selector = QComboBox()
+        self.preview_selector.addItems(list(display.PREVIEW_POLICIES))
+        self.preview_selector.currentTextChanged.connect(self.set_preview_policy)
+        options_layout.addWidget(self.preview_selector)
+        self.preview_n_input = QSpinBox()
+        self.preview_n_input.setRange(1, 10000)
+        self.preview_n_input.setToolTip("N of the \"Every N\" preview choices")
+        self.preview_n_input.setEnabled(False)
+        self.preview_n_input.valueChanged.connect(self.update_render_throttle)
+        options_layout.addWidget(self.preview_n_input)
+        options_layout.addWidget(QLabel("Edge filter"))
+        self.gradient_selector = QComboBox()
+        self.gradient_selector.addItems(list(utils.GRADIENT_METHODS))
+        self.gradient_selector.setToolTip("How g(I) is computed: exact, or faster approximations")
+        self.gradient_selector.currentTextChanged.connect(self.set_gradient_method)
+        options_layout.addWidget(self.gradient_selector)
+        self.profile_checkbox = QCheckBox("Profile")
+        self.profile_checkbox.setToolTip(f"Log stage timings and memory as JSON (also ${profiling.ENV_VAR}=1)")
+        self.profile_checkbox.setChecked(profiling.PROFILER.enabled)
+        self.profile_checkbox.toggled.connect(profiling.PROFILER.set_enabled)
+        options_layout.addWidget(self.profile_checkbox)
+        options_layout.addStretch()
+        main_layout.addLayout(options_layout)
+
         # secoond line show images
         display_layout = QHBoxLayout()
         self.original_label = QLabel("Original Image")
         self.original_label.setFixedSize(*SIZES["img_size"])
         self.original_label.setStyleSheet("background-color: lightgray;")
         self.original_label.setAlignment(Qt.AlignCenter)
-        self.original_label.mousePressEvent = self.select_point_on_image
+        self.original_label.mousePressEvent = self.press_on_image
+        # Dragging a key point of the last result re-segments around the edit.
+        self.original_label.mouseMoveEvent = self.drag_key_point
+        self.original_label.mouseReleaseEvent = self.release_key_point
 
         self.keypoints_label = QLabel("Keypoints Coordinates")
         self.keypoints_label.setFixedSize(*SIZES["coordinate_box_size"])
@@ -165,12 +295,16 @@ class ImageSegmentationApp(QMainWindow):
                                           QMessageBox.No | QMessageBox.Yes)
             if reply == QMessageBox.Yes:                        
                 self.init_para()
-                if file_path.endswith(('.jpg', '.png', '.bmp')):
-                    self.dim =2
-                    self.load_2d_image(file_path)
-                elif file_path.endswith(('.nii', '.nii.gz')):
-                    self.dim =2
-                    self.load_3d_image(file_path)
+                with profiling.stage("load", file=os.path.basename(file_path)) as record:
+                    if file_path.endswith(('.jpg', '.png', '.bmp')):
+                        self.dim =2
+                        self.load_2d_image(file_path)
+                    elif file_path.endswith(('.nii', '.nii.gz')):
+                        self.dim =2
+                        self.load_3d_image(file_path)
+                    record["shape"] = getattr(getattr(self, "image", None), "shape", None)
+                if profiling.PROFILER.enabled:
+                    self.statusBar().showMessage("Loaded: " + profiling.summary(record))
 
     def load_2d_image(self, file_path):
         """ Load a 2D medical image and preprocess it for display and interaction."""
@@ -190,64 +324,154 @@ class ImageSegmentationApp(QMainWindow):
             self.display_result = self.display_data.copy()
             self.gray = 0
 
-        self.result = np.expand_dims(self.image_data, axis=-1)
+        self.labels = LabelStore(self.image_data.shape[:2], 1)
+        self.slice_key_points = {}
+        self.image_serial += 1
+        self.segmentation_queue.cancel()
+        self.edge_maps.clear()
 
         self.current_slice = 0
         self.image_slider.setEnabled(False)
         self.result_slider.setEnabled(False)
-        self.update_display(self.display_data,self.original_label)
-        self.update_display(self.display_result,self.result_label)
+        self.volume_checkbox.setEnabled(False)
+        self.volume_checkbox.setChecked(False)
+        self.propagate_button.setEnabled(False)
+        # Both views start from the same image; big ones are shrunk once through a pyramid.
+        pyramid = display.MipPyramid(self.display_data)
+        self.update_display(pyramid,self.original_label)
+        self.update_display(pyramid,self.result_label)
 
     def load_3d_image(self, file_path):
         """ Load a 3D medical image and preprocess it for display and interaction."""
             
         self.dim =3
-        nii_img = nib.load(file_path)
-        self.image = nii_img.get_fdata()
-        self.image = utils.normalize(self.image)
+        self.nii_image = volume_io.load(file_path, random_access=self.lazy_checkbox.isChecked())
+        self.image = self.normalized_volume(self.nii_image)
         if len(self.image.shape)==3:
             self.gray = 1 
-            # print(self.image.shape) # (432, 104, 432)
-            
-            # self.image = np.transpose(self.image,(0,2,1))
-            self.image = np.transpose(self.image,(1,0,2))
-            self.image = np.flip(self.image, axis=0) 
-            # print(self.image.shape)
-
-            self.result = np.stack([self.image] * 3, axis=2)
-            self.image_data = cv2.cvtColor(self.image[:, :, self.current_slice], cv2.COLOR_GRAY2RGB)
-            self.display_data = cv2.cvtColor(self.image[:, :, self.current_slice], cv2.COLOR_GRAY2RGB)
-            self.display_result = self.display_data.copy()
+
+            self.labels = LabelStore(self.image.shape[:2], self.image.shape[2])
+            self.slice_key_points = {}
+            self.image_serial += 1
+            self.segmentation_queue.cancel()
+            self.slice_cache.clear()
+            self.edge_maps.clear()
+            self.image_data = self.display_data = None  # built when first used
             self.current_slice = 0
 
             self.image_slider.setEnabled(True)
             self.result_slider.setEnabled(True)
+            self.volume_checkbox.setEnabled(True)
+            self.propagate_button.setEnabled(True)
             self.image_slider.setMinimum(0)
             self.image_slider.setMaximum(self.image.shape[2] - 1)
             self.result_slider.setMinimum(0)
             self.result_slider.setMaximum(self.image.shape[2] - 1)
-            # self.update_display()
-            self.image_slider.valueChanged.connect(self.update_image_slice)
-            self.result_slider.valueChanged.connect(self.update_result_slice)
 
-            self.update_display(self.display_data,self.original_label)
-            self.update_display(self.display_result ,self.result_label)
+            self.show_cached_slice("image", self.current_slice, self.current_slice)
+            self.show_cached_slice("result", self.current_result_slice, self.current_result_slice)
+            self.set_warm_edge_maps(self.warm_checkbox.isChecked())
+
+    def normalized_volume(self, nii_img):
+        """The uint8 volume of `nii_img` in the selected intensity window, indexed [y, x, z]."""
+        dataobj = nii_img.dataobj
+        window = self.intensity_selector.currentText()
+        options = volume_io.INTENSITY_WINDOWS[window]
+        lazy = self.lazy_checkbox.isChecked() and len(dataobj.shape) == 3
+        with profiling.stage("normalize", window=window, lazy=lazy):
+            if lazy:
+                # Slices are read from disk and normalized on demand.
+                return volume_io.LazyVolume(dataobj, **options)
+            # Read and normalize a few slices at a time, never the whole volume in float64.
+            image = volume_io.normalize_volume(dataobj,
+                                               *volume_io.intensity_range(dataobj, **options))
+        if image.ndim == 3:
+            image = np.flip(np.transpose(image, (1, 0, 2)), axis=0)
+        return image
+
+    def set_intensity_window(self, name):
+        """Re-normalize the open volume with another intensity window; labels are kept."""
+        if self.dim != 3 or self.nii_image is None or len(self.image.shape) != 3:
+            return
+        self.image = self.normalized_volume(self.nii_image)
+        self.image_serial += 1
+        self.segmentation_queue.cancel()
+        self.slice_cache.clear()
+        self.edge_maps.clear()
+        self.update_image_slice(self.current_slice)
+        self.update_result_slice(self.current_result_slice)
+        self.set_warm_edge_maps(self.warm_checkbox.isChecked())
 
     def update_image_slice(self, value):
         """Update the display for the selected image slice."""
-        self.current_slice = value
-        self.image_data = cv2.cvtColor(self.image[:, :, self.current_slice], cv2.COLOR_GRAY2RGB)
-        self.display_data = cv2.cvtColor(self.image[:, :, self.current_slice], cv2.COLOR_GRAY2RGB)
+        previous, self.current_slice = self.current_slice, value
+        self.image_data = self.display_data = None  # built when first used
         self.image_slice_info.setText(f"slice: {self.current_slice + 1}/{self.image.shape[-1]}")
-        self.update_display(self.display_data,self.original_label)
+        self.show_cached_slice("image", self.current_slice, previous)
 
     def update_result_slice(self, value):
         """Update the result display for the selected slice index"""
 
-        self.current_result_slice = value
-        self.display_result =self.result[..., self.current_result_slice]
+        previous, self.current_result_slice = self.current_result_slice, value
         self.result_slice_info.setText(f"slice: {self.current_result_slice + 1}/{self.image.shape[-1]}")
-        self.update_display(self.display_result ,self.result_label)
+        self.show_cached_slice("result", self.current_result_slice, previous)
+
+    @property
+    def image_data(self):
+        """RGB version of the image slice on screen. For volumes it is built
+        from `image` when first used (seeds, segmentation, saving), not on
+        every slice change."""
+        if self._image_data is None and self.dim == 3 and self.image is not None:
+            self._image_data = self.slice_rgb(self.current_slice)
+        return self._image_data
+
+    @image_data.setter
+    def image_data(self, value):
+        self._image_data = value
+
+    @property
+    def display_data(self):
+        """RGB image the seeds are drawn over; `image_data` unless set."""
+        return self.image_data if self._display_data is None else self._display_data
+
+    @display_data.setter
+    def display_data(self, value):
+        self._display_data = value
+
+    def slice_view(self, view, z):
+        """Cache key and builder of the display-ready slice `z` of `view` ("image" or "result")."""
+        image, labels = self.image, self.labels
+        label = self.original_label if view == "image" else self.result_label
+        size = (label.width(), label.height())
+        version = labels.version(z) if view == "result" else 0
+        key = (self.image_serial, view, z, size, version)
+
+        def build():
+            gray = image[:, :, z]
+            if view == "result":
+                items = contours.colored(labels.contours(z), labels.colors)
+                q_image = display.wrap_qimage(display.contour_overlay(gray, items, *size))
+            else:
+                q_image = display.scaled_qimage(gray, *size)
+            return (q_image, gray.shape[:2]), q_image.byteCount()
+        return key, build
+
+    def show_cached_slice(self, view, z, previous):
+        """Show slice `z` of `view` from the slice cache, then prefetch the next
+        slices in the scroll direction."""
+        key, build = self.slice_view(view, z)
+        entry = self.slice_cache.get(key)
+        if entry is None:
+            entry, nbytes = build()
+            self.slice_cache.put(key, entry, nbytes)
+        q_image, (self.height, self.width) = entry
+        label = self.original_label if view == "image" else self.result_label
+        label.setPixmap(QPixmap.fromImage(q_image))
+
+        step = 1 if z >= previous else -1
+        ahead = [z + step * i for i in range(1, self.prefetch_slices + 1)]
+        self.prefetcher.schedule([self.slice_view(view, n) for n in ahead
+                                  if 0 <= n < self.image.shape[2]])
 
     def update_display(self,display_input,label):
         if display_input is not None:
@@ -262,23 +486,82 @@ class ImageSegmentationApp(QMainWindow):
             elif self.dim ==3 and self.gray ==1:
                self.display_image(display_input, label)
 
-    def display_image(self, img, label):
-        if len(img.shape) == 2:  # Grayscale image
-            self.height, self.width = img.shape
-            q_image = QImage(img.data.tobytes(), self.width, self.height, self.width, QImage.Format_Grayscale8)
-        else:  # RGB image
-            self.height, self.width, _ = img.shape
-            # img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            q_image = QImage(img.data.tobytes(), self.width, self.height, 3 * self.width, QImage.Format_RGB888)
-        
-        pixmap = QPixmap.fromImage(q_image)
-        label.setPixmap(pixmap.scaled(label.size(), Qt.KeepAspectRatio))
+    def display_image(self, img, label, shape=None):
+        """Show a uint8 gray or RGB array (or display.MipPyramid) scaled to fit `label`.
+
+        `shape` is the size of the image shown when `img` is already scaled
+        to the view, as result overlays are.
+        """
+        self.height, self.width = img.shape[:2] if shape is None else shape[:2]
+        q_image = display.scaled_qimage(img, int(label.width()), int(label.height()))
+        label.setPixmap(QPixmap.fromImage(q_image))
 
 
     def update_mode(self, mode):
         """ Update the mode based on the selection (Point or rectangle) """
         self.selected_mode = mode
 
+    def set_narrow_band(self, checked):
+        """Only evolve the tiles around the contour"""
+        self.contour_params.narrow_band = checked
+
+    def set_max_iterations(self, value):
+        """Cap the number of iterations; runs stop earlier once converged"""
+        self.contour_params.iterations = value
+
+    def set_pyramid_levels(self, value):
+        """Number of coarse levels run before the full-size iterations"""
+        self.contour_params.pyramid_levels = value
+
+    def set_pyramid_iterations(self):
+        """Parse the comma-separated iteration counts of the coarse levels"""
+        try:
+            counts = tuple(int(n) for n in self.pyramid_iterations_input.text().split(",") if n.strip())
+            if not counts or min(counts) < 1:
+                raise ValueError
+        except ValueError:
+            QMessageBox.warning(self, "Error", "Enter positive iteration counts, e.g. 100,50.")
+            self.pyramid_iterations_input.setText(
+                ",".join(str(n) for n in self.contour_params.pyramid_iterations))
+            return
+        self.contour_params.pyramid_iterations = counts
+
+    def set_warm_edge_maps(self, checked):
+        """Start or stop computing g(I) of every slice of the volume in the background."""
+        if not checked or self.dim != 3:
+            self.edge_maps.stop_warming()
+            return
+        image, serial, params = self.image, self.image_serial, self.contour_params
+        items = [((serial, z), lambda z=z: engine.to_unit(image[:, :, z], params.dtype))
+                 for z in range(image.shape[2])]
+        self.edge_maps.warm(items, params.alpha, params.sigma, params.gradient_method,
+                            params.dtype)
+
+    def set_gradient_method(self, method):
+        """Select the filter computing g(I)"""
+        self.contour_params.gradient_method = method
+        self.set_warm_edge_maps(self.warm_checkbox.isChecked())
+
+    def set_preview_policy(self, name):
+        """Choose how often intermediate contours are drawn during a run"""
+        options = display.PREVIEW_POLICIES[name]
+        setting = display.PREVIEW_N.get(options["policy"])
+        self.preview_n_input.setEnabled(setting is not None)
+        if setting is not None:
+            self.preview_n_input.blockSignals(True)
+            self.preview_n_input.setSuffix(" ms" if setting == "interval_ms" else " iterations")
+            self.preview_n_input.setValue(options[setting])
+            self.preview_n_input.blockSignals(False)
+        self.update_render_throttle()
+
+    def update_render_throttle(self):
+        """Preview policy of the next runs, with N from its spin box."""
+        options = dict(display.PREVIEW_POLICIES[self.preview_selector.currentText()])
+        setting = display.PREVIEW_N.get(options["policy"])
+        if setting is not None:
+            options[setting] = self.preview_n_input.value()
+        self.render_throttle = display.RenderThrottle(**options)
+
     def select_color(self, color_name):
         """Update the contour color based on the user's selected choice"""
         color_map = {
@@ -320,23 +603,9 @@ class ImageSegmentationApp(QMainWindow):
             # return
         if self.current_key_point < int(self.keypoint_input.text()):
 
-            x = event.pos().x()
-            y = event.pos().y()
-            x_ratio = self.original_label.width()/self.width
-            y_ratio = self.original_label.height()/self.height
-            scale = min(x_ratio, y_ratio)
-            self.scale = scale
-
-            self.scaled_width = int(self.width * scale)
-            self.scaled_height = int(self.height* scale)
-
-            offset_x = (self.original_label.width()-self.scaled_width)//2
-            offset_y = (self.original_label.height()-self.scaled_height)//2
-
-            if offset_x <= x <= offset_x + self.scaled_width and offset_y <= y <= offset_y + self.scaled_height:
-                image_x = int((x - offset_x) / scale)
-                image_y = int((y - offset_y) / scale)
-                self.key_points.append((image_x, image_y))
+            position = self.image_position(event.pos())
+            if position is not None:
+                self.key_points.append(position)
                 self.update_keypoints_display()   
                 self.current_key_point += 1
                 if self.current_key_point == int(self.keypoint_input.text()):
@@ -352,6 +621,68 @@ class ImageSegmentationApp(QMainWindow):
             QMessageBox.information(self, "Selection Complete", "You have already selected all key points.")
 
 
+    def image_position(self, pos):
+        """Image (x, y) of a point of the original view, or None outside the image."""
+        x = pos.x()
+        y = pos.y()
+        x_ratio = self.original_label.width()/self.width
+        y_ratio = self.original_label.height()/self.height
+        scale = min(x_ratio, y_ratio)
+        self.scale = scale
+
+        self.scaled_width = int(self.width * scale)
+        self.scaled_height = int(self.height* scale)
+
+        offset_x = (self.original_label.width()-self.scaled_width)//2
+        offset_y = (self.original_label.height()-self.scaled_height)//2
+
+        if offset_x <= x <= offset_x + self.scaled_width and offset_y <= y <= offset_y + self.scaled_height:
+            return int((x - offset_x) / scale), int((y - offset_y) / scale)
+        return None
+
+    def press_on_image(self, event: QMouseEvent):
+        """Start dragging a key point of the last result, or select a new key point."""
+        seed = self.editable_seed
+        if seed is not None and seed[0] == self.current_slice and self.key_points == seed[2]:
+            position = self.image_position(event.pos())
+            if position is not None:
+                # Grab within 8 screen pixels.
+                reach = 8 / self.scale
+                for i, (x, y) in enumerate(self.key_points):
+                    if abs(x - position[0]) <= reach and abs(y - position[1]) <= reach:
+                        self.drag_index = i
+                        return
+        self.select_point_on_image(event)
+
+    def drag_key_point(self, event: QMouseEvent):
+        """Move the grabbed key point and redraw the seed."""
+        if self.drag_index is None:
+            return
+        position = self.image_position(event.pos())
+        if position is None:
+            return
+        self.key_points[self.drag_index] = position
+        if len(self.key_points) == 2 and self.selected_mode in ("rectangle", "ellipse"):
+            self.update_area_display()
+        else:
+            self.update_keypoints_display()
+
+    def release_key_point(self, event: QMouseEvent):
+        """Re-segment around the moved key point, from the previous result."""
+        if self.drag_index is None:
+            return
+        self.drag_key_point(event)
+        self.drag_index = None
+        z, mode, old_key_points, color = self.editable_seed
+        if self.key_points == old_key_points:
+            return
+        slice_data = cv2.cvtColor(self.image_data, cv2.COLOR_RGB2GRAY)
+        job = RefineJob(slice_data, mode, self.key_points, self.labels.mask(z, color),
+                        old_key_points, self.contour_params, slice_index=z, color=color,
+                        throttle=self.render_throttle, edge_cache=self.edge_maps,
+                        cache_key=(self.image_serial, z), image_serial=self.image_serial)
+        self.segmentation_queue.submit(job)
+
     def update_area_display(self):
         """Update the display of key area"""
         masked = self.display_data.copy()
@@ -387,111 +718,305 @@ class ImageSegmentationApp(QMainWindow):
 
 
 
-    def visual_result(self,levelset):
-        self.display_result = self.result[..., self.current_slice]
-
-        self.display_image(self.display_result, self.result_label) 
-
-        edge_overlay = self.display_result.copy()
-        if levelset is None or levelset.size == 0:
-            print("Received invalid levelset.")
-            return
-        # Update the edge overlay
+    def draw_edges(self, rgb, levelset, color=None):
+        """Return a copy of `rgb` with the level set boundary in `color` (default: the selected color)."""
+        edge_overlay = rgb.copy()
         edges =levelset > 0.5
         # edges = ndi.binary_dilation(edges)
         edges = edges ^ ndi.binary_erosion(edges)
         # Highlight the edges in red
         # edge_overlay[edges] = [255, 0, 0]
-        edge_overlay[edges] = self.selected_color
-        # Update the QLabel display
-        self.display_image(edge_overlay, self.result_label)
-
-        QApplication.processEvents()  # Ensure the GUI updates immediately
+        edge_overlay[edges] = self.selected_color if color is None else color
+        return edge_overlay
 
+    def visual_result(self,levelset, color=None):
+        """Show the contour of an evolving level set over the current result slice."""
+        if levelset is None or levelset.size == 0:
+            print("Received invalid levelset.")
+            return
+        if levelset.ndim == 3:
+            levelset = levelset[..., self.current_slice]
+        color = self.selected_color if color is None else color
+        preview = contours.extract(levelset > 0.5).get(1, [])
+        edge_overlay = self.result_overlay(self.current_slice, [(preview, color)])
+        # Update the QLabel display
+        self.display_image(edge_overlay, self.result_label, shape=levelset.shape)
         return edge_overlay
 
+    def result_overlay(self, z, extra=()):
+        """Result slice `z` at the size of the result view, with the contours
+        of its labels and the (polygons, color) pairs `extra` drawn as polylines."""
+        items = contours.colored(self.labels.contours(z), self.labels.colors) + list(extra)
+        return display.contour_overlay(self.slice_rgb(z), items,
+                                       int(self.result_label.width()),
+                                       int(self.result_label.height()))
+
     def morphological_geodesic_active_contour(self,gimage, iterations,
                                             init_level_set, smoothing=1,
                                             threshold=0.5, balloon=0):
+        """Run the engine MGAC and show intermediate level sets as the preview policy allows.
 
+        This runs on the GUI thread, so events are processed after each
+        preview to repaint it; queued jobs are previewed by
+        on_segmentation_progress instead, which must not re-enter the event loop.
+        """
+        def preview(levelset):
+            self.visual_result(levelset)
+            QApplication.processEvents()
 
-        image = gimage
-        init_level_set = init_level_set
-        utils._check_input(image, init_level_set)
-
-        structure = np.ones((3,) * len(image.shape), dtype=np.int8)
-        dimage = np.gradient(image)
-        # threshold_mask = image > threshold
-        if balloon != 0:
-            threshold_mask_balloon = image > threshold / np.abs(balloon)
-        u = np.int8(init_level_set > 0)
-        self.visual_result(u)
-        for _ in range(iterations):
-            # Balloon
-            if balloon > 0:
-                aux = ndi.binary_dilation(u, structure)
-            elif balloon < 0:
-                aux = ndi.binary_erosion(u, structure)
-            if balloon != 0:
-                u[threshold_mask_balloon] = aux[threshold_mask_balloon]
-
-            # Image attachment
-            aux = np.zeros_like(image)
-            du = np.gradient(u)
-            for el1, el2 in zip(dimage, du):
-                aux += el1 * el2
-            u[aux > 0] = 1
-            u[aux < 0] = 0
-            # Smoothing
-            for _ in range(smoothing):
-                u = utils._curvop(u)
-
-            self.visual_result(u)
-        return u
+        return engine.morphological_geodesic_active_contour(
+            gimage, iterations, init_level_set, smoothing=smoothing,
+            threshold=threshold, balloon=balloon,
+            iter_callback=self.render_throttle.wrap(preview))
 
 
-    def medcontour(self):
+    def add_region(self):
+        """Keep the current seed for a joint run of several regions."""
         if not self.key_points:
+            QMessageBox.warning(self, "Error", "Please select keypoints before adding a region.")
+            return
+        self.regions.append((self.selected_mode, list(self.key_points), self.selected_color))
+        self.key_points = []
+        self.current_key_point = 0
+        self.is_keypoint_active = True
+        self.update_pyramid_controls()
+        self.statusBar().showMessage(
+            f"{len(self.regions)} regions added (regions are segmented at full size, without the pyramid)")
+
+    def update_pyramid_controls(self):
+        """Grey out the pyramid options while regions are queued, which
+        segment_regions evolves at full size only."""
+        for widget in (self.pyramid_input, self.pyramid_iterations_input):
+            widget.setEnabled(not self.regions)
+
+    def volume_key_points(self):
+        """Lift the key points clicked on the current slice to a 3D seed.
+
+        A rectangle/ellipse gets a depth of half its smaller side around the
+        current slice; points keep their in-plane geometry.
+        """
+        z = self.current_slice
+        if len(self.key_points) == 2 and self.selected_mode in ("rectangle", "ellipse"):
+            [(x1, y1), (x2, y2)] = self.key_points
+            depth = min(abs(x2 - x1), abs(y2 - y1)) // 2
+            return [(x1, y1, z - depth), (x2, y2, z + depth)]
+        return [(x, y, z) for x, y in self.key_points]
+
+    def medcontour(self):
+        """Queue a segmentation of the current slice (or volume) in the background."""
+        if not self.key_points and not self.regions:
             QMessageBox.warning(self, "Error", "Please select keypoints before edge detection.")
             return
-        if self.image_data is not None:
-            slice_data = cv2.cvtColor(self.image_data.copy(), cv2.COLOR_RGB2GRAY) 
-            img = slice_data/255.0
-            # g(I)
-            gimg = utils.inverse_gaussian_gradient(img, alpha=1000, sigma=5.48)
-            # Initialization of the level-set and threshold.
-            init_ls,mean_roi = utils.generate_Initial_mask(img, self.selected_mode, self.key_points)
-
-            mask = self.morphological_geodesic_active_contour(gimg, iterations=10,
-                                                    init_level_set=init_ls,
-                                                    smoothing=2, threshold=0.8*mean_roi,
-                                                    balloon=-1)  
-
-            edge_overlay = self.visual_result(mask)
-            self.display_result = cv2.addWeighted(self.display_data, 1, edge_overlay, 0.5, 0)
-            self.result[..., self.current_slice] = self.display_result
+        if self.regions and self.image_data is not None:
+            regions = list(self.regions)
+            if self.key_points:
+                regions.append((self.selected_mode, list(self.key_points), self.selected_color))
+            slice_data = cv2.cvtColor(self.image_data, cv2.COLOR_RGB2GRAY)
+            job = RegionsJob(slice_data, regions, self.contour_params,
+                             slice_index=self.current_slice, throttle=self.render_throttle,
+                             edge_cache=self.edge_maps,
+                             cache_key=(self.image_serial, self.current_slice),
+                             image_serial=self.image_serial)
+            self.regions = []
+            self.update_pyramid_controls()
+        elif self.dim == 3 and self.volume_checkbox.isChecked():
+            job = SegmentationJob(self.image, self.selected_mode, self.volume_key_points(),
+                                  self.contour_params, slice_index=self.current_slice,
+                                  color=self.selected_color, volume=True,
+                                  throttle=self.render_throttle, edge_cache=self.edge_maps,
+                                  cache_key=(self.image_serial, "volume"),
+                                  image_serial=self.image_serial)
+        elif self.image_data is not None:
+            slice_data = cv2.cvtColor(self.image_data, cv2.COLOR_RGB2GRAY) 
+            job = SegmentationJob(slice_data, self.selected_mode, self.key_points,
+                                  self.contour_params, slice_index=self.current_slice,
+                                  color=self.selected_color,
+                                  throttle=self.render_throttle, edge_cache=self.edge_maps,
+                                  cache_key=(self.image_serial, self.current_slice),
+                                  image_serial=self.image_serial)
+        else:
+            return
+        if self.segmentation_queue.busy:
+            self.statusBar().showMessage(
+                f"Segmentation queued ({len(self.segmentation_queue.pending) + 1} waiting)")
+        self.segmentation_queue.submit(job)
+
+    def propagate_volume(self):
+        """Use the current slice's mask to segment its neighbours through the volume."""
+        seed_mask = self.labels.mask(self.current_slice, self.selected_color) if self.dim == 3 else None
+        if seed_mask is None or not seed_mask.any():
+            QMessageBox.warning(self, "Error", "Segment the current slice in the selected color before propagating it.")
+            return
+        job = PropagationJob(self.image, seed_mask,
+                             self.contour_params, slice_index=self.current_slice,
+                             color=self.selected_color, edge_cache=self.edge_maps,
+                             cache_key=self.image_serial, image_serial=self.image_serial)
+        self.segmentation_queue.submit(job)
+
+    def cancel_segmentation(self):
+        """Stop the running segmentation and drop the queued ones."""
+        self.segmentation_queue.cancel()
+
+    def on_segmentation_progress(self, job, levelset):
+        """Preview an intermediate contour (of a volume, the job's slice) if its
+        slice is on screen."""
+        if job.image_serial != self.image_serial or job.slice_index != self.current_slice:
+            return
+        start = time.perf_counter()
+        if isinstance(job, RegionsJob):
+            preview = contours.colored(contours.extract(levelset), job.colors)
+            overlay = self.result_overlay(self.current_slice, preview)
+            self.display_image(overlay, self.result_label, shape=levelset.shape)
+        else:
+            self.visual_result(levelset, job.color)
+        self.render_seconds += time.perf_counter() - start
+        self.render_count += 1
+
+    def log_render_time(self, job):
+        """Log the preview rendering time of a finished job."""
+        profiling.PROFILER.record("render", seconds=self.render_seconds,
+                                  renders=self.render_count, slice=job.slice_index)
+        self.render_seconds, self.render_count = 0.0, 0
+
+    def on_segmentation_finished(self, job, result):
+        """Store the final contour in the label maps."""
+        self.log_render_time(job)
+        if job.image_serial != self.image_serial:
+            return  # queued for an image that has been replaced since
+        if result.stop_reason == "cancelled":
+            self.statusBar().showMessage("Segmentation cancelled")
+            return
+        if isinstance(job, RegionsJob):
+            for label, color in job.colors.items():
+                self.labels.add_mask(job.slice_index, result.mask == label, color)
+            self.slice_key_points[job.slice_index] = [
+                point for _, key_points, _ in job.regions for point in key_points]
+        elif isinstance(job, RefineJob):
+            self.labels.set_mask(job.slice_index, result.mask, job.color)
+        elif job.volume:
+            for z in np.flatnonzero(result.mask.any(axis=(0, 1))):
+                if isinstance(job, PropagationJob) and z == job.slice_index:
+                    continue  # the seed slice already shows its contour
+                self.labels.add_mask(z, result.mask[..., z], job.color)
+        else:
+            self.labels.add_mask(job.slice_index, result.mask, job.color)
+        if isinstance(job, (SegmentationJob, RefineJob)):
+            self.slice_key_points[job.slice_index] = [tuple(p[:2]) for p in job.key_points]
+            if not job.volume:
+                self.editable_seed = (job.slice_index, job.mode, list(job.key_points), job.color)
+        self.display_image(self.result_overlay(self.current_slice), self.result_label,
+                           shape=self.labels.shape)
+        self.show_run_summary(result)
+
+    def on_segmentation_failed(self, job, message):
+        self.log_render_time(job)
+        QMessageBox.warning(self, "Error", f"Segmentation failed: {message}")
+
+    def slice_rgb(self, z):
+        """RGB version of image slice `z`."""
+        if self.dim == 3:
+            return cv2.cvtColor(self.image[:, :, z], cv2.COLOR_GRAY2RGB)
+        return self.image_data
+
+    def compose_result(self, z):
+        """Result slice `z`: the image with the contours of its labels."""
+        return self.labels.compose(z, self.slice_rgb(z))
+
+    def show_run_summary(self, result):
+        """Report how many iterations ran and why the contour stopped."""
+        if isinstance(result, PropagationResult):
+            message = f"Propagated to {len(result.slices)} slices in {result.iterations} iterations ({result.stop_reason})"
+        else:
+            message = f"Stopped after {result.iterations} iterations ({result.stop_reason.replace('_', ' ')})"
+        record = profiling.PROFILER.last("segmentation") if profiling.PROFILER.enabled else None
+        if record is not None:
+            message += " | " + profiling.summary(record)
+        self.statusBar().showMessage(message)
+
+    def closeEvent(self, event):
+        self.segmentation_queue.cancel()
+        self.segmentation_queue.wait()
+        self.label_saver.wait()  # never leave a half-written file
+        self.prefetcher.close()
+        self.edge_maps.stop_warming()
+        super().closeEvent(event)
 
     def save_result(self):
         # Pop up a dialog box to let the user select a save option
         response, ok = QInputDialog.getItem(
-            self, "Save Options", "Choose an option:", ["Save current slice", "Save all slices"], 0, False
+            self, "Save Options", "Choose an option:",
+            ["Save current slice", "Save all slices", "Save label volume", "Export contours"], 0, False
         )
-        file_path, _ = QFileDialog.getSaveFileName(self, "Save Result", "", "NIfTI Files (*.nii);;Images (*.jpg *.png)")
+        file_path, _ = QFileDialog.getSaveFileName(self, "Save Result", "", "NIfTI Files (*.nii *.nii.gz);;Images (*.jpg *.png);;Contours (*.json *.csv)")
         if not file_path:
             return
         
         if ok:
-            if response == "Save current slice":
-                # self.save_image(self.result[:, :, :, self.current_slice], f"slice_{self.current_slice}.nii")
-                image_data = self.result[:, :, :, self.current_slice]
-                cv2.imwrite(file_path, cv2.cvtColor(image_data, cv2.COLOR_RGB2BGR))  # 转换为 BGR 格式，OpenCV 使用 BGR
-                QMessageBox.information(self, "Save", f"Image saved as {file_path}")            
-            elif response == "Save all slices":
-                nii_image = nib.Nifti1Image(self.result, affine=np.eye(4))
-                nib.save(nii_image, file_path)
-                QMessageBox.information(self, "Save", f"Image saved as {file_path}")
-
-
+            if response == "Save label volume":
+                self.save_label_volume(file_path)
+                return
+            if response == "Export contours":
+                self.export_contours(file_path)
+                return
+            with profiling.stage("save", option=response, file=os.path.basename(file_path)):
+                if response == "Save current slice":
+                    image_data = self.compose_result(self.current_slice)
+                    cv2.imwrite(file_path, cv2.cvtColor(image_data, cv2.COLOR_RGB2BGR))  # 转换为 BGR 格式，OpenCV 使用 BGR
+                elif response == "Save all slices":
+                    overlays = np.stack([self.compose_result(z) for z in range(self.labels.depth)], axis=-1)
+                    nii_image = nib.Nifti1Image(overlays, affine=np.eye(4))
+                    nib.save(nii_image, file_path)
+            QMessageBox.information(self, "Save", f"Image saved as {file_path}")
+
+    def export_contours(self, file_path):
+        """Write the vector contours and key points of every labelled slice
+        to a JSON file, or a CSV file if `file_path` ends with .csv."""
+        epsilon, ok = QInputDialog.getDouble(self, "Export contours",
+                                             "Simplify (max. deviation in pixels, 0 = exact):",
+                                             0.0, 0.0, 10.0, 1)
+        if not ok:
+            return
+        with profiling.stage("save", option="Export contours", file=os.path.basename(file_path)):
+            slices = {z: self.labels.contours(z, epsilon) for z in self.labels.labelled_slices()}
+            if file_path.lower().endswith(".csv"):
+                contours.export_csv(file_path, slices, self.slice_key_points)
+            else:
+                contours.export_json(file_path, slices, self.labels.colors, self.slice_key_points)
+        QMessageBox.information(self, "Save", f"Contours saved as {file_path}")
+
+    def save_label_volume(self, file_path):
+        """Write the labels as a uint8 NIfTI volume in the background.
+
+        The open volume's header and affine are kept. Uncompressed files
+        saved before only get the slices changed since rewritten.
+        """
+        if not file_path.endswith((".nii", ".nii.gz")):
+            file_path += ".nii.gz"
+        level = 6
+        if file_path.endswith(".gz"):
+            level, ok = QInputDialog.getInt(self, "Compression", "gzip level (1 fastest, 9 smallest):",
+                                            level, 1, 9)
+            if not ok:
+                return
+        since = None
+        if self.last_label_save is not None:
+            path, store, counter = self.last_label_save
+            if path == file_path and store is self.labels:
+                since = counter
+        reference = self.nii_image if self.dim == 3 else None
+        self.label_saver.submit(SaveJob(self.labels, file_path, reference,
+                                        compresslevel=level, since=since))
+        self.statusBar().showMessage(f"Saving labels to {file_path}")
+
+    def on_save_progress(self, job, done, total):
+        self.statusBar().showMessage(f"Saving labels to {job.path}: {done}/{total} slices")
+
+    def on_save_finished(self, job, slices):
+        self.last_label_save = (job.path, job.source, job.labels.counter)
+        self.statusBar().showMessage(f"Labels saved to {job.path} ({len(slices)} slices written)")
+
+    def on_save_failed(self, job, message):
+        QMessageBox.warning(self, "Error", f"Saving {job.path} failed: {message}")
 
 if __name__ == "__main__":
     app = QApplication([])
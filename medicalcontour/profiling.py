@@ -0,0 +1,157 @@
+"""Per-stage timing and memory instrumentation.
+
+Off by default. Set MEDCONTOUR_PROFILE=1 to record the wall time and peak
+traced allocations of every stage (loading, normalization, g(I), seed
+masks, iterations, rendering, saving), or MEDCONTOUR_PROFILE=time to skip
+the memory tracing, which slows allocation-heavy code down. Records are
+written as JSON lines to the file named by MEDCONTOUR_PROFILE_LOG, or to
+stderr. The window can also switch it on.
+"""
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+
+ENV_VAR = "MEDCONTOUR_PROFILE"
+LOG_ENV_VAR = "MEDCONTOUR_PROFILE_LOG"
+
+
+class _OpenStage(object):
+    __slots__ = ("record", "start", "start_bytes", "peak")
+
+
+class Profiler(object):
+    """Records stages as dicts: "stage", "seconds", "peak_bytes" (None
+    without memory tracing), the stage's own fields, and "stages", the
+    seconds spent in stages nested in it on the same thread.
+
+    Peak allocations are those made while the stage was open, including by
+    stages running at the same time on other threads.
+    """
+
+    def __init__(self, enabled=False, memory=True, log_path=None, history=1000):
+        self.enabled = False
+        self.memory = False
+        self.log_path = log_path
+        self.records = deque(maxlen=history)
+        self._tracing = False  # whether tracemalloc was started here
+        self._lock = threading.Lock()
+        self._open = []  # open stages of every thread
+        self._local = threading.local()  # open stages of this thread
+        self.set_enabled(enabled, memory)
+
+    @classmethod
+    def from_env(cls, environ=os.environ):
+        value = environ.get(ENV_VAR, "").strip().lower()
+        enabled = value not in ("", "0", "off", "false", "no")
+        return cls(enabled=enabled, memory=value != "time", log_path=environ.get(LOG_ENV_VAR))
+
+    def set_enabled(self, enabled, memory=None):
+        """Switch recording on or off; `memory` also traces allocations."""
+        if memory is None:
+            memory = self.memory
+        with self._lock:
+            if enabled and memory and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._tracing = True
+            elif not (enabled and memory) and self._tracing:
+                tracemalloc.stop()
+                self._tracing = False
+            self.enabled = bool(enabled)
+            self.memory = bool(enabled and memory)
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """Time the block as stage `name`. Yields the record, so the block
+        can add fields such as an iteration count."""
+        record = dict(stage=name, **fields)
+        if not self.enabled:
+            yield record
+            return
+        stage = _OpenStage()
+        stage.record = record
+        record["stages"] = {}
+        with self._lock:
+            if self.memory:
+                current, peak = tracemalloc.get_traced_memory()
+                self._raise_peaks(peak)
+                tracemalloc.reset_peak()
+                stage.start_bytes = stage.peak = current
+            self._open.append(stage)
+        stack = self._stack()
+        stack.append(stage)
+        stage.start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - stage.start
+            stack.pop()
+            with self._lock:
+                self._open.remove(stage)
+                if self.memory and tracemalloc.is_tracing() and hasattr(stage, "peak"):
+                    self._raise_peaks(tracemalloc.get_traced_memory()[1], stage)
+                    record["peak_bytes"] = stage.peak - stage.start_bytes
+                else:
+                    record["peak_bytes"] = None
+            record["seconds"] = seconds
+            if stack:
+                parent = stack[-1].record["stages"]
+                parent[name] = parent.get(name, 0.0) + seconds
+            self._emit(record)
+
+    def record(self, name, **fields):
+        """Log a record measured by the caller (e.g. accumulated render time)."""
+        if self.enabled:
+            self._emit(dict(stage=name, **fields))
+
+    def last(self, name):
+        """The most recent record of stage `name`, or None."""
+        for record in reversed(self.records):
+            if record["stage"] == name:
+                return record
+        return None
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _raise_peaks(self, peak, stage=None):
+        for open_stage in self._open + ([stage] if stage is not None else []):
+            if hasattr(open_stage, "peak"):
+                open_stage.peak = max(open_stage.peak, peak)
+
+    def _emit(self, record):
+        record["time"] = time.time()
+        record["thread"] = threading.current_thread().name
+        self.records.append(record)
+        line = json.dumps(record, default=str)
+        with self._lock:
+            if self.log_path:
+                with open(self.log_path, "a") as f:
+                    f.write(line + "\n")
+            else:
+                sys.stderr.write(line + "\n")
+
+
+def summary(record):
+    """Short readout of a record and its nested stages, for a status bar."""
+    parts = [f"{name} {seconds:.2f} s" for name, seconds in record.get("stages", {}).items()]
+    parts.append(f"total {record['seconds']:.2f} s")
+    if record.get("peak_bytes") is not None:
+        parts.append(f"peak {record['peak_bytes'] / 2 ** 20:.0f} MB")
+    return ", ".join(parts)
+
+
+# Shared by the engine, the workers and the window.
+PROFILER = Profiler.from_env()
+
+
+def stage(name, **fields):
+    """`PROFILER.stage`."""
+    return PROFILER.stage(name, **fields)
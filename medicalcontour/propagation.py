@@ -0,0 +1,283 @@
+"""Propagate a slice segmentation through a whole volume.
+
+The final mask of a seeded slice becomes the initial level set of its
+neighbours, walking up and down the z axis until the structure disappears.
+The edge maps g(I) are computed a slab at a time just ahead of each walk, so
+a structure spanning a few slices of a deep volume only pays for those, and
+they are taken from (and added to) the window's EdgeMapCache when one is
+given. Work is spread over a process pool: the upward and downward walks run
+side by side while the other workers prepare the next slabs. Volume, edge
+maps and masks live in shared memory so that the workers never pickle full
+arrays.
+"""
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, List, Optional
+
+import numpy as np
+
+from medicalcontour import engine
+from medicalcontour import profiling
+
+
+@dataclass
+class PropagationResult:
+    """Masks of every segmented slice, indexed [y, x, z] like the volume."""
+    mask: np.ndarray
+    slices: List[int] = field(default_factory=list)
+    iterations: int = 0
+    stop_reason: str = "completed"  # or "cancelled"
+
+
+def _call_shared(fn, specs, *args):
+    """Call `fn` with the shared arrays described by `specs`, then `args`.
+
+    The arrays only live in `fn`'s frame, so the segments can be closed as
+    soon as it returns.
+    """
+    shms = [SharedMemory(name=name) for name, _, _ in specs]
+    try:
+        return fn(*[np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+                    for shm, (_, shape, dtype) in zip(shms, specs)], *args)
+    finally:
+        for shm in shms:
+            try:
+                shm.close()
+            except BufferError:
+                # A traceback still references the arrays; the OS releases
+                # the mapping with the process.
+                pass
+
+
+def _edge_maps(volume, gvolume, zs, alpha, sigma, method="exact", dtype="float32"):
+    """Fill g(I) for the slices `zs`."""
+    with profiling.stage("edge_maps", slices=(min(zs), max(zs) + 1), method=method):
+        for z in zs:
+            gvolume[..., z] = engine.inverse_gaussian_gradient(
+                engine.to_unit(volume[..., z], dtype), alpha=alpha, sigma=sigma,
+                method=method, dtype=dtype)
+
+
+def _walk(volume, edge_map, masks, seed_mask, zs, params, min_area, should_stop):
+    """Segment the slices `zs` in order, each seeded by the previous mask.
+
+    `edge_map(z)` returns g(I) of slice z and its gradient (or None). Stops
+    when a mask has fewer than `min_area` pixels. Returns the slices
+    segmented, the total number of iterations and whether it was cancelled.
+    """
+    done, iterations = [], 0
+    previous = seed_mask
+    for z in zs:
+        if should_stop():
+            return done, iterations, True
+        gimage, gradient = edge_map(z)
+        img = engine.to_unit(volume[..., z], params.dtype)
+        roi = img[previous]
+        mean_roi = float(np.mean(roi)) if roi.size > 0 else 0.0
+        with profiling.stage("evolve", slice=z) as record:
+            result = engine.evolve(gimage, previous, params.threshold_ratio * mean_roi,
+                                   params, gradient=gradient)
+            record["iterations"] = result.iterations
+        iterations += result.iterations
+        current = result.mask > 0
+        if np.count_nonzero(current) < min_area:
+            break
+        masks[..., z] = current
+        done.append(z)
+        previous = current
+    return done, iterations, False
+
+
+def _walk_shared(volume, gvolume, masks, control, seed_mask, zs, params, min_area):
+    return _walk(volume, lambda z: (gvolume[..., z], None), masks, seed_mask, zs, params,
+                 min_area, lambda: bool(control[0]))
+
+
+def _cached_edge_map(volume, params, edge_cache, cache_key):
+    """`edge_map` for `_walk` in this process, through `edge_cache` if given."""
+    def edge_map(z):
+        img = lambda: engine.to_unit(volume[..., z], params.dtype)
+        if edge_cache is not None:
+            return edge_cache.edge_map((cache_key, z), img, params.alpha, params.sigma,
+                                       params.gradient_method, params.dtype)
+        with profiling.stage("edge_maps", slices=(z, z + 1), method=params.gradient_method):
+            return engine.inverse_gaussian_gradient(img(), alpha=params.alpha,
+                                                    sigma=params.sigma,
+                                                    method=params.gradient_method,
+                                                    dtype=params.dtype), None
+    return edge_map
+
+
+def propagate_volume(volume: np.ndarray, seed_index: int, seed_mask: np.ndarray,
+                     params: Optional[engine.ContourParams] = None,
+                     workers: Optional[int] = None, min_area: int = 20,
+                     should_stop: Optional[Callable[[], bool]] = None,
+                     edge_cache: Optional[engine.EdgeMapCache] = None,
+                     cache_key=None) -> PropagationResult:
+    """Propagate `seed_mask` of slice `seed_index` through a uint8 volume.
+
+    `workers` is the number of processes (default: one per CPU); with one
+    worker everything runs in the calling process. Edge maps are kept in
+    the compute dtype of `params`. With an `edge_cache`, g(I) of slice z is
+    looked up and stored under (`cache_key`, z), as the window keys slices.
+    """
+    if params is None:
+        params = engine.ContourParams()
+    if should_stop is None:
+        should_stop = lambda: False
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if cache_key is None:
+        edge_cache = None
+    volume = np.asarray(volume)
+    if volume.ndim != 3:
+        raise ValueError("`volume` must be a 3-dimensional array.")
+    depth = volume.shape[2]
+    seed_mask = np.asarray(seed_mask) > 0
+    up = list(range(seed_index + 1, depth))
+    down = list(range(seed_index - 1, -1, -1))
+
+    if workers <= 1:
+        masks = np.zeros(volume.shape, dtype=bool)
+        masks[..., seed_index] = seed_mask
+        edge_map = _cached_edge_map(volume, params, edge_cache, cache_key)
+        slices, iterations, cancelled = [seed_index], 0, False
+        for zs in (up, down):
+            done, n, cancelled = _walk(volume, edge_map, masks, seed_mask, zs, params,
+                                       min_area, should_stop)
+            slices += done
+            iterations += n
+            if cancelled:
+                break
+        return PropagationResult(mask=masks, slices=sorted(slices), iterations=iterations,
+                                 stop_reason="cancelled" if cancelled else "completed")
+
+    dtypes = (np.uint8, engine.compute_dtype(params.dtype), bool, np.uint8)
+    shapes = (volume.shape,) * 3 + ((1,),)
+    shms = []
+    try:
+        for shape, dtype in zip(shapes, dtypes):
+            size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            shms.append(SharedMemory(create=True, size=size))
+        specs = [(shm.name, shape, np.dtype(dtype).str)
+                 for shm, shape, dtype in zip(shms, shapes, dtypes)]
+        return _call_shared(_propagate_in_pool, specs, specs, volume, seed_index,
+                            seed_mask, up, down, params, workers, min_area, should_stop,
+                            edge_cache, cache_key)
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+
+class _PoolWalk(object):
+    """One direction of a pooled propagation, split into slabs of slices.
+
+    g(I) of a slab is computed (or copied from the cache) while the walk
+    segments the slab before it; the walk stops at the first slab that it
+    does not finish.
+    """
+
+    def __init__(self, zs, seed_mask, slab):
+        self.slabs = [zs[i:i + slab] for i in range(0, len(zs), slab)]
+        self.seed = seed_mask
+        self.current = 0  # slab being (or next to be) segmented
+        self.edges = {}  # slab index -> (slices computed in the pool, their futures)
+        self.segmenting = None  # future of the walk over the current slab
+        self.done, self.iterations, self.cancelled = [], 0, False
+        self.finished = not self.slabs
+
+    def futures(self):
+        pending = [f for _, futures in self.edges.values() for f in futures]
+        return pending + ([self.segmenting] if self.segmenting is not None else [])
+
+    def stop(self):
+        self.finished = True
+        for _, futures in self.edges.values():
+            for future in futures:
+                future.cancel()
+
+
+def _propagate_in_pool(shared_volume, gvolume, masks, control, specs, volume,
+                       seed_index, seed_mask, up, down, params, workers, min_area,
+                       should_stop, edge_cache, cache_key):
+    shared_volume[...] = volume
+    masks[...] = False
+    masks[..., seed_index] = seed_mask
+    control[0] = 0
+    key_params = (params.alpha, params.sigma, params.gradient_method, params.dtype)
+
+    def prepare(pool, walk, index):
+        """Start filling g(I) of slab `index` of `walk`, from the cache where possible."""
+        if index in walk.edges or index >= len(walk.slabs):
+            return
+        missing = []
+        for z in walk.slabs[index]:
+            cached = edge_cache.get((cache_key, z), *key_params) if edge_cache else None
+            if cached is not None:
+                gvolume[..., z] = cached[0]
+            else:
+                missing.append(z)
+        walk.edges[index] = (missing, [pool.submit(_call_shared, _edge_maps, specs[:2], [z],
+                                                   *key_params) for z in missing])
+
+    def advance(pool, walk):
+        """Start segmenting the next slab of `walk` once its g(I) is ready."""
+        if walk.finished or walk.segmenting is not None:
+            return
+        prepare(pool, walk, walk.current)
+        computed, futures = walk.edges[walk.current]
+        if not all(f.done() for f in futures):
+            return
+        for future in futures:
+            future.result()
+        del walk.edges[walk.current]
+        if edge_cache is not None:
+            for z in computed:
+                edge_cache.put((cache_key, z), gvolume[..., z].copy(), *key_params)
+        walk.segmenting = pool.submit(_call_shared, _walk_shared, specs, walk.seed,
+                                      walk.slabs[walk.current], params, min_area)
+        prepare(pool, walk, walk.current + 1)
+
+    def finish_slab(walk):
+        slab = walk.slabs[walk.current]
+        done, n, cancelled = walk.segmenting.result()
+        walk.segmenting = None
+        walk.done += done
+        walk.iterations += n
+        walk.cancelled = cancelled
+        walk.current += 1
+        if cancelled or len(done) < len(slab) or walk.current == len(walk.slabs):
+            walk.stop()
+        else:
+            walk.seed = masks[..., slab[-1]].copy()
+
+    # The two walks each take a worker; the others prepare slabs ahead of them.
+    slab = max(1, workers - 2)
+    walks = [_PoolWalk(zs, seed_mask, slab) for zs in (up, down)]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+        while not all(walk.finished for walk in walks):
+            if control[0]:
+                for walk in walks:
+                    if walk.segmenting is None and not walk.finished:
+                        walk.cancelled = True
+                        walk.stop()
+            for walk in walks:
+                advance(pool, walk)
+            pending = [f for walk in walks for f in walk.futures()]
+            if pending:
+                wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+            if should_stop():
+                control[0] = 1
+            for walk in walks:
+                if walk.segmenting is not None and walk.segmenting.done():
+                    finish_slab(walk)
+    slices = [seed_index] + [z for walk in walks for z in walk.done]
+    cancelled = bool(control[0]) or any(walk.cancelled for walk in walks)
+    return PropagationResult(mask=masks.copy(), slices=sorted(slices),
+                             iterations=sum(walk.iterations for walk in walks),
+                             stop_reason="cancelled" if cancelled else "completed")
+
@@ -0,0 +1,288 @@
+"""Lazy access to NIfTI volumes.
+
+`LazyVolume` keeps the file's data on disk (memory-mapped for uncompressed
+.nii files) and only reads and normalizes the slices that are asked for, so
+large volumes open without materializing them in float64. Eagerly loaded
+volumes are normalized chunk by chunk with `normalize_volume`. Files are
+opened with `load`, which keeps them open between chunk reads.
+Segmentations are written back as uint8 label volumes by `save_label_volume`.
+"""
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+
+import nibabel as nib
+import numpy as np
+
+import medicalcontour.utils as utils
+
+
+# Intensity mappings offered when loading a volume: label -> intensity_range arguments.
+INTENSITY_WINDOWS = {
+    "Full range": {},
+    "Percentiles 0.5-99.5": dict(percentiles=(0.5, 99.5)),
+}
+INTENSITY_WINDOWS.update({f"{name} window": dict(window=window)
+                          for name, window in utils.WINDOW_PRESETS.items()})
+
+
+def load(path, random_access=False):
+    """Open a NIfTI file for reading in chunks or slices.
+
+    nibabel reopens a file for every read by default, and a .nii.gz is then
+    decompressed from its start each time, which makes a chunked pass
+    quadratic in the depth; the file is kept open instead, so a pass in
+    order decompresses it once. Random access into a gzip stream still
+    decompresses everything before the slice read, so with `random_access`
+    a .nii.gz is decompressed once to a temporary .nii, deleted with the
+    returned image's data.
+    """
+    if not (random_access and path.endswith(".gz")):
+        return nib.load(path, keep_file_open=True)
+    handle, temporary = tempfile.mkstemp(suffix=".nii")
+    try:
+        with gzip.open(path, "rb") as src, os.fdopen(handle, "wb") as dst:
+            shutil.copyfileobj(src, dst, 2 ** 22)
+        image = nib.load(temporary, keep_file_open=True)
+    except BaseException:
+        os.remove(temporary)
+        raise
+    weakref.finalize(image.dataobj, os.remove, temporary)
+    return image
+
+
+def _read_chunks(dataobj, chunk_slices):
+    """(index, array) pairs covering a (proxy) array, `chunk_slices` z-slices at a time."""
+    if len(dataobj.shape) < 3:
+        yield Ellipsis, np.asarray(dataobj)
+        return
+    for z0 in range(0, dataobj.shape[2], chunk_slices):
+        index = (slice(None), slice(None), slice(z0, z0 + chunk_slices))
+        yield index, np.asarray(dataobj[index])
+
+
+def streaming_min_max(dataobj, chunk_slices=16):
+    """Global min and max of a (proxy) array, read `chunk_slices` z-slices at a time."""
+    min_val, max_val = np.inf, -np.inf
+    for _, chunk in _read_chunks(dataobj, chunk_slices):
+        min_val = min(min_val, float(chunk.min()))
+        max_val = max(max_val, float(chunk.max()))
+    return min_val, max_val
+
+
+def streaming_histogram(dataobj, min_val, max_val, bins=4096, chunk_slices=16):
+    """Counts of `bins` equal bins over [min_val, max_val], in one pass over the chunks."""
+    counts = np.zeros(bins, dtype=np.int64)
+    for _, chunk in _read_chunks(dataobj, chunk_slices):
+        counts += np.histogram(chunk, bins, (min_val, max_val))[0]
+    return counts
+
+
+def histogram_percentiles(counts, min_val, max_val, percentiles):
+    """Percentiles of the data counted by `streaming_histogram`, interpolated
+    within bins."""
+    cdf = np.cumsum(counts)
+    width = (max_val - min_val) / len(counts)
+    values = []
+    for p in percentiles:
+        rank = p / 100.0 * cdf[-1]
+        i = min(int(np.searchsorted(cdf, rank)), len(counts) - 1)
+        before = cdf[i - 1] if i > 0 else 0
+        fraction = (rank - before) / counts[i] if counts[i] else 0.0
+        values.append(min_val + (i + fraction) * width)
+    return values
+
+
+def intensity_range(dataobj, window=None, percentiles=None, chunk_slices=16):
+    """The intensities mapped to 0 and 255 when normalizing `dataobj`.
+
+    `window` is a (level, width) pair (see utils.WINDOW_PRESETS);
+    `percentiles` a (low, high) pair, clipping outliers such as metal or
+    air; the default is the full data range.
+    """
+    if window is not None:
+        return utils.window_range(*window)
+    min_val, max_val = streaming_min_max(dataobj, chunk_slices)
+    if percentiles is None or not max_val > min_val:
+        return min_val, max_val
+    counts = streaming_histogram(dataobj, min_val, max_val, chunk_slices=chunk_slices)
+    low, high = histogram_percentiles(counts, min_val, max_val, percentiles)
+    return low, high
+
+
+def normalize_volume(dataobj, min_val, max_val, out=None, chunk_slices=16):
+    """uint8 copy of a (proxy) array normalized to [min_val, max_val].
+
+    Chunks of `chunk_slices` z-slices are read and written straight into
+    `out` (allocated if None), so the peak memory is the output plus about
+    one chunk.
+    """
+    if out is None:
+        out = np.empty(dataobj.shape, dtype=np.uint8)
+    for index, chunk in _read_chunks(dataobj, chunk_slices):
+        utils.normalize(chunk, min_val, max_val, out=out[index])
+    return out
+
+
+def _is_full(index):
+    return isinstance(index, slice) and index == slice(None)
+
+
+class LazyVolume(object):
+    """Read-only uint8 view of a 3D NIfTI data array.
+
+    Indexed [y, x, z] like the eagerly loaded volume (the file's x/y axes are
+    transposed and y is flipped). `volume[:, :, z]` reads and normalizes a
+    single slice; the last `cache_slices` of them are kept. Any other index,
+    or `np.asarray(volume)`, materializes the whole uint8 volume.
+    `window` and `percentiles` are as in `intensity_range`. Open compressed
+    files with `load(path, random_access=True)`: slices of a gzip stream
+    cost a decompression of everything before them.
+    """
+
+    def __init__(self, dataobj, chunk_slices=16, cache_slices=8, window=None, percentiles=None):
+        if len(dataobj.shape) != 3:
+            raise ValueError("LazyVolume needs a 3-dimensional volume.")
+        self.dataobj = dataobj
+        x, y, z = dataobj.shape
+        self.shape = (y, x, z)
+        self.ndim = 3
+        self.dtype = np.dtype(np.uint8)
+        self.chunk_slices = chunk_slices
+        self.cache_slices = cache_slices
+        self.min_val, self.max_val = intensity_range(dataobj, window, percentiles, chunk_slices)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()  # slices are also read by the display prefetcher
+
+    def _normalize(self, raw):
+        """Normalize raw [x, y, ...] data and reorient it to [y, x, ...]."""
+        image = utils.normalize(np.asarray(raw), self.min_val, self.max_val)
+        return np.ascontiguousarray(np.flip(np.swapaxes(image, 0, 1), axis=0))
+
+    def slice(self, z):
+        """The normalized uint8 slice `z`, indexed [y, x]."""
+        z = range(self.shape[2])[z]
+        with self._lock:
+            if z in self._cache:
+                self._cache.move_to_end(z)
+                return self._cache[z]
+            image = self._normalize(self.dataobj[:, :, z])
+            self._cache[z] = image
+            if len(self._cache) > self.cache_slices:
+                self._cache.popitem(last=False)
+            return image
+
+    def __array__(self, dtype=None):
+        out = np.empty(self.shape, dtype=np.uint8)
+        for z0 in range(0, self.shape[2], self.chunk_slices):
+            z1 = min(z0 + self.chunk_slices, self.shape[2])
+            out[:, :, z0:z1] = self._normalize(self.dataobj[:, :, z0:z1])
+        return out if dtype is None else out.astype(dtype)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            if len(key) == 2 and key[0] is Ellipsis:
+                key = (slice(None), slice(None), key[1])
+            if (len(key) == 3 and _is_full(key[0]) and _is_full(key[1])
+                    and isinstance(key[2], (int, np.integer))):
+                return self.slice(key[2])
+        return np.asarray(self)[key]
+
+    def __len__(self):
+        return self.shape[0]
+
+
+def label_header(labels, reference=None):
+    """NIfTI header of the uint8 label volume of `labels` (a LabelStore).
+
+    Geometry and metadata come from `reference`, the image the labels were
+    drawn on, so the labels overlay it in other viewers; without one the
+    affine is the identity.
+    """
+    rows, columns = labels.shape
+    shape = (columns, rows, labels.depth)
+    if reference is None:
+        header = nib.Nifti1Header()
+        header.set_qform(np.eye(4), code="aligned")
+        header.set_sform(np.eye(4), code="aligned")
+    else:
+        if tuple(reference.shape[:3]) != shape[:len(reference.shape)]:
+            raise ValueError(f"Labels of shape {shape} do not match the image's {reference.shape}.")
+        header = nib.Nifti1Header.from_header(reference.header)
+    header.set_data_shape(shape)
+    header.set_data_dtype(np.uint8)
+    header.set_slope_inter(1.0, 0.0)
+    header.set_data_offset(0)  # set past the extensions when written
+    header.set_intent("label")
+    header["cal_min"], header["cal_max"] = 0, max(labels.colors, default=0)
+    return header
+
+
+def _slice_bytes(labels, z):
+    # Label maps are indexed [y, x] with y flipped; the file stores [x, y]
+    # in Fortran order, which is the flipped map in C order.
+    return np.ascontiguousarray(labels.get(z)[::-1]).tobytes()
+
+
+def _update_labels(labels, path, slices, progress):
+    """Rewrite `slices` of the uncompressed label file `path` in place.
+    False if the file does not hold a label volume of the same shape and
+    labels."""
+    try:
+        image = nib.load(path)
+    except Exception:
+        return False
+    rows, columns = labels.shape
+    if (image.shape != (columns, rows, labels.depth) or image.get_data_dtype() != np.uint8
+            or image.header["cal_max"] < max(labels.colors, default=0)):
+        return False
+    offset = image.dataobj.offset
+    with open(path, "r+b") as f:
+        for done, z in enumerate(slices, 1):
+            f.seek(offset + z * rows * columns)
+            f.write(_slice_bytes(labels, z))
+            progress(done, len(slices))
+    return True
+
+
+def save_label_volume(labels, path, reference=None, compresslevel=6, since=None,
+                      progress=None):
+    """Write `labels` (a LabelStore) to `path` as a uint8 NIfTI label volume.
+
+    A ".gz" path is compressed at gzip level `compresslevel` (1 is fastest,
+    9 smallest). Slices are decoded and written one at a time, into a
+    temporary file renamed over `path` at the end. With `since`, the
+    `labels.counter` of a previous save to the same uncompressed file, only
+    the slices changed after it are rewritten in place. `progress(done,
+    total)` is called after each slice. Returns the slices written.
+    """
+    if progress is None:
+        progress = lambda done, total: None
+    compressed = path.endswith(".gz")
+    if since is not None and not compressed and os.path.exists(path):
+        slices = labels.changed_since(since)
+        if _update_labels(labels, path, slices, progress):
+            return slices
+    header = label_header(labels, reference)
+    temporary = path + ".part"
+    try:
+        if compressed:
+            f = gzip.open(temporary, "wb", compresslevel=compresslevel)
+        else:
+            f = open(temporary, "wb")
+        with f:
+            header.write_to(f)
+            f.write(b"\0" * (header.get_data_offset() - f.tell()))
+            for z in range(labels.depth):
+                f.write(_slice_bytes(labels, z))
+                progress(z + 1, labels.depth)
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return list(range(labels.depth))
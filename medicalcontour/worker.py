@@ -0,0 +1,326 @@
+"""Background segmentation so the window stays responsive during a run.
+
+Jobs run one at a time on a QThread; the engine's scipy.ndimage calls release
+the GIL, so the GUI thread keeps handling events meanwhile. Intermediate level
+sets and results come back through Qt signals. Label volumes are saved the
+same way by a `LabelSaver`, on a thread of their own so that a save does not
+wait for the segmentations.
+"""
+import copy
+import threading
+from collections import deque
+from dataclasses import dataclass, field, replace
+from typing import Any, Optional, Sequence, Tuple
+
+import numpy as np
+from PyQt5.QtCore import QObject, QThread, pyqtSignal, pyqtSlot
+
+from medicalcontour import display
+from medicalcontour import engine
+from medicalcontour import profiling
+from medicalcontour import propagation
+from medicalcontour import volume_io
+from medicalcontour.labels import LabelStore
+
+
+@dataclass
+class SegmentationJob:
+    """Everything a run needs, captured when it is queued.
+
+    `image` is the gray slice, or the whole volume when `volume` is set.
+    With an `edge_cache`, g(I) is looked up under `cache_key`. `image_serial`
+    identifies the window's image the job was queued for, so that a result
+    arriving after another image is loaded can be dropped.
+    """
+    image: np.ndarray
+    mode: str
+    key_points: Sequence[Tuple[int, ...]]
+    params: engine.ContourParams
+    slice_index: int = 0
+    color: Tuple[int, int, int] = (255, 0, 0)
+    volume: bool = False
+    throttle: display.RenderThrottle = field(default_factory=display.RenderThrottle)
+    edge_cache: Optional[engine.EdgeMapCache] = None
+    cache_key: Optional[tuple] = None
+    image_serial: int = 0
+
+    def __post_init__(self):
+        # The window keeps editing its own parameters while the job waits.
+        self.params = replace(self.params)
+        self.key_points = list(self.key_points)
+        self.throttle = copy.copy(self.throttle)
+
+    def run(self, iter_callback=None, should_stop=None):
+        segment = engine.segment_volume if self.volume else engine.segment
+        return segment(self.image, self.mode, self.key_points,
+                       params=self.params, iter_callback=iter_callback,
+                       should_stop=should_stop, edge_cache=self.edge_cache,
+                       cache_key=self.cache_key)
+
+
+@dataclass
+class RefineJob:
+    """Re-segment slice `slice_index` after its seed moved from
+    `old_key_points` to `key_points`, starting from its `previous` mask;
+    see `engine.refine`."""
+    image: np.ndarray
+    mode: str
+    key_points: Sequence[Tuple[int, int]]
+    previous: np.ndarray
+    old_key_points: Sequence[Tuple[int, int]]
+    params: engine.ContourParams
+    slice_index: int = 0
+    color: Tuple[int, int, int] = (255, 0, 0)
+    volume: bool = False
+    throttle: display.RenderThrottle = field(default_factory=display.RenderThrottle)
+    edge_cache: Optional[engine.EdgeMapCache] = None
+    cache_key: Optional[tuple] = None
+    image_serial: int = 0
+
+    def __post_init__(self):
+        self.params = replace(self.params)
+        self.key_points = list(self.key_points)
+        self.old_key_points = list(self.old_key_points)
+        self.previous = np.array(self.previous, dtype=bool)
+        self.throttle = copy.copy(self.throttle)
+
+    def run(self, iter_callback=None, should_stop=None):
+        return engine.refine(self.image, self.mode, self.key_points, self.previous,
+                             self.old_key_points, params=self.params,
+                             iter_callback=iter_callback, should_stop=should_stop,
+                             edge_cache=self.edge_cache, cache_key=self.cache_key)
+
+
+@dataclass
+class RegionsJob:
+    """Several seeds of one slice segmented together; see `engine.segment_regions`.
+
+    `regions` holds (mode, key_points, color) triples. The result mask labels
+    region k with k + 1.
+    """
+    image: np.ndarray
+    regions: Sequence[Tuple[str, Sequence[Tuple[int, int]], Tuple[int, int, int]]]
+    params: engine.ContourParams
+    slice_index: int = 0
+    volume: bool = False
+    throttle: display.RenderThrottle = field(default_factory=display.RenderThrottle)
+    edge_cache: Optional[engine.EdgeMapCache] = None
+    cache_key: Optional[tuple] = None
+    image_serial: int = 0
+
+    def __post_init__(self):
+        self.params = replace(self.params)
+        self.regions = [(mode, list(key_points), tuple(color))
+                        for mode, key_points, color in self.regions]
+        self.throttle = copy.copy(self.throttle)
+
+    @property
+    def colors(self):
+        """Label -> color, as used by `labels.draw_label_edges`."""
+        return {k: color for k, (_, _, color) in enumerate(self.regions, 1)}
+
+    def run(self, iter_callback=None, should_stop=None):
+        return engine.segment_regions(self.image, [(mode, key_points)
+                                                   for mode, key_points, _ in self.regions],
+                                      params=self.params, iter_callback=iter_callback,
+                                      should_stop=should_stop, edge_cache=self.edge_cache,
+                                      cache_key=self.cache_key)
+
+
+@dataclass
+class PropagationJob:
+    """Propagate the mask of slice `slice_index` through the whole volume.
+
+    With an `edge_cache`, g(I) of slice z is shared under (`cache_key`, z).
+    """
+    image: np.ndarray
+    seed_mask: np.ndarray
+    params: engine.ContourParams
+    slice_index: int = 0
+    color: Tuple[int, int, int] = (255, 0, 0)
+    workers: Optional[int] = None
+    volume: bool = True
+    throttle: display.RenderThrottle = field(default_factory=display.RenderThrottle)
+    edge_cache: Optional[engine.EdgeMapCache] = None
+    cache_key: Any = None
+    image_serial: int = 0
+
+    def __post_init__(self):
+        self.params = replace(self.params)
+        self.seed_mask = np.array(self.seed_mask, dtype=bool)
+
+    def run(self, iter_callback=None, should_stop=None):
+        # Slices are finished in worker processes; there is no per-iteration preview.
+        return propagation.propagate_volume(self.image, self.slice_index, self.seed_mask,
+                                            params=self.params, workers=self.workers,
+                                            should_stop=should_stop, edge_cache=self.edge_cache,
+                                            cache_key=self.cache_key)
+
+
+@dataclass
+class SaveJob:
+    """Write `labels` as a label volume; see `volume_io.save_label_volume`.
+
+    The labels are snapshotted when the job is created, so segmentations that
+    finish during the save are left for the next one.
+    """
+    labels: LabelStore
+    path: str
+    reference: Any = None  # the NIfTI image the labels were drawn on
+    compresslevel: int = 6
+    since: Optional[int] = None
+    source: LabelStore = field(init=False, repr=False)  # the store snapshotted
+
+    def __post_init__(self):
+        self.source, self.labels = self.labels, self.labels.snapshot()
+
+    def run(self, progress=None):
+        return volume_io.save_label_volume(self.labels, self.path, self.reference,
+                                           compresslevel=self.compresslevel,
+                                           since=self.since, progress=progress)
+
+
+class SegmentationWorker(QObject):
+    """Runs a single job; lives on its own QThread."""
+    progress = pyqtSignal(object, object)  # job, level set copy
+    finished = pyqtSignal(object, object)  # job, ContourResult
+    failed = pyqtSignal(object, str)       # job, error message
+
+    def __init__(self, job):
+        super().__init__()
+        self.job = job
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    @pyqtSlot()
+    def run(self):
+        self.job.throttle.reset()
+        try:
+            with profiling.stage("segmentation", job=type(self.job).__name__,
+                                 slice=self.job.slice_index, volume=self.job.volume) as record:
+                result = self.job.run(self._progress, self._cancel.is_set)
+                record["iterations"] = result.iterations
+                record["stop_reason"] = result.stop_reason
+        except Exception as exc:
+            self.failed.emit(self.job, str(exc))
+            return
+        self.finished.emit(self.job, result)
+
+    def _progress(self, levelset):
+        # The engine reuses the level set buffer, so send a copy across threads;
+        # of a volume only the job's slice, which is all the preview shows.
+        if self.job.throttle.should_render():
+            if self.job.volume:
+                levelset = levelset[..., self.job.slice_index]
+            self.progress.emit(self.job, levelset.copy())
+
+
+class SegmentationQueue(QObject):
+    """Queue of segmentation jobs run one after another in the background."""
+    progress = pyqtSignal(object, object)
+    finished = pyqtSignal(object, object)
+    failed = pyqtSignal(object, str)
+    busy_changed = pyqtSignal(bool)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pending = deque()
+        self._thread = None
+        self._worker = None
+
+    @property
+    def busy(self):
+        return self._thread is not None
+
+    def submit(self, job):
+        """Queue `job`; it starts as soon as the previous one is done."""
+        self.pending.append(job)
+        if not self.busy:
+            self._start_next()
+
+    def cancel(self):
+        """Drop the queued jobs and stop the running one."""
+        self.pending.clear()
+        if self._worker is not None:
+            self._worker.cancel()
+
+    def wait(self, msecs=None):
+        """Block until the running job's thread has exited (for shutdown)."""
+        if self._thread is not None:
+            return self._thread.wait() if msecs is None else self._thread.wait(msecs)
+        return True
+
+    def _start_next(self):
+        if not self.pending:
+            self.busy_changed.emit(False)
+            return
+        job = self.pending.popleft()
+        thread = QThread()
+        worker = SegmentationWorker(job)
+        worker.moveToThread(thread)
+        thread.started.connect(worker.run)
+        worker.progress.connect(self.progress)
+        worker.finished.connect(self.finished)
+        worker.failed.connect(self.failed)
+        worker.finished.connect(thread.quit)
+        worker.failed.connect(thread.quit)
+        thread.finished.connect(self._on_thread_finished)
+        self._thread, self._worker = thread, worker
+        self.busy_changed.emit(True)
+        thread.start()
+
+    def _on_thread_finished(self):
+        # `finished` is emitted just before the thread exits; let it exit
+        # before the QThread object is released.
+        self._thread.wait()
+        self._thread = self._worker = None
+        self._start_next()
+
+
+class LabelSaver(QObject):
+    """Runs SaveJobs one after another on a background thread."""
+    progress = pyqtSignal(object, int, int)  # job, slices written, total
+    finished = pyqtSignal(object, object)    # job, slices written
+    failed = pyqtSignal(object, str)         # job, error message
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pending = deque()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def busy(self):
+        return self._thread is not None
+
+    def submit(self, job):
+        with self._lock:
+            self.pending.append(job)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def wait(self, timeout=None):
+        """Block until the queued saves are written (for shutdown)."""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        return not self.busy
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self.pending:
+                    self._thread = None
+                    return
+                job = self.pending.popleft()
+            try:
+                with profiling.stage("save", file=job.path, level=job.compresslevel) as record:
+                    slices = job.run(lambda done, total: self.progress.emit(job, done, total))
+                    record["slices"] = len(slices)
+            except Exception as exc:
+                self.failed.emit(job, str(exc))
+            else:
+                self.finished.emit(job, slices)